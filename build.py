@@ -5,7 +5,6 @@
 
 import argparse
 import os
-import pickle
 import numpy as np
 import datetime
 from dateutil.parser import parse as parse_date
@@ -13,7 +12,7 @@ import logging
 from ml_tools.logs import init_logging
 from ml_tools.trackdatabase import TrackDatabase
 from config.config import Config
-from ml_tools.dataset import Dataset, dataset_db_path
+from ml_tools.dataset import Dataset, dataset_manifest_path, save_datasets
 from ml_tools.datasetstructures import Camera
 import pytz
 
@@ -294,7 +293,7 @@ def main():
     datasets = (*datasets, test)
     print_counts(dataset, *datasets)
     print_cameras(*datasets)
-    pickle.dump(datasets, open(dataset_db_path(config), "wb"))
+    save_datasets(datasets, dataset_manifest_path(config))
 
 
 if __name__ == "__main__":
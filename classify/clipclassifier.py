@@ -322,9 +322,12 @@ class ClipClassifier(CPTVFileProcessor):
             track_info["frame_end"] = track.end_frame
 
             positions = []
-            for region in track.bounds_history:
-                track_time = round(region.frame_number / clip.frames_per_second, 2)
-                positions.append([track_time, region])
+            for frame_number, bounds in zip(
+                track.bounds_history.frame_number.tolist(),
+                track.bounds_history.ltrb().tolist(),
+            ):
+                track_time = round(frame_number / clip.frames_per_second, 2)
+                positions.append([track_time, bounds])
             track_info["positions"] = positions
             prediction_info = []
             for model, predictions in predictions_per_model.items():
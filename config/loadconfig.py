@@ -51,6 +51,9 @@ class LoadConfig(DefaultConfig):
     tag_precedence = attr.ib()
     cache_to_disk = attr.ib()
     high_quality_optical_flow = attr.ib()
+    sharded_writes = attr.ib()
+    incremental = attr.ib()
+    evict_removed = attr.ib()
 
     @classmethod
     def load(cls, config):
@@ -61,6 +64,9 @@ class LoadConfig(DefaultConfig):
             tag_precedence=LoadConfig.get_tag_precedence(config),
             cache_to_disk=config["cache_to_disk"],
             high_quality_optical_flow=config["high_quality_optical_flow"],
+            sharded_writes=config["sharded_writes"],
+            incremental=config["incremental"],
+            evict_removed=config["evict_removed"],
         )
 
     @classmethod
@@ -72,6 +78,9 @@ class LoadConfig(DefaultConfig):
             tag_precedence=LoadConfig.DEFAULT_GROUPS,
             cache_to_disk=False,
             high_quality_optical_flow=True,
+            sharded_writes=False,
+            incremental=False,
+            evict_removed=False,
         )
 
     def get_tag_precedence(config):
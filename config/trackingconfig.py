@@ -23,6 +23,8 @@ from config import config
 from .defaultconfig import DefaultConfig
 from .motionconfig import MotionConfig
 from load.cliptrackextractor import ClipTrackExtractor
+from track.framebuffer import FrameBuffer
+from ml_tools.imageprocessing import DENOISERS
 
 
 @attr.s
@@ -61,6 +63,16 @@ class TrackingConfig(DefaultConfig):
     max_mass_std_percent = attr.ib()
 
     max_jitter = attr.ib()
+    single_pass = attr.ib()
+    region_matching = attr.ib()
+    denoiser = attr.ib()
+    threaded_pipeline = attr.ib()
+    background_cache_dir = attr.ib()
+    background_cache_mb = attr.ib()
+    frame_cache = attr.ib()
+    ring_buffer_frames = attr.ib()
+    flow_region_padding = attr.ib()
+    lazy_flow = attr.ib()
     # used to provide defaults
     stats = attr.ib()
     filters = attr.ib()
@@ -108,6 +120,24 @@ class TrackingConfig(DefaultConfig):
             max_blank_percent=tracking["max_blank_percent"],
             max_mass_std_percent=tracking["max_mass_std_percent"],
             max_jitter=tracking["max_jitter"],
+            single_pass=tracking["single_pass"],
+            region_matching=config.parse_options_param(
+                "region_matching",
+                tracking["region_matching"],
+                [ClipTrackExtractor.GREEDY, ClipTrackExtractor.HUNGARIAN],
+            ),
+            denoiser=config.parse_options_param(
+                "denoiser", tracking["denoiser"], list(DENOISERS)
+            ),
+            threaded_pipeline=tracking["threaded_pipeline"],
+            background_cache_dir=tracking["background_cache_dir"],
+            background_cache_mb=tracking["background_cache_mb"],
+            frame_cache=config.parse_options_param(
+                "frame_cache", tracking["frame_cache"], list(FrameBuffer.CACHE_BACKENDS)
+            ),
+            ring_buffer_frames=tracking["ring_buffer_frames"],
+            flow_region_padding=tracking["flow_region_padding"],
+            lazy_flow=tracking["lazy_flow"],
             stats=None,
             filters=None,
             areas_of_interest=None,
@@ -165,6 +195,16 @@ class TrackingConfig(DefaultConfig):
             max_blank_percent=30,
             max_mass_std_percent=ClipTrackExtractor.MASS_CHANGE_PERCENT,
             max_jitter=20,
+            single_pass=False,
+            region_matching=ClipTrackExtractor.GREEDY,
+            denoiser="nlmeans",
+            threaded_pipeline=False,
+            background_cache_dir=None,
+            background_cache_mb=200,
+            frame_cache="hdf5",
+            ring_buffer_frames=None,
+            flow_region_padding=None,
+            lazy_flow=False,
         )
 
     def validate(self):
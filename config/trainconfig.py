@@ -33,6 +33,8 @@ class TrainConfig(DefaultConfig):
     resnet_params = attr.ib()
     use_gru = attr.ib()
     model = attr.ib()
+    segment_cache_mb = attr.ib()
+    segment_cache_dir = attr.ib()
 
     @classmethod
     def load(cls, raw, base_data_folder):
@@ -46,6 +48,8 @@ class TrainConfig(DefaultConfig):
             epochs=raw["epochs"],
             use_gru=raw["use_gru"],
             model=raw["model"],
+            segment_cache_mb=raw.get("segment_cache_mb", 1024),
+            segment_cache_dir=raw.get("segment_cache_dir"),
         )
 
     @classmethod
@@ -73,6 +77,8 @@ class TrainConfig(DefaultConfig):
             epochs=30,
             use_gru=True,
             model="Resnet",
+            segment_cache_mb=1024,
+            segment_cache_dir=None,
         )
 
     def validate(self):
@@ -0,0 +1,3 @@
+from tests.denoisetest import main
+
+main()
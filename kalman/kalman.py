@@ -22,3 +22,177 @@ class Kalman:
     def correct(self, rect):
         pts = np.array([np.float32(rect.mid_x), np.float32(rect.mid_y)], np.float32)
         self.kalman.correct(pts)
+
+
+class BatchKalman:
+    """
+    Constant velocity Kalman filters for all the active tracks of a clip. The state
+    of every filter is stored in stacked numpy arrays, corrections and predictions
+    are queued by each track and applied to all tracks together by update().
+    Follows the same equations as the cv2.KalmanFilter used by Kalman.
+    """
+
+    INITIAL_CAPACITY = 16
+
+    TRANSITION = np.array(
+        [[1, 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0], [0, 0, 0, 1]], np.float32
+    )
+    PROCESS_NOISE = np.eye(4, 4, dtype=np.float32) * 0.03
+    MEASUREMENT_NOISE = np.eye(2, 2, dtype=np.float32)
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        capacity = max(1, capacity)
+        self.state_pre = np.zeros((capacity, 4), np.float32)
+        self.state_post = np.zeros((capacity, 4), np.float32)
+        self.cov_pre = np.zeros((capacity, 4, 4), np.float32)
+        self.cov_post = np.zeros((capacity, 4, 4), np.float32)
+        self.measurement = np.zeros((capacity, 2), np.float32)
+        self.to_correct = np.zeros(capacity, dtype=bool)
+        self.to_predict = np.zeros(capacity, dtype=bool)
+        self.free_slots = list(reversed(range(capacity)))
+
+    def _grow(self):
+        capacity = len(self.state_pre)
+        for name in (
+            "state_pre",
+            "state_post",
+            "cov_pre",
+            "cov_post",
+            "measurement",
+            "to_correct",
+            "to_predict",
+        ):
+            values = getattr(self, name)
+            grown = np.zeros((2 * capacity,) + values.shape[1:], values.dtype)
+            grown[:capacity] = values
+            setattr(self, name, grown)
+        self.free_slots.extend(reversed(range(capacity, 2 * capacity)))
+
+    def add(self, state=None):
+        """Returns a slot for a new filter, optionally restoring a saved state"""
+        if len(self.free_slots) == 0:
+            self._grow()
+        slot = self.free_slots.pop()
+        if state is None:
+            state = (0, 0, 0, 0)
+        (
+            self.state_pre[slot],
+            self.state_post[slot],
+            self.cov_pre[slot],
+            self.cov_post[slot],
+        ) = state
+        return slot
+
+    def remove(self, slot):
+        """Frees slot applying any pending operations, returns the filters state"""
+        if self.to_correct[slot] or self.to_predict[slot]:
+            self.update()
+        state = (
+            self.state_pre[slot].copy(),
+            self.state_post[slot].copy(),
+            self.cov_pre[slot].copy(),
+            self.cov_post[slot].copy(),
+        )
+        self.free_slots.append(slot)
+        return state
+
+    def correct(self, slot, x, y):
+        # a correction uses the latest prediction so earlier operations must be applied
+        if self.to_correct[slot] or self.to_predict[slot]:
+            self.update()
+        self.measurement[slot] = (x, y)
+        self.to_correct[slot] = True
+
+    def predict(self, slot):
+        if self.to_predict[slot]:
+            self.update()
+        self.to_predict[slot] = True
+
+    def pending(self, slot):
+        return self.to_correct[slot] or self.to_predict[slot]
+
+    def update(self):
+        """Applies all queued corrections and then all queued predictions"""
+        slots = np.flatnonzero(self.to_correct)
+        if len(slots) > 0:
+            self._correct(slots)
+        slots = np.flatnonzero(self.to_predict)
+        if len(slots) > 0:
+            self._predict(slots)
+        self.to_correct[:] = False
+        self.to_predict[:] = False
+
+    def _correct(self, slots):
+        state = self.state_pre[slots]
+        cov = self.cov_pre[slots]
+        # the measurement matrix selects the position, so the measurement
+        # covariances are the top rows of the state covariance
+        cov_h = cov[:, :2, :]
+        innovation = cov[:, :2, :2] + BatchKalman.MEASUREMENT_NOISE
+        a = innovation[:, 0, 0]
+        b = innovation[:, 0, 1]
+        c = innovation[:, 1, 0]
+        d = innovation[:, 1, 1]
+        inverse = np.stack((np.stack((d, -b), -1), np.stack((-c, a), -1)), 1)
+        inverse /= (a * d - b * c)[:, np.newaxis, np.newaxis]
+        gain = np.transpose(inverse @ cov_h, (0, 2, 1))
+        residual = self.measurement[slots] - state[:, :2]
+        self.state_post[slots] = state + (gain @ residual[:, :, np.newaxis])[:, :, 0]
+        self.cov_post[slots] = cov - gain @ cov_h
+
+    def _predict(self, slots):
+        transition = BatchKalman.TRANSITION
+        state = self.state_post[slots] @ transition.T
+        cov = transition @ self.cov_post[slots] @ transition.T
+        cov += BatchKalman.PROCESS_NOISE
+        self.state_pre[slots] = state
+        self.state_post[slots] = state
+        self.cov_pre[slots] = cov
+        self.cov_post[slots] = cov
+
+
+class KalmanTracker:
+    """
+    The Kalman filter of a single track, stored in a slot of a BatchKalman. Tracks
+    which do not share a BatchKalman get one of their own.
+    """
+
+    def __init__(self, batch=None):
+        if batch is None:
+            batch = BatchKalman(capacity=1)
+        self.batch = batch
+        self.slot = batch.add()
+        self.saved_state = None
+        self.predicted = False
+
+    def _get_slot(self):
+        if self.slot is None:
+            self.slot = self.batch.add(self.saved_state)
+            self.saved_state = None
+        return self.slot
+
+    def correct(self, rect):
+        self.batch.correct(self._get_slot(), rect.mid_x, rect.mid_y)
+
+    def predict(self):
+        self.batch.predict(self._get_slot())
+        self.predicted = True
+
+    def release(self):
+        """Frees this filters slot, it will be restored if the filter is used again"""
+        if self.slot is not None:
+            self.saved_state = self.batch.remove(self.slot)
+            self.slot = None
+
+    @property
+    def predicted_mid(self):
+        """Latest predicted x and y, or None if nothing has been predicted"""
+        if not self.predicted:
+            return None
+        if self.slot is None:
+            state = self.saved_state[0]
+        else:
+            if self.batch.pending(self.slot):
+                self.batch.update()
+            state = self.batch.state_pre[self.slot]
+        return (state[0], state[1])
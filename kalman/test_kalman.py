@@ -0,0 +1,45 @@
+import numpy as np
+
+from kalman.kalman import BatchKalman, Kalman, KalmanTracker
+from track.region import Region
+
+
+class TestBatchKalman:
+    def test_matches_cv2_kalman(self):
+        rng = np.random.default_rng(11)
+        batch = BatchKalman(capacity=2)
+        filters = [(Kalman(), KalmanTracker(batch)) for _ in range(6)]
+        for _ in range(60):
+            for kalman, tracker in filters:
+                if rng.random() < 0.7:
+                    region = Region(*rng.integers(0, 150, 2), 10, 8)
+                    kalman.correct(region)
+                    tracker.correct(region)
+                kalman.predict()
+                tracker.predict()
+            batch.update()
+            for kalman, tracker in filters:
+                expected = kalman.kalman.statePre[:2, 0]
+                assert np.allclose(tracker.predicted_mid, expected, rtol=1e-4)
+
+    def test_release_restores_state(self):
+        batch = BatchKalman(capacity=1)
+        tracker = KalmanTracker(batch)
+        other = KalmanTracker(batch)
+        for x in range(5):
+            tracker.correct(Region(x * 4, x * 2, 10, 10))
+            tracker.predict()
+            other.predict()
+        predicted_mid = tracker.predicted_mid
+        tracker.release()
+        assert tracker.predicted_mid == predicted_mid
+        KalmanTracker(batch)
+        tracker.predict()
+        expected = Kalman()
+        for x in range(5):
+            expected.correct(Region(x * 4, x * 2, 10, 10))
+            expected.predict()
+        prediction = expected.predict()
+        assert np.allclose(
+            tracker.predicted_mid, (prediction[0][0], prediction[1][0]), rtol=1e-4
+        )
@@ -0,0 +1,120 @@
+"""
+classifier-pipeline - this is a server side component that manipulates cptv
+files and to create a classification model of animals present
+Copyright (C) 2018, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import attr
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+
+class BackgroundCache:
+    """
+    Stores the calculated background of clips on disk so that reprocessing a clip
+    can skip the background pass. Entries are keyed by a hash of the cptv file
+    contents and the config used to calculate the background, when the cache grows
+    larger than max_bytes the least recently used entries are removed.
+    """
+
+    # increment when the background calculation changes to invalidate old entries
+    VERSION = 1
+    EXTENSION = ".npz"
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, clip):
+        """Hash of the clips file and the settings which affect its background"""
+        key = hashlib.sha1()
+        with open(clip.source_file, "rb") as f:
+            for chunk in iter(lambda: f.read(BackgroundCache.READ_SIZE), b""):
+                key.update(chunk)
+        settings = {
+            "version": BackgroundCache.VERSION,
+            "res": (clip.res_x, clip.res_y),
+            "background_thresh": clip.background_thresh,
+            "dynamic_thresh": clip.config.motion_config.dynamic_thresh,
+            "threshold": (
+                attr.asdict(clip.threshold_config) if clip.threshold_config else None
+            ),
+        }
+        key.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + BackgroundCache.EXTENSION)
+
+    def load(self, clip, key):
+        """Sets the background of clip from the cache, returns False if not cached"""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as cached:
+                clip.set_background(
+                    cached["background"],
+                    int(cached["background_frames"]),
+                    float(cached["mean_background_value"]),
+                    cached["temp_thresh"].item(),
+                )
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Could not load cached background %s %s", path, e)
+            return False
+        # mark as recently used
+        os.utime(path)
+        return True
+
+    def save(self, clip, key):
+        """Saves the background of clip, and removes old entries if the cache is full"""
+        if clip.background is None:
+            return
+        path = self._path(key)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(
+                f,
+                background=clip.background,
+                background_frames=clip.background_frames,
+                mean_background_value=clip.stats.mean_background_value,
+                temp_thresh=clip.temp_thresh,
+            )
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(BackgroundCache.EXTENSION):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
@@ -27,6 +27,7 @@ import cv2
 
 from ml_tools.imageprocessing import normalize, detect_objects
 from ml_tools.tools import Rectangle
+from kalman.kalman import BatchKalman
 from track.framebuffer import FrameBuffer
 from track.track import Track
 from track.region import Region
@@ -54,6 +55,8 @@ class Clip:
         self.num_preview_frames = 0
         self.region_history = []
         self.active_tracks = set()
+        # kalman filters of the active tracks, updated together each frame
+        self.kalman = BatchKalman()
         self.tracks = []
         self.filtered_tracks = []
         self.from_metadata = False
@@ -106,6 +109,18 @@ class Clip:
         self.set_temp_thresh()
         self.background_calculated = True
 
+    def set_background(
+        self, background, background_frames, mean_background_value, temp_thresh
+    ):
+        """Sets a background calculated previously for this clip"""
+        self.background = background
+        self.background_frames = background_frames
+        self.stats.mean_background_value = mean_background_value
+        self.temp_thresh = temp_thresh
+        if self.config.motion_config.dynamic_thresh:
+            self.stats.temp_thresh = temp_thresh
+        self.background_calculated = True
+
     def on_preview(self):
         return not self.background_calculated
 
@@ -266,6 +281,20 @@ class Clip:
     def _add_active_track(self, track):
         self.active_tracks.add(track)
         self.tracks.append(track)
+        if self.frame_buffer is not None:
+            self.frame_buffer.pin(track.get_id(), track.start_frame)
+
+    def _close_track(self, track):
+        """Frees the kalman filter and buffered frames of a track which has ended"""
+        track.kalman_tracker.release()
+        if self.frame_buffer is not None:
+            self.frame_buffer.unpin(track.get_id())
+
+    def _remove_active_tracks(self, tracks):
+        """Removes tracks from the active tracks and closes them"""
+        for track in tracks:
+            self._close_track(track)
+        self.active_tracks -= set(tracks)
 
     def get_id(self):
         return str(self._id)
@@ -335,7 +364,15 @@ class Clip:
 
     def set_frame_buffer(self, high_quality_flow, cache_to_disk, use_flow, keep_frames):
         self.frame_buffer = FrameBuffer(
-            self.source_file, high_quality_flow, cache_to_disk, use_flow, keep_frames
+            self.source_file,
+            high_quality_flow,
+            cache_to_disk,
+            use_flow,
+            keep_frames,
+            self.config.frame_cache,
+            self.config.ring_buffer_frames,
+            self.config.flow_region_padding,
+            self.config.lazy_flow,
         )
 
     def set_res(self, res_x, res_y):
@@ -364,12 +401,19 @@ class Clip:
         if self.config.verbose:
             logging.info(info_string)
 
-    def add_frame(self, thermal, filtered, mask, ffc_affected=False):
+    def add_frame(self, thermal, filtered, mask, ffc_affected=False, frame=None):
+        """
+        Adds a frame to the frame buffer, frame can be supplied if it has already
+        been created along with its optical flow
+        """
         if ffc_affected:
             self.ffc_frames.append(self.frame_on)
-        self.frame_buffer.add_frame(
-            thermal, filtered, mask, self.frame_on, ffc_affected
-        )
+        if frame is None:
+            self.frame_buffer.add_frame(
+                thermal, filtered, mask, self.frame_on, ffc_affected
+            )
+        else:
+            self.frame_buffer.store_frame(frame)
         if self.calc_stats:
             self.stats.add_frame(thermal, filtered)
 
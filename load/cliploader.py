@@ -17,7 +17,6 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
-
 import os
 import logging
 import multiprocessing
@@ -32,6 +31,7 @@ from ml_tools.kerasmodel import KerasModel
 from ml_tools.previewer import Previewer
 from ml_tools.trackdatabase import TrackDatabase
 from .clip import Clip
+from .loadmanifest import LoadManifest, get_metadata_filename
 from .cliptrackextractor import ClipTrackExtractor
 from track.track import Track, TrackChannels
 from classify.trackprediction import TrackPrediction
@@ -40,24 +40,31 @@ from ml_tools.imageprocessing import overlay_image, clear_frame
 import numpy as np
 
 
-def process_job(loader, queue, model_file=None):
+def process_job(loader, queue, model_file=None, shard=None):
     i = 0
+    if shard is not None:
+        loader.write_to_shard(shard)
     classifier = None
     if model_file is not None:
         classifier = KerasModel()
         classifier.load_model(model_file)
     while True:
         i += 1
-        clip_id = queue.get()
+        job = queue.get()
         try:
-            if clip_id == "DONE":
+            if job == "DONE":
                 break
             else:
-                loader.process_file(str(clip_id), classifier=classifier)
+                filename, reprocess = job
+                clip_id = loader.process_file(
+                    filename, classifier=classifier, reprocess=reprocess
+                )
+                if loader.manifest is not None:
+                    loader.manifest.record(filename, clip_id)
             if i % 50 == 0:
                 logging.info("%s jobs left", queue.qsize())
         except Exception as e:
-            logging.error("Process_job error %s %s", clip_id, e)
+            logging.error("Process_job error %s %s", job, e)
             traceback.print_exc()
 
 
@@ -110,8 +117,17 @@ class ClipLoader:
         self.database = TrackDatabase(
             os.path.join(self.config.tracks_folder, "dataset.hdf5")
         )
+        # database clips are written to, a shard of the database in sharded mode
+        self.writer = self.database
         self.calculate_predictions = calculate_predictions
         self.reprocess = reprocess
+        # files which have been loaded, so that only new or changed files are loaded
+        self.manifest = None
+        if self.config.load.incremental:
+            self.manifest = LoadManifest(
+                os.path.join(self.config.tracks_folder, "manifest.sqlite"),
+                ClipTrackExtractor.VERSION,
+            )
         self.compression = (
             tools.gzip_compression if self.config.load.enable_compression else None
         )
@@ -155,9 +171,36 @@ class ClipLoader:
                     process.terminate()
                 exit()
 
+    def write_to_shard(self, shard):
+        """
+        Writes clips to a shard of the database which only this process uses, so
+        workers don't wait on each other for the database lock
+        """
+        self.writer = TrackDatabase(
+            self.database.get_shard_filename(shard), use_lock=False
+        )
+        # files are only recorded as loaded once their clips are merged
+        if self.manifest is not None:
+            self.manifest = LoadManifest(
+                self.manifest.get_shard_filename(shard), self.manifest.tracker_version
+            )
+
+    def merge_shards(self):
+        """
+        Merges the shards of the database, then records the files loaded into them,
+        including shards left by a load which didn't finish
+        """
+        merged = self.database.merge_shards()
+        if merged:
+            logging.info("Merged %d clips from shards", merged)
+        if self.manifest is not None:
+            self.manifest.merge_shards()
+
     def process_all(self, root):
+        self.merge_shards()
         job_queue = Queue()
         processes = []
+        sharded = self.config.load.sharded_writes
         for i in range(max(1, self.workers_threads)):
             p = Process(
                 target=process_job,
@@ -165,6 +208,7 @@ class ClipLoader:
                     self,
                     job_queue,
                     self.config.classify.model if self.calculate_predictions else None,
+                    i if sharded else None,
                 ),
             )
             processes.append(p)
@@ -172,12 +216,24 @@ class ClipLoader:
         if root is None:
             root = self.config.source_folder
 
+        skipped = 0
         for folder_path, _, files in os.walk(root):
             for name in files:
                 if os.path.splitext(name)[1] == ".cptv":
                     full_path = os.path.join(folder_path, name)
-                    job_queue.put(full_path)
-
+                    reprocess = self.reprocess
+                    if self.manifest is not None and not reprocess:
+                        status = self.manifest.get_status(full_path)
+                        if status == LoadManifest.CURRENT:
+                            skipped += 1
+                            continue
+                        reprocess = status == LoadManifest.CHANGED
+                    job_queue.put((full_path, reprocess))
+
+        if self.manifest is not None:
+            logging.info("Skipping %d files which haven't changed", skipped)
+            if self.config.load.evict_removed:
+                self.evict_removed(root)
         logging.info("Processing %d", job_queue.qsize())
         for i in range(len(processes)):
             job_queue.put("DONE")
@@ -189,6 +245,15 @@ class ClipLoader:
                 for process in processes:
                     process.terminate()
                 exit()
+        if sharded:
+            self.merge_shards()
+
+    def evict_removed(self, root):
+        """Removes clips from the database whose cptv file under root was deleted"""
+        for filename, clip_id in self.manifest.get_removed(root):
+            if clip_id is not None and self.database.remove_clip(clip_id):
+                logging.info("Removed clip %s, %s was deleted", clip_id, filename)
+            self.manifest.remove(filename)
 
     def _get_dest_folder(self, filename):
         return os.path.join(self.config.tracks_folder, get_distributed_folder(filename))
@@ -201,7 +266,7 @@ class ClipLoader:
         # overwrite any old clips.
         # Note: we do this even if there are no tracks so there there will be a blank clip entry as a record
         # that we have processed it.
-        self.database.create_clip(clip)
+        self.writer.create_clip(clip)
         for track in clip.tracks:
             start_time, end_time = clip.start_and_end_time_absolute(
                 track.start_s, track.end_s
@@ -226,11 +291,11 @@ class ClipLoader:
 
             important_frames = get_important_frames(
                 clip.ffc_frames,
-                [bounds.mass for bounds in track.bounds_history],
+                track.bounds_history.mass,
                 self.config.build.train_min_mass,
                 cropped_data,
             )
-            self.database.add_track(
+            self.writer.add_track(
                 clip.get_id(),
                 track,
                 cropped_data,
@@ -290,8 +355,16 @@ class ClipLoader:
         confidence = track_tag.get("confidence", 0)
         return tag and tag not in excluded_tags and confidence >= min_confidence
 
-    def process_file(self, filename, classifier=None):
+    def process_file(self, filename, classifier=None, reprocess=None):
+        """
+        Tracks the clip in filename and writes it to the database.
+        :param reprocess: reload the clip if it is in the database, defaults to the
+        loaders reprocess setting
+        :returns: id of the clip or None if it has no metadata
+        """
         start = time.time()
+        if reprocess is None:
+            reprocess = self.reprocess
         base_filename = os.path.splitext(os.path.basename(filename))[0]
 
         logging.info(f"processing %s", filename)
@@ -301,27 +374,26 @@ class ClipLoader:
         tools.purge(destination_folder, base_filename + "*.mp4")
 
         # read metadata
-        metadata_filename = os.path.join(
-            os.path.dirname(filename), base_filename + ".txt"
-        )
+        metadata_filename = get_metadata_filename(filename)
 
         if not os.path.isfile(metadata_filename):
             logging.error("No meta data found for %s", metadata_filename)
             return
 
         metadata = tools.load_clip_metadata(metadata_filename)
-        if not self.reprocess and self.database.has_clip(str(metadata["id"])):
-            if not self.database.has_prediction(str(metadata["id"])) and classifier:
+        clip_id = str(metadata["id"])
+        if not reprocess and self.database.has_clip(clip_id):
+            if not self.database.has_prediction(clip_id) and classifier:
                 logging.info("Adding predictions to %s", filename)
-                add_predictions(self.database, str(metadata["id"]), classifier)
+                add_predictions(self.database, clip_id, classifier)
             else:
                 logging.warning("Already loaded %s", filename)
-            return
+            return clip_id
 
         valid_tracks = self._filter_clip_tracks(metadata)
         if not valid_tracks:
             logging.error("No valid track data found for %s", filename)
-            return
+            return clip_id
 
         clip = Clip(self.track_config, filename)
         clip.load_metadata(
@@ -332,7 +404,7 @@ class ClipLoader:
 
         if not self.track_extractor.parse_clip(clip):
             logging.error("No valid clip found for %s", filename)
-            return
+            return clip_id
 
         # , self.config.load.cache_to_disk, self.config.use_opt_flow
 
@@ -356,6 +428,7 @@ class ClipLoader:
                     len(clip.tracks), num_frames, ms_per_frame
                 )
             )
+        return clip_id
 
     def _log_message(self, message):
         """Record message in stdout.  Will be printed if verbose is enabled."""
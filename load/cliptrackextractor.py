@@ -18,6 +18,7 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 
+import attr
 import logging
 import numpy as np
 import time
@@ -25,13 +26,19 @@ import yaml
 
 from cptv import CPTVReader
 import cv2
+from scipy.optimize import linear_sum_assignment
 
+from .backgroundcache import BackgroundCache
 from .clip import Clip
+from .cptvframestore import CPTVFrameStore
+from .framepipeline import FramePipeline
+from ml_tools.frame import Frame
 from ml_tools.tools import Rectangle
 from track.region import Region
+from track.spatialindex import RegionGrid, TrackOverlapIndex
 from track.track import Track
 from piclassifier.motiondetector import is_affected_by_ffc
-from ml_tools.imageprocessing import detect_objects, normalize
+from ml_tools.imageprocessing import detect_objects, normalize, DENOISERS
 
 
 class ClipTrackExtractor:
@@ -44,9 +51,17 @@ class ClipTrackExtractor:
     MASS_CHANGE_PERCENT = 0.55
 
     MAX_DISTANCE = 2000
+    # maximum frames kept in memory when parsing in a single pass, 10 minutes
+    MAX_STORED_FRAMES = 9 * 60 * 10
+    # frames each stage of the threaded pipeline can get ahead by
+    PIPELINE_QUEUE_SIZE = 9
     PREVIEW = "preview"
     VERSION = 9
 
+    # methods of assigning regions to tracks
+    GREEDY = "greedy"
+    HUNGARIAN = "hungarian"
+
     def __init__(
         self,
         config,
@@ -70,6 +85,13 @@ class ClipTrackExtractor:
         self.keep_frames = keep_frames
         self.calc_stats = calc_stats
         self.tracking_time = None
+        self.denoise = DENOISERS[self.config.denoiser]
+        self.background_cache = None
+        if self.config.background_cache_dir:
+            self.background_cache = BackgroundCache(
+                self.config.background_cache_dir,
+                self.config.background_cache_mb * 1024 * 1024,
+            )
         if self.config.dilation_pixels > 0:
             size = self.config.dilation_pixels * 2 + 1
             self.dilate_kernel = np.ones((size, size), np.uint8)
@@ -109,14 +131,20 @@ class ClipTrackExtractor:
                 reader.preview_secs * clip.frames_per_second - self.config.ignore_frames
             )
             clip.set_video_stats(video_start_time)
-            clip.calculate_background(reader)
+            if self.config.single_pass:
+                # decode once and use the stored frames for both background and tracking
+                frame_store = CPTVFrameStore(
+                    clip.source_file, reader, ClipTrackExtractor.MAX_STORED_FRAMES
+                )
+                self._calculate_background(clip, frame_store)
+                self._process_frames(clip, frame_store)
+            else:
+                self._calculate_background(clip, reader)
 
-        with open(clip.source_file, "rb") as f:
-            reader = CPTVReader(f)
-            for frame in reader:
-                if frame.background_frame:
-                    continue
-                self.process_frame(clip, frame.pix, is_affected_by_ffc(frame))
+        if not self.config.single_pass:
+            with open(clip.source_file, "rb") as f:
+                reader = CPTVReader(f)
+                self._process_frames(clip, reader)
 
         if not clip.from_metadata:
             self.apply_track_filtering(clip)
@@ -126,6 +154,93 @@ class ClipTrackExtractor:
         self.tracking_time = time.time() - start
         return True
 
+    def _calculate_background(self, clip, frame_reader):
+        """Calculates the clips background, or loads it from the background cache"""
+        if self.background_cache is None:
+            clip.calculate_background(frame_reader)
+            return
+        key = self.background_cache.get_key(clip)
+        if not self.background_cache.load(clip, key):
+            clip.calculate_background(frame_reader)
+            self.background_cache.save(clip, key)
+
+    def _process_frames(self, clip, frames):
+        if self.config.threaded_pipeline:
+            self._process_frames_threaded(clip, frames)
+            return
+        for frame in frames:
+            if frame.background_frame:
+                continue
+            self.process_frame(clip, frame.pix, is_affected_by_ffc(frame))
+
+    def _process_frames_threaded(self, clip, frames):
+        """
+        Decodes, filters, detects objects and calculates optical flow for frames in
+        separate threads, then tracks the objects in order on this thread
+        """
+
+        def decode():
+            frame_number = clip.frame_on
+            for frame in frames:
+                if frame.background_frame:
+                    continue
+                yield PipelineFrame(frame_number, frame.pix, is_affected_by_ffc(frame))
+                frame_number += 1
+
+        def filter_frame(job):
+            job.filtered, job.threshold = self._get_filtered_frame(clip, job.thermal)
+            return job
+
+        def detect(job):
+            _, job.mask, job.component_details = detect_objects(
+                job.filtered.copy(), otsus=False, threshold=job.threshold
+            )
+            return job
+
+        prev_frame = clip.frame_buffer.prev_frame
+
+        def flow(job):
+            nonlocal prev_frame
+            job.frame = Frame(
+                job.thermal,
+                job.filtered,
+                job.mask,
+                job.frame_number,
+                ffc_affected=job.ffc_affected,
+            )
+            job.frame.generate_optical_flow(
+                clip.frame_buffer.opt_flow,
+                prev_frame,
+                region_padding=clip.frame_buffer.flow_region_padding,
+                lazy=clip.frame_buffer.lazy_flow,
+            )
+            prev_frame = job.frame
+            return job
+
+        stages = [filter_frame, detect]
+        if clip.frame_buffer.opt_flow:
+            stages.append(flow)
+        pipeline = FramePipeline(
+            decode(), stages, ClipTrackExtractor.PIPELINE_QUEUE_SIZE
+        )
+        for job in pipeline:
+            if job.ffc_affected:
+                self.print_if_verbose("{} ffc_affected".format(clip.frame_on))
+            clip.ffc_affected = job.ffc_affected
+            prev_filtered = clip.frame_buffer.get_last_filtered()
+            clip.add_frame(
+                job.thermal, job.filtered, job.mask, job.ffc_affected, frame=job.frame
+            )
+            self._track_objects(
+                clip,
+                job.filtered,
+                prev_filtered,
+                job.threshold,
+                job.component_details,
+                job.ffc_affected,
+            )
+            clip.frame_on += 1
+
     def process_frame(self, clip, frame, ffc_affected=False):
         if ffc_affected:
             self.print_if_verbose("{} ffc_affected".format(clip.frame_on))
@@ -154,7 +269,7 @@ class ClipTrackExtractor:
         np.clip(filtered - clip.background - avg_change, 0, None, out=filtered)
 
         filtered, stats = normalize(filtered, new_max=255)
-        filtered = cv2.fastNlMeansDenoising(np.uint8(filtered), None)
+        filtered = self.denoise(np.uint8(filtered))
         if stats[1] == stats[2]:
             mapped_thresh = clip.background_thresh
         else:
@@ -173,7 +288,14 @@ class ClipTrackExtractor:
         )
         prev_filtered = clip.frame_buffer.get_last_filtered()
         clip.add_frame(thermal, filtered, mask, ffc_affected)
+        self._track_objects(
+            clip, filtered, prev_filtered, threshold, component_details, ffc_affected
+        )
 
+    def _track_objects(
+        self, clip, filtered, prev_filtered, threshold, component_details, ffc_affected
+    ):
+        """Matches objects detected in the latest frame to tracks"""
         if clip.from_metadata:
             for track in clip.tracks:
                 if clip.frame_on in track.frame_list:
@@ -185,7 +307,7 @@ class ClipTrackExtractor:
         else:
             regions = []
             if ffc_affected:
-                clip.active_tracks = set()
+                clip._remove_active_tracks(list(clip.active_tracks))
             else:
                 regions = self._get_regions_of_interest(
                     clip, component_details, filtered, prev_filtered
@@ -201,24 +323,44 @@ class ClipTrackExtractor:
         unmatched_regions, matched_tracks = self._match_existing_tracks(clip, regions)
         new_tracks = self._create_new_tracks(clip, unmatched_regions)
         self._filter_inactive_tracks(clip, new_tracks, matched_tracks)
+        # apply this frames corrections and predictions to every track at once
+        clip.kalman.update()
 
     def _match_existing_tracks(self, clip, regions):
-
-        scores = []
-        used_regions = set()
         unmatched_regions = set(regions)
-        for track in clip.active_tracks:
-            for region in regions:
-                distance, size_change = get_region_score(track.last_bound, region)
-                # we give larger tracks more freedom to find a match as they might move quite a bit.
-
-                max_distance = get_max_distance_change(track)
-                max_size_change = get_max_size_change(track, region)
-                max_mass_change = get_max_mass_change_percent(track)
-                if (
-                    max_mass_change
-                    and abs(track.average_mass() - region.mass) > max_mass_change
-                ):
+        matched_tracks = set()
+        tracks = list(clip.active_tracks)
+        if len(tracks) == 0 or len(regions) == 0:
+            return unmatched_regions, matched_tracks
+
+        distance, size_change, mass_ok, distance_ok, size_ok = get_region_costs(
+            tracks, regions
+        )
+        if self.config.verbose:
+            self._print_rejected_matches(
+                tracks, regions, distance, size_change, mass_ok, distance_ok
+            )
+        valid = mass_ok & distance_ok & size_ok
+        if self.config.region_matching == ClipTrackExtractor.HUNGARIAN:
+            matches = hungarian_matches(distance, valid)
+        else:
+            matches = greedy_matches(tracks, distance, valid)
+
+        for track_i, region_i in matches:
+            track = tracks[track_i]
+            region = regions[region_i]
+            track.add_region(region)
+            matched_tracks.add(track)
+            unmatched_regions.remove(region)
+        return unmatched_regions, matched_tracks
+
+    def _print_rejected_matches(
+        self, tracks, regions, distance, size_change, mass_ok, distance_ok
+    ):
+        for track_i, track in enumerate(tracks):
+            max_distance = get_max_distance_change(track)
+            for region_i, region in enumerate(regions):
+                if not mass_ok[track_i, region_i]:
                     self.print_if_verbose(
                         "track {} region mass {} deviates too much from {}".format(
                             track.get_id(),
@@ -226,49 +368,33 @@ class ClipTrackExtractor:
                             track.average_mass(),
                         )
                     )
-
-                    continue
-                if distance > max_distance:
+                elif not distance_ok[track_i, region_i]:
                     self.print_if_verbose(
                         "track {} distance score {} bigger than max distance {}".format(
-                            track.get_id(), distance, max_distance
+                            track.get_id(), distance[track_i, region_i], max_distance
                         )
                     )
-
-                    continue
-                if size_change > max_size_change:
+                elif size_change[track_i, region_i] > get_max_size_change(
+                    track, region
+                ):
                     self.print_if_verbose(
                         "track {} size_change {} bigger than max size_change {}".format(
-                            track.get_id(), size_change, max_size_change
+                            track.get_id(),
+                            size_change[track_i, region_i],
+                            get_max_size_change(track, region),
                         )
                     )
-                    continue
-                scores.append((distance, track, region))
-
-        # makes tracking consistent by ordering by score then by frame since target then track id
-        scores.sort(
-            key=lambda record: record[1].frames_since_target_seen
-            + float(".{}".format(record[1]._id))
-        )
-        scores.sort(key=lambda record: record[0])
-
-        matched_tracks = set()
-        for (score, track, region) in scores:
-            if track in matched_tracks or region in used_regions:
-                continue
-            track.add_region(region)
-            matched_tracks.add(track)
-            used_regions.add(region)
-            unmatched_regions.remove(region)
-        return unmatched_regions, matched_tracks
 
     def _create_new_tracks(self, clip, unmatched_regions):
         """Create new tracks for any unmatched regions"""
         new_tracks = set()
+        grid = RegionGrid(clip.res_x, clip.res_y)
+        for track in clip.active_tracks:
+            grid.add(track, track.last_bound)
         for region in unmatched_regions:
             # make sure we don't overlap with existing tracks.  This can happen if a tail gets tracked as a new object
             overlaps = [
-                track.last_bound.overlap_area(region) for track in clip.active_tracks
+                track.last_bound.overlap_area(region) for track in grid.query(region)
             ]
             if len(overlaps) > 0 and max(overlaps) > (region.area * 0.25):
                 continue
@@ -276,6 +402,7 @@ class ClipTrackExtractor:
             track = Track.from_region(clip, region)
             new_tracks.add(track)
             clip._add_active_track(track)
+            grid.add(track, track.last_bound)
             self.print_if_verbose(
                 "Creating a new track {} with region {} mass{} area {} frame {}".format(
                     track.get_id(),
@@ -306,6 +433,8 @@ class ClipTrackExtractor:
                         clip.frame_on, track.get_id()
                     )
                 )
+            else:
+                clip._close_track(track)
 
     def _get_regions_of_interest(
         self, clip, component_details, filtered, prev_filtered
@@ -383,7 +512,7 @@ class ClipTrackExtractor:
             track.trim()
             track.set_end_s(clip.frames_per_second)
 
-        track_stats = [(track.get_stats(), track) for track in clip.tracks]
+        track_stats = list(zip(Track.get_batch_stats(clip.tracks), clip.tracks))
         track_stats.sort(reverse=True, key=lambda record: record[0].score)
 
         if self.config.verbose:
@@ -402,10 +531,11 @@ class ClipTrackExtractor:
             "{} {}".format("Number of tracks before filtering", len(clip.tracks))
         )
 
+        overlap_index = TrackOverlapIndex(clip.tracks)
         for stats, track in track_stats:
             # discard any tracks that overlap too often with other tracks.  This normally means we are tracking the
             # tail of an animal.
-            if not self.filter_track(clip, track, stats):
+            if not self.filter_track(clip, track, stats, overlap_index):
                 good_tracks.append(track)
 
         clip.tracks = good_tracks
@@ -425,7 +555,7 @@ class ClipTrackExtractor:
             )
             clip.tracks = clip.tracks[: self.max_tracks]
 
-    def filter_track(self, clip, track, stats):
+    def filter_track(self, clip, track, stats, overlap_index=None):
         # discard any tracks that are less min_duration
         # these are probably glitches anyway, or don't contain enough information.
         if len(track) < self.config.min_duration_secs * clip.frames_per_second:
@@ -473,10 +603,10 @@ class ClipTrackExtractor:
 
             return True
 
+        if overlap_index is None:
+            overlap_index = TrackOverlapIndex(clip.tracks)
         highest_ratio = 0
-        for other in clip.tracks:
-            if track == other:
-                continue
+        for other in overlap_index.candidates(track):
             highest_ratio = max(track.get_overlap_ratio(other), highest_ratio)
 
         if highest_ratio > self.config.track_overlap_ratio:
@@ -494,6 +624,20 @@ class ClipTrackExtractor:
             logging.info(info_string)
 
 
+@attr.s(slots=True)
+class PipelineFrame:
+    """A frame as it passes through the stages of the threaded pipeline"""
+
+    frame_number = attr.ib()
+    thermal = attr.ib()
+    ffc_affected = attr.ib()
+    filtered = attr.ib(default=None)
+    threshold = attr.ib(default=None)
+    mask = attr.ib(default=None)
+    component_details = attr.ib(default=None)
+    frame = attr.ib(default=None)
+
+
 def get_max_size_change(track, region):
     exiting = region.is_along_border and not track.last_bound.is_along_border
     entering = not exiting and track.last_bound.is_along_border
@@ -538,6 +682,125 @@ def get_max_distance_change(track):
     return max_distance
 
 
+def get_region_costs(tracks, regions):
+    """
+    Scores every track against every region at once, equivalent to calling
+    get_region_score, get_max_distance_change, get_max_size_change and
+    get_max_mass_change_percent for each pair.
+    :return: distance and size_change matrices of shape [tracks, regions] and boolean
+    matrices of the same shape indicating if the mass, distance and size change are
+    within the allowed limits for each pair
+    """
+    region_bounds = np.array(
+        [
+            (region.x, region.y, region.right, region.bottom, region.area)
+            for region in regions
+        ],
+        dtype=np.float64,
+    )
+    region_mass = np.array([region.mass for region in regions], dtype=np.float64)
+    region_border = np.array([region.is_along_border for region in regions])
+    region_mid = np.trunc(
+        np.array([(region.mid_x, region.mid_y) for region in regions], dtype=np.float64)
+    )
+
+    last_bounds = [track.last_bound for track in tracks]
+    track_bounds = np.array(
+        [
+            (bound.x, bound.y, bound.right, bound.bottom, bound.area)
+            for bound in last_bounds
+        ],
+        dtype=np.float64,
+    )
+    track_mid = np.array(
+        [(bound.mid_x, bound.mid_y) for bound in last_bounds], dtype=np.float64
+    )
+    track_border = np.array([bound.is_along_border for bound in last_bounds])
+    track_young = np.array([len(track) < 5 for track in tracks])
+    max_distance = np.array([get_max_distance_change(track) for track in tracks])
+    average_mass = np.array([track.average_mass() for track in tracks])
+    max_mass_change = np.array(
+        [get_max_mass_change_percent(track) for track in tracks], dtype=np.float64
+    )
+    # tracks which are too new have no mass restriction
+    max_mass_change[np.isnan(max_mass_change)] = np.inf
+
+    def squared_diff(track_values, region_values):
+        return (region_values[np.newaxis, :] - track_values[:, np.newaxis]) ** 2
+
+    # same order of operations as Region.average_distance so results are identical
+    distance = squared_diff(track_mid[:, 0], region_mid[:, 0]) + squared_diff(
+        track_mid[:, 1], region_mid[:, 1]
+    )
+    distance += squared_diff(track_bounds[:, 0], region_bounds[:, 0]) + squared_diff(
+        track_bounds[:, 1], region_bounds[:, 1]
+    )
+    distance += squared_diff(track_bounds[:, 2], region_bounds[:, 2]) + squared_diff(
+        track_bounds[:, 3], region_bounds[:, 3]
+    )
+    distance /= 3.0
+
+    size_change = np.abs(
+        region_bounds[np.newaxis, :, 4] - track_bounds[:, np.newaxis, 4]
+    ) / (track_bounds[:, np.newaxis, 4] + 50)
+
+    max_size_change = np.where(
+        track_young[:, np.newaxis]
+        | track_border[:, np.newaxis]
+        | region_border[np.newaxis, :],
+        2,
+        1.5,
+    )
+    mass_ok = ~(
+        np.abs(average_mass[:, np.newaxis] - region_mass[np.newaxis, :])
+        > max_mass_change[:, np.newaxis]
+    )
+    distance_ok = ~(distance > max_distance[:, np.newaxis])
+    size_ok = ~(size_change > max_size_change)
+    return distance, size_change, mass_ok, distance_ok, size_ok
+
+
+def greedy_matches(tracks, distance, valid):
+    """
+    Greedily matches the closest valid track and region pairs, ties are broken by
+    frames since the target was seen and then track id so tracking is consistent.
+    :return: list of (track index, region index) pairs
+    """
+    track_i, region_i = np.nonzero(valid)
+    tie_break = np.array(
+        [
+            track.frames_since_target_seen + float(".{}".format(track._id))
+            for track in tracks
+        ]
+    )
+    order = np.argsort(tie_break[track_i], kind="stable")
+    order = order[np.argsort(distance[track_i, region_i][order], kind="stable")]
+
+    matches = []
+    used_tracks = set()
+    used_regions = set()
+    for t_i, r_i in zip(track_i[order], region_i[order]):
+        if t_i in used_tracks or r_i in used_regions:
+            continue
+        used_tracks.add(t_i)
+        used_regions.add(r_i)
+        matches.append((t_i, r_i))
+    return matches
+
+
+def hungarian_matches(distance, valid):
+    """
+    Matches tracks and regions so the total distance of all valid pairs is minimized.
+    :return: list of (track index, region index) pairs
+    """
+    # invalid pairs cost more than any combination of valid pairs, so the most valid
+    # pairs are always matched first
+    invalid_cost = np.sum(distance[valid]) + 1
+    cost = np.where(valid, distance, invalid_cost)
+    track_i, region_i = linear_sum_assignment(cost)
+    return [(t_i, r_i) for t_i, r_i in zip(track_i, region_i) if valid[t_i, r_i]]
+
+
 def get_region_score(last_bound: Region, region: Region):
     """
     Calculates a score between 2 regions based of distance and area.
@@ -0,0 +1,69 @@
+"""
+classifier-pipeline - this is a server side component that manipulates cptv
+files and to create a classification model of animals present
+Copyright (C) 2018, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from cptv import CPTVReader
+
+
+class CPTVFrameStore:
+    """
+    Keeps decoded cptv frames in memory so a clip can be iterated more than once
+    (e.g. for background calculation and then tracking) while only being decoded once.
+    At most max_frames are kept, any frames past this are decoded again from the
+    source file when they are next needed.
+    """
+
+    def __init__(self, source_file, reader, max_frames=None):
+        self.source_file = source_file
+        self.reader = reader
+        self.max_frames = max_frames
+        self.frames = []
+        self.frames_read = 0
+        self.background_frames = reader.background_frames
+        self._reader_iter = iter(reader)
+
+    @property
+    def truncated(self):
+        """True if some decoded frames could not be kept in the store"""
+        return self.frames_read > len(self.frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        stored = len(self.frames)
+        for frame in self.frames[:stored]:
+            yield frame
+
+        if self.truncated:
+            yield from self._reread(stored)
+            return
+
+        for frame in self._reader_iter:
+            self.frames_read += 1
+            if self.max_frames is None or len(self.frames) < self.max_frames:
+                self.frames.append(frame)
+            yield frame
+
+    def _reread(self, skip):
+        with open(self.source_file, "rb") as f:
+            reader = CPTVReader(f)
+            for i, frame in enumerate(reader):
+                if i < skip:
+                    continue
+                yield frame
@@ -0,0 +1,117 @@
+"""
+classifier-pipeline - this is a server side component that manipulates cptv
+files and to create a classification model of animals present
+Copyright (C) 2018, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import queue
+import threading
+
+
+class FramePipeline:
+    """
+    Runs the source and each stage in its own thread, connected by bounded queues.
+    Each stage is a function which takes an item and returns the processed item, as
+    every stage has a single thread items are returned in the order the source
+    produced them. Any exception raised in a thread is re-raised by the iterator.
+    """
+
+    # wait this long before checking if the pipeline has been stopped
+    POLL_SECONDS = 0.1
+
+    def __init__(self, source, stages, queue_size=9):
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self._stop = threading.Event()
+
+    def __iter__(self):
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [
+            threading.Thread(target=self._run_source, args=(queues[0],), daemon=True)
+        ]
+        for i, stage in enumerate(self.stages):
+            threads.append(
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(stage, queues[i], queues[i + 1]),
+                    daemon=True,
+                )
+            )
+        self._stop.clear()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Error):
+                    raise item.exception
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _put(self, out_queue, item):
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=FramePipeline.POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, in_queue):
+        while not self._stop.is_set():
+            try:
+                return in_queue.get(timeout=FramePipeline.POLL_SECONDS)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _run_source(self, out_queue):
+        try:
+            for item in self.source:
+                if not self._put(out_queue, item):
+                    return
+        except Exception as e:
+            self._put(out_queue, _Error(e))
+            return
+        self._put(out_queue, _DONE)
+
+    def _run_stage(self, stage, in_queue, out_queue):
+        while True:
+            item = self._get(in_queue)
+            if item is _DONE or isinstance(item, _Error):
+                self._put(out_queue, item)
+                return
+            try:
+                item = stage(item)
+            except Exception as e:
+                self._put(out_queue, _Error(e))
+                return
+            if not self._put(out_queue, item):
+                return
+
+
+class _Error:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_DONE = object()
@@ -0,0 +1,179 @@
+"""
+classifier-pipeline - this is a server side component that manipulates cptv
+files and to create a classification model of animals present
+Copyright (C) 2018, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import glob
+import hashlib
+import os
+import sqlite3
+
+
+def get_metadata_filename(filename):
+    """The metadata file which is loaded with a cptv file"""
+    return os.path.splitext(filename)[0] + ".txt"
+
+
+class LoadManifest:
+    """
+    Records the cptv files which have been loaded so that incremental loads only
+    process files which are new or have changed. A file has changed if the contents
+    of it or its metadata file differ from when it was loaded, or it was loaded by a
+    different version of the tracker. File sizes and modification times are compared
+    first so that unchanged files don't need to be read.
+    """
+
+    NEW = "new"
+    CHANGED = "changed"
+    CURRENT = "current"
+    READ_SIZE = 1024 * 1024
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime INTEGER,
+            meta_size INTEGER,
+            meta_mtime INTEGER,
+            hash TEXT,
+            tracker_version INTEGER,
+            clip_id TEXT
+        );
+    """
+
+    def __init__(self, filename, tracker_version):
+        self.filename = filename
+        self.tracker_version = tracker_version
+        self.conn = None
+        self.pid = None
+
+    def _connect(self):
+        # connections can't be shared with forked processes
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.filename, timeout=60 * 3)
+            self.conn.executescript(LoadManifest.SCHEMA)
+            self.pid = os.getpid()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+    def _get_stats(self, path):
+        """Size and modification time of path and its metadata file"""
+        stats = []
+        for filename in (path, get_metadata_filename(path)):
+            try:
+                stat = os.stat(filename)
+                stats.extend((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stats.extend((None, None))
+        return tuple(stats)
+
+    def _get_hash(self, path):
+        key = hashlib.sha1()
+        for filename in (path, get_metadata_filename(path)):
+            if not os.path.exists(filename):
+                key.update(b"missing")
+                continue
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(LoadManifest.READ_SIZE), b""):
+                    key.update(chunk)
+        return key.hexdigest()
+
+    def get_status(self, path):
+        """Returns if path is NEW, CHANGED or CURRENT"""
+        path = os.path.abspath(path)
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT size, mtime, meta_size, meta_mtime, hash, tracker_version "
+                "FROM files WHERE path = ?",
+                (path,),
+            ).fetchone()
+            if row is None:
+                return LoadManifest.NEW
+            if row[5] != self.tracker_version:
+                return LoadManifest.CHANGED
+            stats = self._get_stats(path)
+            if stats == tuple(row[:4]):
+                return LoadManifest.CURRENT
+            if self._get_hash(path) != row[4]:
+                return LoadManifest.CHANGED
+            # touched or copied without changing, so save the new times
+            conn.execute(
+                "UPDATE files SET size = ?, mtime = ?, meta_size = ?, meta_mtime = ? "
+                "WHERE path = ?",
+                stats + (path,),
+            )
+        return LoadManifest.CURRENT
+
+    def record(self, path, clip_id):
+        """Saves that path has been loaded as clip_id"""
+        path = os.path.abspath(path)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path,)
+                + self._get_stats(path)
+                + (self._get_hash(path), self.tracker_version, clip_id),
+            )
+
+    def get_removed(self, root):
+        """Returns (path, clip_id) of recorded files under root which no longer exist"""
+        root = os.path.join(os.path.abspath(root), "")
+        with self._connect() as conn:
+            rows = conn.execute("SELECT path, clip_id FROM files").fetchall()
+        return [
+            (path, clip_id)
+            for path, clip_id in rows
+            if path.startswith(root) and not os.path.exists(path)
+        ]
+
+    def remove(self, path):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(path),))
+
+    def get_shard_filename(self, shard):
+        """
+        Returns the filename of a shard of this manifest, which records the files a
+        process has loaded into a shard of the database until the shard is merged
+        """
+        base, ext = os.path.splitext(self.filename)
+        return "{}.shard-{}{}".format(base, shard, ext)
+
+    def merge_shards(self):
+        """
+        Copies the records of every shard into this manifest, then deletes the shards.
+        Only call once the shards of the database have been merged.
+        :returns: number of files merged
+        """
+        base, ext = os.path.splitext(self.filename)
+        shards = sorted(glob.glob("{}.shard-*{}".format(glob.escape(base), ext)))
+        merged = 0
+        conn = self._connect()
+        for shard in shards:
+            conn.execute("ATTACH DATABASE ? AS shard", (shard,))
+            try:
+                with conn:
+                    merged += conn.execute(
+                        "INSERT OR REPLACE INTO files SELECT * FROM shard.files"
+                    ).rowcount
+            finally:
+                conn.execute("DETACH DATABASE shard")
+            os.remove(shard)
+        return merged
@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+
+from config.config import Config
+from load.backgroundcache import BackgroundCache
+from load.clip import Clip
+from load.cliptrackextractor import ClipTrackExtractor
+
+CLIP = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "tests",
+    "clips",
+    "background.cptv",
+)
+
+
+def parse_clip(config):
+    track_extractor = ClipTrackExtractor(config.tracking, False, False)
+    clip = Clip(config.tracking, CLIP)
+    track_extractor.parse_clip(clip)
+    return clip
+
+
+class TestBackgroundCache:
+    def test_cached_background(self, tmp_path):
+        config = Config.get_defaults()
+        config.tracking.background_cache_dir = str(tmp_path)
+        calculated = parse_clip(config)
+        assert len(os.listdir(tmp_path)) == 1
+
+        cache = BackgroundCache(str(tmp_path), 1024 * 1024)
+        clip = Clip(config.tracking, CLIP)
+        clip.set_res(calculated.res_x, calculated.res_y)
+        clip.set_model(calculated.camera_model)
+        assert cache.load(clip, cache.get_key(clip))
+        assert np.array_equal(clip.background, calculated.background)
+        assert (
+            clip.stats.mean_background_value == calculated.stats.mean_background_value
+        )
+        assert clip.temp_thresh == calculated.temp_thresh
+
+        cached = parse_clip(config)
+        assert len(cached.tracks) == len(calculated.tracks) > 0
+        for track, expected in zip(cached.tracks, calculated.tracks):
+            assert np.array_equal(
+                track.bounds_history.ltrb(), expected.bounds_history.ltrb()
+            )
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = BackgroundCache(str(tmp_path), 0)
+        for name in ("a", "b", "c"):
+            with open(
+                os.path.join(tmp_path, name + BackgroundCache.EXTENSION), "wb"
+            ) as f:
+                f.write(b"0" * 100)
+        os.utime(os.path.join(tmp_path, "a.npz"), (0, 0))
+        os.utime(os.path.join(tmp_path, "b.npz"), (2, 2))
+        os.utime(os.path.join(tmp_path, "c.npz"), (1, 1))
+        cache.max_bytes = 150
+        cache.evict()
+        assert os.listdir(tmp_path) == ["b.npz"]
@@ -0,0 +1,28 @@
+import pytest
+
+from load.framepipeline import FramePipeline
+
+
+class TestFramePipeline:
+    def test_order(self):
+        pipeline = FramePipeline(
+            range(100), [lambda x: x * 2, lambda x: x + 1], queue_size=2
+        )
+        assert list(pipeline) == [x * 2 + 1 for x in range(100)]
+
+    def test_stage_exception(self):
+        def fail(x):
+            if x == 50:
+                raise ValueError("bad frame")
+            return x
+
+        pipeline = FramePipeline(range(100), [fail], queue_size=2)
+        with pytest.raises(ValueError):
+            list(pipeline)
+
+    def test_stop_early(self):
+        pipeline = FramePipeline(range(100), [lambda x: x], queue_size=2)
+        for x in pipeline:
+            if x == 10:
+                break
+        assert x == 10
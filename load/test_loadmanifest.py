@@ -0,0 +1,70 @@
+import os
+
+from load.loadmanifest import LoadManifest
+
+
+def write_clip(folder, name, data=b"cptv", metadata=b"{}"):
+    path = folder / (name + ".cptv")
+    path.write_bytes(data)
+    (folder / (name + ".txt")).write_bytes(metadata)
+    return str(path)
+
+
+class TestLoadManifest:
+    def test_status(self, tmp_path):
+        source = tmp_path / "source"
+        source.mkdir()
+        manifest = LoadManifest(str(tmp_path / "manifest.sqlite"), 1)
+        path = write_clip(source, "clip")
+        assert manifest.get_status(path) == LoadManifest.NEW
+        manifest.record(path, "10")
+        assert manifest.get_status(path) == LoadManifest.CURRENT
+
+        # touched without changing the contents
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert manifest.get_status(path) == LoadManifest.CURRENT
+
+        write_clip(source, "clip", metadata=b'{"tags": []}')
+        assert manifest.get_status(path) == LoadManifest.CHANGED
+        manifest.record(path, "10")
+        assert manifest.get_status(path) == LoadManifest.CURRENT
+
+        newer_tracker = LoadManifest(manifest.filename, 2)
+        assert newer_tracker.get_status(path) == LoadManifest.CHANGED
+
+    def test_removed(self, tmp_path):
+        manifest = LoadManifest(str(tmp_path / "manifest.sqlite"), 1)
+        folders = []
+        for name in ("source", "other"):
+            folder = tmp_path / name
+            folder.mkdir()
+            folders.append(folder)
+        kept = write_clip(folders[0], "kept")
+        removed = write_clip(folders[0], "removed")
+        other = write_clip(folders[1], "other")
+        for clip_id, path in enumerate((kept, removed, other)):
+            manifest.record(path, str(clip_id))
+        os.remove(removed)
+        os.remove(other)
+
+        assert manifest.get_removed(str(folders[0])) == [(removed, "1")]
+        manifest.remove(removed)
+        assert manifest.get_removed(str(folders[0])) == []
+        assert manifest.get_status(removed) == LoadManifest.NEW
+
+    def test_merge_shards(self, tmp_path):
+        source = tmp_path / "source"
+        source.mkdir()
+        manifest = LoadManifest(str(tmp_path / "manifest.sqlite"), 1)
+        paths = [write_clip(source, "clip{}".format(i)) for i in range(3)]
+        manifest.record(paths[0], "0")
+        for shard, path in enumerate(paths[1:]):
+            LoadManifest(manifest.get_shard_filename(shard), 1).record(path, "1")
+        # shards aren't current until they are merged
+        assert manifest.get_status(paths[1]) == LoadManifest.NEW
+
+        assert manifest.merge_shards() == 2
+        assert all(manifest.get_status(path) == LoadManifest.CURRENT for path in paths)
+        assert sorted(os.listdir(tmp_path)) == ["manifest.sqlite", "source"]
+        assert manifest.merge_shards() == 0
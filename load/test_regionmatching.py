@@ -0,0 +1,96 @@
+import numpy as np
+
+from load.cliptrackextractor import (
+    get_region_costs,
+    get_region_score,
+    get_max_distance_change,
+    get_max_size_change,
+    get_max_mass_change_percent,
+    greedy_matches,
+    hungarian_matches,
+)
+from track.region import Region
+from track.track import Track
+
+
+def random_region(rng, frame_number):
+    region = Region(
+        int(rng.integers(0, 8)) * 4,
+        int(rng.integers(0, 8)) * 4,
+        int(rng.integers(1, 4)) * 4,
+        int(rng.integers(1, 4)) * 4,
+        mass=int(rng.integers(0, 40)),
+        frame_number=frame_number,
+    )
+    region.is_along_border = bool(rng.integers(0, 2))
+    return region
+
+
+def random_tracks(rng, num_tracks, frames):
+    tracks = []
+    for _ in range(num_tracks):
+        track = Track(1)
+        track.start_frame = 0
+        for frame_number in range(int(rng.integers(1, frames))):
+            track.add_region(random_region(rng, frame_number))
+        tracks.append(track)
+    return tracks
+
+
+def loop_matches(tracks, regions):
+    """Matches tracks to regions one pair at a time"""
+    scores = []
+    for track in tracks:
+        for region in regions:
+            distance, size_change = get_region_score(track.last_bound, region)
+            max_distance = get_max_distance_change(track)
+            max_size_change = get_max_size_change(track, region)
+            max_mass_change = get_max_mass_change_percent(track)
+            if (
+                max_mass_change
+                and abs(track.average_mass() - region.mass) > max_mass_change
+            ):
+                continue
+            if distance > max_distance:
+                continue
+            if size_change > max_size_change:
+                continue
+            scores.append((distance, track, region))
+    scores.sort(
+        key=lambda record: record[1].frames_since_target_seen
+        + float(".{}".format(record[1]._id))
+    )
+    scores.sort(key=lambda record: record[0])
+
+    matches = []
+    used = set()
+    for _, track, region in scores:
+        if track in used or region in used:
+            continue
+        used.add(track)
+        used.add(region)
+        matches.append((tracks.index(track), regions.index(region)))
+    return matches
+
+
+class TestRegionMatching:
+    def test_greedy_matches_loop(self):
+        rng = np.random.default_rng(7)
+        for _ in range(50):
+            tracks = random_tracks(rng, int(rng.integers(1, 12)), 30)
+            regions = [random_region(rng, 30) for _ in range(int(rng.integers(1, 20)))]
+            distance, _, mass_ok, distance_ok, size_ok = get_region_costs(
+                tracks, regions
+            )
+            matches = greedy_matches(tracks, distance, mass_ok & distance_ok & size_ok)
+            assert matches == loop_matches(tracks, regions)
+
+    def test_hungarian_minimizes_distance(self):
+        distance = np.array([[1.0, 2.0], [1.5, 10.0]])
+        valid = np.ones(distance.shape, dtype=bool)
+        assert hungarian_matches(distance, valid) == [(0, 1), (1, 0)]
+
+        valid[1, 0] = False
+        assert hungarian_matches(distance, valid) == [(0, 0), (1, 1)]
+        valid[1, 1] = False
+        assert hungarian_matches(distance, valid) == [(0, 0)]
@@ -0,0 +1,108 @@
+"""
+Converts a track database written with a dataset per frame to the current layout,
+where each track's frames are stored in a few concatenated datasets.
+"""
+
+import argparse
+import logging
+import os
+
+import h5py
+
+from ml_tools.logs import init_logging
+from ml_tools.trackdatabase import (
+    TRACK_LAYOUT_VERSION,
+    read_frame_datasets,
+    write_track_frames,
+)
+from ml_tools.trackindex import TrackIndex
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="Track database to convert")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Where to write the converted database, defaults to replacing source",
+    )
+    return parser.parse_args()
+
+
+def frame_datasets(node):
+    """Returns the datasets in node which hold a frame, ordered by frame number"""
+    names = [name for name in node if name.isdigit()]
+    return sorted(names, key=int)
+
+
+def get_compression(frames_node, names):
+    if len(names) == 0:
+        return {}
+    dataset = frames_node[names[0]]
+    if dataset.compression is None:
+        return {}
+    return {
+        "compression": dataset.compression,
+        "compression_opts": dataset.compression_opts,
+    }
+
+
+def migrate_track(track, new_clip, name):
+    """Copies track into new_clip converting its frames to the current layout"""
+    new_track = new_clip.create_group(name)
+    new_track.attrs.update(track.attrs)
+    cropped_node = track["cropped"] if "cropped" in track else track
+    names = frame_datasets(cropped_node)
+    frame_numbers = [int(frame_name) for frame_name in names]
+    cropped = read_frame_datasets(track, frame_numbers)
+    original = None
+    if "original" in track and len(track["original"]) > 0:
+        original = read_frame_datasets(
+            track, frame_datasets(track["original"]), original=True
+        )
+    write_track_frames(
+        new_track, cropped, original, get_compression(cropped_node, names)
+    )
+    for child in track:
+        if child not in ("cropped", "original") and not child.isdigit():
+            track.copy(child, new_track)
+
+
+def migrate(source, destination):
+    with h5py.File(source, "r") as f, h5py.File(destination, "w") as new_f:
+        new_f.attrs.update(f.attrs)
+        new_clips = new_f.create_group("clips")
+        clips = f["clips"]
+        for clip_id in clips:
+            clip = clips[clip_id]
+            new_clip = new_clips.create_group(clip_id)
+            new_clip.attrs.update(clip.attrs)
+            for name in clip:
+                node = clip[name]
+                if (
+                    isinstance(node, h5py.Group)
+                    and node.attrs.get("layout_version", 1) < TRACK_LAYOUT_VERSION
+                ):
+                    migrate_track(node, new_clip, name)
+                else:
+                    clip.copy(name, new_clip)
+            logging.info("Converted clip %s", clip_id)
+    # the index is rebuilt from the converted database when it is next opened
+    TrackIndex(destination).delete()
+
+
+def main():
+    init_logging()
+    args = parse_args()
+    destination = args.output
+    if destination is None:
+        destination = args.source + ".migrating"
+    migrate(args.source, destination)
+    if args.output is None:
+        os.replace(destination, args.source)
+        TrackIndex(args.source).delete()
+    logging.info("Converted %s", args.source)
+
+
+if __name__ == "__main__":
+    main()
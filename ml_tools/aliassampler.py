@@ -0,0 +1,119 @@
+import numpy as np
+
+
+class AliasTable:
+    """
+    Walker's alias method, after building in O(n log n) any number of indices are
+    drawn by weight with one uniform index and one comparison each. Uses numpy's
+    global random state.
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        total = weights.sum()
+        if len(weights) == 0 or not total > 0:
+            raise ValueError("Alias table needs a positive total weight")
+        self.total = total
+        self.probability, self.alias = _build(weights * (len(weights) / total))
+
+    def sample(self, n):
+        """Returns n indices drawn by weight"""
+        index = np.random.randint(len(self.probability), size=n)
+        keep = np.random.random_sample(n) < self.probability[index]
+        return np.where(keep, index, self.alias[index])
+
+
+class AliasSampler:
+    """
+    Draws items by weight using an alias table for the items of each group and a
+    table choosing the group, so a group is removed by only rebuilding the group
+    table. Groups whose items have no weight are never drawn. Items may be any
+    sequence, only the items drawn are indexed.
+    """
+
+    def __init__(self, items, weights, groups):
+        self.items = items
+        self.indices = {}
+        self.tables = {}
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) > 0:
+            names, group_of = np.unique(np.asarray(groups), return_inverse=True)
+            order = np.argsort(group_of, kind="stable")
+            bounds = np.searchsorted(group_of[order], np.arange(len(names) + 1))
+            for i, group in enumerate(names.tolist()):
+                indices = order[bounds[i] : bounds[i + 1]]
+                group_weights = weights[indices]
+                if not group_weights.sum() > 0:
+                    continue
+                self.indices[group] = indices
+                self.tables[group] = AliasTable(group_weights)
+        self._rebuild_groups()
+
+    def _rebuild_groups(self):
+        self.groups = list(self.tables.keys())
+        self.group_table = None
+        if self.groups:
+            self.group_table = AliasTable(
+                [self.tables[group].total for group in self.groups]
+            )
+
+    def remove_group(self, group):
+        """Stops drawing the items of group"""
+        if self.tables.pop(group, None) is not None:
+            del self.indices[group]
+            self._rebuild_groups()
+
+    def sample_indices(self, n):
+        """Returns an array of n indices into items drawn by weight"""
+        if self.group_table is None:
+            return np.empty(0, dtype=np.int64)
+        drawn = self.group_table.sample(n)
+        result = np.empty(n, dtype=np.int64)
+        for group_index in np.unique(drawn):
+            group = self.groups[group_index]
+            positions = np.flatnonzero(drawn == group_index)
+            result[positions] = self.indices[group][
+                self.tables[group].sample(len(positions))
+            ]
+        return result
+
+    def sample(self, n):
+        """Returns a list of n items drawn by weight, empty if there are no items"""
+        return [self.items[i] for i in self.sample_indices(n)]
+
+
+def _build(probability):
+    """
+    Builds the alias table of probabilities scaled to average 1. Items under 1 take
+    the rest of their column from the items over 1 in turn, like Vose's method, the
+    item giving when an item's deficit starts is found from cumulative sums so the
+    pairing is vectorised. When an item over 1 has given all of its surplus it is
+    under 1 and takes the rest of its column from the next item over 1.
+    """
+    probability = probability.copy()
+    alias = np.arange(len(probability))
+    small = np.flatnonzero(probability < 1)
+    large = np.flatnonzero(probability >= 1)
+    if len(small) == 0 or len(large) == 0:
+        probability[:] = 1
+        return probability, alias
+
+    deficit_end = np.cumsum(1 - probability[small])
+    deficit_start = deficit_end - (1 - probability[small])
+    surplus_end = np.cumsum(probability[large] - 1)
+
+    giver = np.searchsorted(surplus_end, deficit_start, side="left")
+    alias[small] = large[np.minimum(giver, len(large) - 1)]
+
+    # the deficit that exhausts each large item's surplus
+    exhausted_by = np.searchsorted(deficit_end, surplus_end, side="right")
+    exhausted = exhausted_by < len(small)
+    exhausted[-1] = False
+    exhausted_large = large[exhausted]
+    probability[exhausted_large] = 1 - (
+        deficit_end[exhausted_by[exhausted]] - surplus_end[exhausted]
+    )
+    alias[exhausted_large] = large[np.flatnonzero(exhausted) + 1]
+    probability[large[~exhausted]] = 1
+    np.clip(probability, 0, 1, out=probability)
+    return probability, alias
@@ -0,0 +1,52 @@
+import multiprocessing
+
+import numpy as np
+
+
+class BatchRing:
+    """
+    Preallocated batches in shared memory which loader processes fill, so batches
+    are passed to the trainer without being pickled. Only slot numbers are sent
+    between processes, a slot goes from the free queue to a loader, then through the
+    filled queue to the trainer which frees it when it asks for the next batch.
+    """
+
+    def __init__(self, slots, batch_size, x_shape, x_dtype, y_dtype):
+        if slots < 1:
+            raise ValueError("Batch ring needs at least one slot {}".format(slots))
+        self.slots = slots
+        self.batch_size = batch_size
+        x_shape = (slots, batch_size) + tuple(x_shape)
+        y_shape = (slots, batch_size)
+        self.x = _shared_array(x_shape, x_dtype)
+        self.y = _shared_array(y_shape, y_dtype)
+        self.free = multiprocessing.Queue()
+        self.filled = multiprocessing.Queue()
+        # slot whose batch the trainer is using
+        self.held = None
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def put(self, X, y):
+        """Copies a batch into a free slot, blocks until a slot is free"""
+        slot = self.free.get()
+        self.x[slot] = X
+        self.y[slot] = y
+        self.filled.put(slot)
+
+    def next_batch(self):
+        """
+        Returns views of the next filled batch, the views are valid until next_batch
+        is called again
+        """
+        if self.held is not None:
+            self.free.put(self.held)
+        self.held = self.filled.get()
+        return self.x[self.held], self.y[self.held]
+
+
+def _shared_array(shape, dtype):
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    buffer = multiprocessing.RawArray("b", max(1, size))
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
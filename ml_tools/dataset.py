@@ -7,21 +7,30 @@ Dataset used for training a tensorflow model from track data.
 Tracks are broken into segments.  Filtered, and then passed to the trainer using a weighted random sample.
 
 """
+
+import datetime
+import json
 import logging
 import math
 import multiprocessing
 import os
+import pickle
 import queue
 import random
+import shutil
 import threading
 import time
 
 import dateutil
 import numpy as np
 
+from ml_tools.aliassampler import AliasSampler
+from ml_tools.batchring import BatchRing
+from ml_tools.datasetmanifest import DatasetManifest, save_manifest
 from ml_tools.datasetstructures import TrackHeader, SegmentHeader, Camera
 from ml_tools.trackdatabase import TrackDatabase
-from ml_tools.preprocess import preprocess_segment
+from ml_tools.preprocess import preprocess_segment, preprocess_segment_array
+from ml_tools.segmentcache import SegmentCache
 from ml_tools.imageprocessing import clear_frame
 
 
@@ -53,6 +62,38 @@ class Dataset:
     # number of pixels to inset from frame edges by default
     DEFAULT_INSET = 2
 
+    # segments each async loader reads from the database at once
+    PRELOAD_SEGMENTS = 16
+
+    # attributes saved in a manifest along with the tracks and segments
+    MANIFEST_ATTRIBUTES = (
+        "labels",
+        "label_mapping",
+        "enable_augmentation",
+        "scale_frequency",
+        "encode_frame_offsets_in_flow",
+        "min_frame_mass",
+        "segment_length",
+        "segment_spacing",
+        "segment_min_mass",
+        "banned_clips",
+        "included_labels",
+        "clip_before_date",
+        "filtered_stats",
+    )
+    # mappings of datasets loaded from a manifest, made when first used
+    MANIFEST_MAPPINGS = (
+        "tracks_by_label",
+        "tracks_by_bin",
+        "tracks_by_id",
+        "segments_by_label",
+        "segments_by_id",
+        "frames_by_label",
+        "frame_samples",
+        "cameras_by_id",
+        "camera_names",
+    )
+
     def __init__(
         self,
         track_db: TrackDatabase,
@@ -79,7 +120,8 @@ class Dataset:
 
         # writes the frame motion into the center of the optical flow channels
         self.encode_frame_offsets_in_flow = False
-        self.segment_cdf = []
+        # draws segments by weight, grouped by label
+        self.segment_sampler = None
         self.segment_label_cdf = {}
         self.segments = []
         self.segments_by_label = {}
@@ -103,7 +145,13 @@ class Dataset:
         # how often to scale during augmentation
         self.scale_frequency = 0.50
 
+        # columns the tracks and segments were loaded from, if loaded from a manifest
+        self.manifest = None
         self.preloader_queue = None
+        self.batch_ring = None
+        # rows of the last shared memory batch which weren't returned
+        self.batch_leftover = None
+        self.segment_cache = None
         self.preloader_threads = None
         self.preloader_stop_flag = False
         # a copy of our entire dataset, if loaded.
@@ -138,6 +186,88 @@ class Dataset:
             "no_data": 0,
         }
 
+    def __setstate__(self, state):
+        # datasets pickled by build.py before the async batch ring and segment
+        # cache existed
+        state.setdefault("batch_ring", None)
+        state.setdefault("batch_leftover", None)
+        state.setdefault("segment_cache", None)
+        # the segment sampler replaced the segment cdf, it's rebuilt when first used
+        state.pop("segment_cdf", None)
+        state.setdefault("segment_sampler", None)
+        state.setdefault("manifest", None)
+        self.__dict__.update(state)
+
+    def __getattr__(self, name):
+        # only called for attributes which aren't set
+        if name in Dataset.MANIFEST_MAPPINGS and self.__dict__.get("manifest"):
+            self._add_manifest_mappings()
+            return self.__dict__[name]
+        raise AttributeError(
+            "'{}' object has no attribute '{}'".format(type(self).__name__, name)
+        )
+
+    def _add_manifest_mappings(self):
+        """Adds the tracks of a dataset loaded from a manifest to its mappings"""
+        labels = self.labels
+        label_mapping = self.label_mapping
+        # the labels were mapped before saving
+        self.labels = []
+        self.label_mapping = None
+        self.tracks_by_label = {}
+        self.tracks_by_bin = {}
+        self.tracks_by_id = {}
+        self.segments_by_label = {}
+        self.segments_by_id = {}
+        self.frames_by_label = {}
+        self.frame_samples = []
+        self.cameras_by_id = {}
+        self.camera_names = set()
+        for track in self.tracks:
+            self.add_track_to_mappings(track)
+        self.labels = labels
+        self.label_mapping = label_mapping
+
+    def save_manifest(self, directory):
+        """Saves the dataset as columns in directory which load_manifest maps"""
+        attributes = {
+            "name": self.name,
+            "use_segments": self.use_segments,
+            "consecutive_segments": self.consecutive_segments,
+        }
+        for name in Dataset.MANIFEST_ATTRIBUTES:
+            if hasattr(self, name):
+                attributes[name] = getattr(self, name)
+        if isinstance(attributes.get("clip_before_date"), datetime.datetime):
+            attributes["clip_before_date"] = attributes["clip_before_date"].isoformat()
+        save_manifest(self, directory, attributes)
+
+    @classmethod
+    def load_manifest(cls, track_db, directory):
+        """
+        Loads a dataset saved by save_manifest, the tracks and segments are created
+        when first used
+        """
+        manifest = DatasetManifest(directory)
+        attributes = dict(manifest.attributes)
+        dataset = cls(
+            track_db,
+            attributes.pop("name"),
+            use_segments=attributes.pop("use_segments"),
+            consecutive_segments=attributes.pop("consecutive_segments"),
+        )
+        if attributes.get("clip_before_date") is not None:
+            attributes["clip_before_date"] = datetime.datetime.fromisoformat(
+                attributes["clip_before_date"]
+            )
+        dataset.__dict__.update(attributes)
+        for name in Dataset.MANIFEST_MAPPINGS:
+            del dataset.__dict__[name]
+        dataset.manifest = manifest
+        dataset.tracks = manifest.tracks
+        dataset.segments = manifest.segments
+        return dataset
+
     @property
     def rows(self):
         return len(self.segments)
@@ -186,9 +316,37 @@ class Dataset:
         :param disable_async: forces fetching of segment in this thread / process rather than collecting from
             an aync reader queue (if one exists)
         :param force_no_augmentation: forces augmentation off, may disable asyc loading.
-        :return: X of shape [n, channels, height, width], y (labels) of shape [n]
+        :return: X of shape [n, channels, height, width], y (labels) of shape [n], when
+            batches are loaded into shared memory these are views which are only valid
+            until the next call
         """
 
+        if (
+            not disable_async
+            and self.batch_ring is not None
+            and not force_no_augmentation
+        ):
+            if n == self.batch_ring.batch_size and self.batch_leftover is None:
+                return self.batch_ring.next_batch()
+            # copy from as many batches as needed, keeping any rows left over from
+            # the last batch for the next call
+            batch_X = []
+            batch_y = []
+            loaded = 0
+            while loaded < n:
+                if self.batch_leftover is not None:
+                    X, y = self.batch_leftover
+                    self.batch_leftover = None
+                else:
+                    X, y = self.batch_ring.next_batch()
+                used = min(len(X), n - loaded)
+                batch_X.append(X[:used].copy())
+                batch_y.append(y[:used].copy())
+                loaded += used
+                if used < len(X):
+                    self.batch_leftover = (X[used:].copy(), y[used:].copy())
+            return np.concatenate(batch_X), np.concatenate(batch_y)
+
         # if async is enabled use it.
         if (
             not disable_async
@@ -205,16 +363,14 @@ class Dataset:
 
             return np.asarray(batch_X), np.asarray(batch_y)
 
-        segments = [self.sample_segment() for _ in range(n)]
+        segments = self.sample_segments(n)
 
-        batch_X = []
+        batch_X = self.fetch_segments(
+            segments, augment=self.enable_augmentation and not force_no_augmentation
+        )
         batch_y = []
 
-        for segment in segments:
-            data = self.fetch_segment(
-                segment, augment=self.enable_augmentation and not force_no_augmentation
-            )
-            batch_X.append(data)
+        for segment, data in zip(segments, batch_X):
             batch_y.append(self.labels.index(segment.label))
 
             if np.isnan(data).any():
@@ -393,7 +549,7 @@ class Dataset:
         Fetches all segments
         :return: X of shape [n,f,channels,height,width], y of shape [n]
         """
-        X = np.float32([self.fetch_segment(segment) for segment in self.segments])
+        X = np.float32(self.fetch_segments(self.segments))
         y = np.int32([self.labels.index(segment.label) for segment in self.segments])
         return X, y
 
@@ -420,6 +576,85 @@ class Dataset:
         :param augment: if true applies data augmentation
         :return: segment data of shape [frames, channels, height, width]
         """
+        return self.fetch_segments([segment], augment)[0]
+
+    def fetch_segments(self, segments, augment=False):
+        """
+        Fetches data for many segments, reading them from the database together.
+        :param segments: the segment headers to fetch
+        :param augment: if true applies data augmentation
+        :return: list of segment data of shape [frames, channels, height, width],
+            segments from the cache are read only
+        """
+        frame_ranges = [
+            self.get_segment_frames(segment, augment) for segment in segments
+        ]
+        result = [None] * len(segments)
+        keys = [None] * len(segments)
+        if not augment and self.segment_cache is not None:
+            for i, (segment, (first_frame, last_frame)) in enumerate(
+                zip(segments, frame_ranges)
+            ):
+                keys[i] = self.get_segment_key(segment, first_frame, last_frame)
+                result[i] = self.segment_cache.get(keys[i])
+        missing = [i for i, data in enumerate(result) if data is None]
+        if len(missing) == 0:
+            return result
+
+        segments_data = self.db.get_segments(
+            [
+                (
+                    segments[i].clip_id,
+                    segments[i].track_number,
+                    range(*frame_ranges[i]),
+                )
+                for i in missing
+            ]
+        )
+        for i, data in zip(missing, segments_data):
+            segment = segments[i]
+            first_frame, last_frame = frame_ranges[i]
+            segment_width = self.segment_length * segment.track.frames_per_second
+            if len(data) != segment_width:
+                logging.error(
+                    "invalid segment length %d, expected %d",
+                    len(data),
+                    len(segment_width),
+                )
+
+            result[i], _ = preprocess_segment_array(
+                data,
+                segment.track.frame_temp_median[first_frame:last_frame],
+                segment.track.frame_velocity[first_frame:last_frame],
+                augment=augment,
+                default_inset=self.DEFAULT_INSET,
+            )
+            if keys[i] is not None:
+                self.segment_cache.put(keys[i], result[i])
+        return result
+
+    def get_segment_key(self, segment: SegmentHeader, first_frame, last_frame):
+        """Identifies the preprocessed data of a segment which isn't augmented"""
+        return "{}-{}-{}-{}-{}".format(
+            segment.clip_id,
+            segment.track_number,
+            first_frame,
+            last_frame,
+            self.DEFAULT_INSET,
+        )
+
+    def enable_segment_cache(self, max_bytes, cache_dir=None):
+        """
+        Caches segments which aren't augmented so they are only read and preprocessed
+        once, see SegmentCache
+        """
+        self.segment_cache = SegmentCache(max_bytes, cache_dir)
+
+    def get_segment_frames(self, segment: SegmentHeader, augment=False):
+        """
+        Returns the first (inclusive) and last (exclusive) frame to read for segment,
+        if augment is set the frames are jittered
+        """
         segment_width = self.segment_length * segment.track.frames_per_second
         # if we are requesting a segment smaller than the default segment size take it from the middle.
         unused_frames = segment.frames - segment_width
@@ -444,35 +679,23 @@ class Dataset:
             jitter = 0
         first_frame += jitter
         last_frame += jitter
-
-        data = self.db.get_track(
-            segment.clip_id, segment.track_number, first_frame, last_frame
-        )
-
-        if len(data) != segment_width:
-            logging.error(
-                "invalid segment length %d, expected %d", len(data), len(segment_width)
-            )
-
-        data = preprocess_segment(
-            data,
-            segment.track.frame_temp_median[first_frame:last_frame],
-            segment.track.frame_velocity[first_frame:last_frame],
-            augment=augment,
-            default_inset=self.DEFAULT_INSET,
-        )
-
-        return data
+        return first_frame, last_frame
 
     def sample_segment(self):
         """Returns a random segment from weighted list."""
-        if not self.segments:
-            return None
-        choice = np.random.choice(self.samples(), 1, p=self.segment_cdf)
-        if len(choice) > 0:
-            return choice[0]
+        segments = self.sample_segments(1)
+        if len(segments) > 0:
+            return segments[0]
         return None
 
+    def sample_segments(self, n):
+        """Returns a list of n random segments from weighted list."""
+        if not self.segments:
+            return []
+        if self.segment_sampler is None:
+            self.rebuild_segment_sampler()
+        return self.segment_sampler.sample(n)
+
     def load_all(self, force=False):
         """Loads all X and y into dataset if required."""
         if self.X is None or force:
@@ -541,7 +764,9 @@ class Dataset:
             segment for segment in self.segments if segment.label != label_to_remove
         ]
         self._purge_track_segments()
-        self.rebuild_cdf()
+        # the frame cdf and label cdfs don't change, so only the sampler is updated
+        if self.segment_sampler is not None:
+            self.segment_sampler.remove_group(label_to_remove)
 
     def _purge_track_segments(self):
         """Removes any segments from track_headers where the segment has been deleted"""
@@ -657,19 +882,9 @@ class Dataset:
             self.frame_label_cdf = mapped_cdf
 
     def rebuild_segment_cdf(self, lbl_p=None):
-        """Calculates the CDF used for fast random sampling"""
-        self.segment_cdf = []
-        total = 0
+        """Calculates the CDF and alias tables used for fast random sampling"""
+        self.rebuild_segment_sampler(lbl_p=lbl_p)
         self.segment_label_cdf = {}
-        for segment in self.segments:
-            seg_weight = segment.weight
-            if lbl_p and segment.track.label in lbl_p:
-                seg_weight *= lbl_p[segment.track.label]
-            total += seg_weight
-            self.segment_cdf.append(seg_weight)
-
-        if len(self.segment_cdf) > 0:
-            self.segment_cdf = [x / total for x in self.segment_cdf]
 
         # guarantee that the cdf is in the same order that we will sample by
         for label, segments in self.segments_by_label.items():
@@ -707,6 +922,19 @@ class Dataset:
                 mapped_cdf[key] = [x / total for x in cdf]
             self.segment_label_cdf = mapped_cdf
 
+    def rebuild_segment_sampler(self, lbl_p=None):
+        """Builds the alias tables used for fast random sampling"""
+        if self.manifest is not None and self.segments is self.manifest.segments:
+            # read from the columns so the segments aren't all created
+            weights = self.manifest.get_segment_weights()
+            labels = self.manifest.get_segment_labels()
+        else:
+            weights = np.float64([segment.weight for segment in self.segments])
+            labels = [segment.label for segment in self.segments]
+        if lbl_p:
+            weights *= [lbl_p.get(label, 1) for label in labels]
+        self.segment_sampler = AliasSampler(self.segments, weights, labels)
+
     def get_label_weight(self, label):
         """Returns the total weight for all segments of given label."""
         tracks = self.tracks_by_label.get(label)
@@ -805,9 +1033,12 @@ class Dataset:
     def sample_count(self):
         return len(self.samples())
 
-    def start_async_load(self, buffer_size=128):
+    def start_async_load(self, buffer_size=128, batch_size=None):
         """
         Starts async load process.
+        :param buffer_size: number of segments to load ahead
+        :param batch_size: size of the batches next_batch will be called with, if set
+            and loading is process based whole batches are loaded into shared memory
         """
 
         # threading has limitations due to global lock
@@ -816,7 +1047,21 @@ class Dataset:
         # this could be solved either by using linux (with forking, which is copy on write) or with a shared ctype
         # array.
 
-        if self.PROCESS_BASED:
+        if self.PROCESS_BASED and batch_size is not None:
+            X, y = self.next_batch(batch_size, disable_async=True)
+            # a slot for each loader to fill while the trainer uses another
+            slots = max(self.WORKER_THREADS + 1, math.ceil(buffer_size / batch_size))
+            self.batch_ring = BatchRing(
+                slots, batch_size, X.shape[1:], X.dtype, y.dtype
+            )
+            self.batch_ring.put(X, y)
+            self.preloader_threads = [
+                multiprocessing.Process(
+                    target=batch_preloader, args=(self.batch_ring, self)
+                )
+                for _ in range(self.WORKER_THREADS)
+            ]
+        elif self.PROCESS_BASED:
             self.preloader_queue = multiprocessing.Queue(buffer_size)
             self.preloader_threads = [
                 multiprocessing.Process(
@@ -845,6 +1090,8 @@ class Dataset:
                     # note this will corrupt the queue, so reset it
                     thread.terminate()
                     self.preloader_queue = None
+                    self.batch_ring = None
+                    self.batch_leftover = None
                 else:
                     thread.exit()
 
@@ -862,8 +1109,10 @@ def preloader(q, dataset):
     timer = time.time()
     while not dataset.preloader_stop_flag:
         if not q.full():
-            q.put(dataset.next_batch(1, disable_async=True))
-            loads += 1
+            X, y = dataset.next_batch(Dataset.PRELOAD_SEGMENTS, disable_async=True)
+            for i in range(len(X)):
+                q.put((X[i : i + 1], y[i : i + 1]))
+            loads += len(X)
             if (time.time() - timer) > 1.0:
                 # logging.debug("{} segments per seconds {:.1f}".format(dataset.name, loads / (time.time() - timer)))
                 loads = 0
@@ -871,9 +1120,71 @@ def preloader(q, dataset):
             time.sleep(0.1)
 
 
+def batch_preloader(batch_ring, dataset):
+    """fills batches of the shared batch ring"""
+    logging.info(
+        " -started batch fetcher for %s with augment=%s batch_size=%s",
+        dataset.name,
+        dataset.enable_augmentation,
+        batch_ring.batch_size,
+    )
+    while not dataset.preloader_stop_flag:
+        batch_ring.put(*dataset.next_batch(batch_ring.batch_size, disable_async=True))
+
+
 def dataset_db_path(config):
     return os.path.join(config.tracks_folder, "datasets.dat")
 
+
+def dataset_manifest_path(config):
+    return os.path.join(config.tracks_folder, "datasets")
+
+
+def get_datasets_path(config):
+    """Returns where datasets are saved, or the pickled datasets of older builds"""
+    path = dataset_manifest_path(config)
+    if not os.path.exists(path) and os.path.exists(dataset_db_path(config)):
+        return dataset_db_path(config)
+    return path
+
+
+def save_datasets(datasets, directory):
+    """Saves datasets, which share a track database, as manifests in directory"""
+    temp_directory = directory + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+    db = datasets[0].db
+    with open(os.path.join(temp_directory, "datasets.json"), "w") as f:
+        json.dump(
+            {
+                "database": db.database,
+                "use_lock": db.use_lock,
+                "datasets": len(datasets),
+            },
+            f,
+        )
+    for i, dataset in enumerate(datasets):
+        dataset.save_manifest(os.path.join(temp_directory, str(i)))
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(temp_directory, directory)
+
+
+def load_datasets(path):
+    """
+    Loads datasets saved by save_datasets, or a file of datasets pickled by older
+    builds
+    """
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    with open(os.path.join(path, "datasets.json"), "r") as f:
+        saved = json.load(f)
+    db = TrackDatabase(saved["database"], saved["use_lock"])
+    return tuple(
+        Dataset.load_manifest(db, os.path.join(path, str(i)))
+        for i in range(saved["datasets"])
+    )
+
     # trying to get only clear frames
 
 
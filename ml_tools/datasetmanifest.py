@@ -0,0 +1,281 @@
+import datetime
+import json
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+from ml_tools.datasetstructures import SegmentHeader, TrackHeader
+
+
+class DatasetManifest:
+    """
+    Tracks and segments of a dataset saved as columns, one .npy file per column,
+    which are memory mapped when loaded. Values which vary in length per row are
+    saved concatenated with the offset of each row. TrackHeaders and SegmentHeaders
+    are only created when they are used, a track is created with its segments.
+    """
+
+    # track attributes saved as a column of numbers
+    TRACK_NUMBERS = (
+        "clip_id",
+        "track_id",
+        "start_frame",
+        "num_frames",
+        "duration",
+        "score",
+        "frames_per_second",
+        "res_x",
+        "res_y",
+        "important_predicted",
+        "lower_mass",
+        "upper_mass",
+        "median_mass",
+        "mean_mass",
+    )
+    # track attributes which vary in length per track, saved as arrays
+    TRACK_ARRAYS = (
+        "frame_temp_median",
+        "track_bounds",
+        "frame_mass",
+        "predictions",
+    )
+    # track attributes which vary in length per track, saved as arrays of lists
+    TRACK_LISTS = ("frame_velocity", "frame_crop", "ffc_frames")
+    # track attributes saved as json
+    TRACK_META = ("camera", "location", "correct_prediction", "filtered_stats")
+    SEGMENT_NUMBERS = ("id", "start_frame", "frames", "weight", "avg_mass")
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "dataset.json"), "r") as f:
+            self.attributes = json.load(f)
+        self.labels = np.load(os.path.join(directory, "labels.npy"))
+        self.track_columns = _load_columns(os.path.join(directory, "tracks"))
+        self.segment_columns = _load_columns(os.path.join(directory, "segments"))
+        self.tracks = TrackTable(self)
+        self.segments = SegmentTable(self)
+        self.created_tracks = {}
+        self.created_segments = {}
+
+    def __getstate__(self):
+        # memory mapped columns are opened again when unpickled
+        return {"directory": self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state["directory"])
+
+    @property
+    def track_count(self):
+        return len(self.track_columns["clip_id"])
+
+    @property
+    def segment_count(self):
+        return len(self.segment_columns["id"])
+
+    def get_track(self, index):
+        """Returns the TrackHeader of track index, creating it and its segments"""
+        track = self.created_tracks.get(index)
+        if track is not None:
+            return track
+        columns = self.track_columns
+        track = TrackHeader.__new__(TrackHeader)
+        for name in DatasetManifest.TRACK_NUMBERS:
+            setattr(track, name, columns[name][index].item())
+        for name in DatasetManifest.TRACK_ARRAYS:
+            value = _get_row(columns, name, index)
+            setattr(track, name, None if value is None else np.array(value))
+        for name in DatasetManifest.TRACK_LISTS:
+            value = _get_row(columns, name, index)
+            setattr(track, name, None if value is None else value.tolist())
+        meta = json.loads(str(columns["meta"][index]))
+        for name in DatasetManifest.TRACK_META:
+            setattr(track, name, meta[name])
+        if isinstance(track.location, list):
+            track.location = np.array(track.location)
+        track.frame_velocity = [tuple(velocity) for velocity in track.frame_velocity]
+        track.start_time = datetime.datetime.fromisoformat(meta["start_time"])
+        track.label = str(self.labels[columns["label"][index]])
+        sample_frames = _get_row(columns, "sample_frames", index)
+        track.sample_frames = None
+        if sample_frames is not None:
+            track.set_sample_frames(sample_frames.tolist())
+        self.created_tracks[index] = track
+
+        track.segments = []
+        for segment_index in _get_row(columns, "segments", index).tolist():
+            segment = SegmentHeader.__new__(SegmentHeader)
+            segment.track = track
+            for name in DatasetManifest.SEGMENT_NUMBERS:
+                value = self.segment_columns[name][segment_index].item()
+                setattr(segment, name, value)
+            frame_indices = _get_row(
+                self.segment_columns, "frame_indices", segment_index
+            )
+            segment.frame_indices = (
+                None if frame_indices is None else frame_indices.tolist()
+            )
+            track.segments.append(segment)
+            self.created_segments[segment_index] = segment
+        return track
+
+    def get_segment(self, index):
+        """Returns the SegmentHeader of segment index, creating its track"""
+        segment = self.created_segments.get(index)
+        if segment is None:
+            self.get_track(self.segment_columns["track"][index].item())
+            segment = self.created_segments[index]
+        return segment
+
+    def get_segment_weights(self):
+        """Returns the weight of every segment, without creating them"""
+        weights = np.array(self.segment_columns["weight"], dtype=np.float64)
+        for index, segment in self.created_segments.items():
+            weights[index] = segment.weight
+        return weights
+
+    def get_segment_labels(self):
+        """Returns the label of every segment, without creating them"""
+        track_labels = self.labels[self.track_columns["label"]].astype(object)
+        for index, track in self.created_tracks.items():
+            track_labels[index] = track.label
+        return track_labels[self.segment_columns["track"]]
+
+
+class TrackTable(Sequence):
+    """Sequence of the TrackHeaders of a manifest, created when indexed"""
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def __len__(self):
+        return self.manifest.track_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.manifest.get_track(_check_index(index, len(self)))
+
+
+class SegmentTable(Sequence):
+    """Sequence of the SegmentHeaders of a manifest, created when indexed"""
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def __len__(self):
+        return self.manifest.segment_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.manifest.get_segment(_check_index(index, len(self)))
+
+
+def save_manifest(dataset, directory, attributes):
+    """Saves the tracks and segments of dataset, and attributes as json"""
+    os.makedirs(directory)
+    with open(os.path.join(directory, "dataset.json"), "w") as f:
+        json.dump(attributes, f)
+    labels = sorted({track.label for track in dataset.tracks})
+    np.save(os.path.join(directory, "labels.npy"), np.array(labels, dtype=str))
+
+    track_index = {id(track): i for i, track in enumerate(dataset.tracks)}
+    segment_tracks = []
+    track_segments = [[] for _ in dataset.tracks]
+    for i, segment in enumerate(dataset.segments):
+        index = track_index.get(id(segment.track))
+        if index is None:
+            raise ValueError("Segment {} isn't of a dataset track".format(segment))
+        segment_tracks.append(index)
+        track_segments[index].append(i)
+
+    tracks = {}
+    for name in DatasetManifest.TRACK_NUMBERS:
+        tracks[name] = np.array([getattr(track, name) for track in dataset.tracks])
+    for name in DatasetManifest.TRACK_ARRAYS + DatasetManifest.TRACK_LISTS:
+        tracks[name] = [getattr(track, name) for track in dataset.tracks]
+    tracks["label"] = np.searchsorted(
+        labels, [track.label for track in dataset.tracks]
+    ).astype(np.int32)
+    tracks["meta"] = np.array(
+        [_track_meta(track) for track in dataset.tracks], dtype=str
+    )
+    tracks["sample_frames"] = [
+        (
+            None
+            if track.sample_frames is None
+            else [frame.frame_num for frame in track.sample_frames]
+        )
+        for track in dataset.tracks
+    ]
+    tracks["segments"] = track_segments
+    _save_columns(os.path.join(directory, "tracks"), tracks)
+
+    segments = {}
+    for name in DatasetManifest.SEGMENT_NUMBERS:
+        segments[name] = np.array(
+            [getattr(segment, name) for segment in dataset.segments]
+        )
+    segments["track"] = np.array(segment_tracks, dtype=np.int64)
+    segments["frame_indices"] = [segment.frame_indices for segment in dataset.segments]
+    _save_columns(os.path.join(directory, "segments"), segments)
+
+
+def _track_meta(track):
+    meta = {name: getattr(track, name) for name in DatasetManifest.TRACK_META}
+    meta["start_time"] = track.start_time.isoformat()
+    return json.dumps(meta, default=_json_default)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Can't save {!r} in a dataset manifest".format(value))
+
+
+def _save_columns(directory, columns):
+    """
+    Saves each column as name.npy, columns given as lists of rows are concatenated
+    with name.offsets.npy holding the start of each row and name.missing.npy the rows
+    which are None
+    """
+    os.makedirs(directory)
+    for name, values in columns.items():
+        if isinstance(values, list):
+            missing = np.array([row is None for row in values], dtype=bool)
+            rows = [np.asarray(row) for row in values if row is not None and len(row)]
+            lengths = [len(row) if row is not None else 0 for row in values]
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            values = np.concatenate(rows) if rows else np.empty(0)
+            np.save(os.path.join(directory, name + ".offsets.npy"), offsets)
+            np.save(os.path.join(directory, name + ".missing.npy"), missing)
+        np.save(os.path.join(directory, name + ".npy"), values)
+
+
+def _load_columns(directory):
+    columns = {}
+    for filename in os.listdir(directory):
+        name = filename[: -len(".npy")]
+        columns[name] = np.load(os.path.join(directory, filename), mmap_mode="r")
+    return columns
+
+
+def _get_row(columns, name, index):
+    """Returns row index of a column saved as rows, or None"""
+    if columns[name + ".missing"][index]:
+        return None
+    offsets = columns[name + ".offsets"]
+    return columns[name][offsets[index] : offsets[index + 1]]
+
+
+def _check_index(index, length):
+    index = int(index)
+    if index < 0:
+        index += length
+    if not 0 <= index < length:
+        raise IndexError("Index {} out of range".format(index))
+    return index
@@ -1,5 +1,6 @@
 import attr
 import cv2
+import functools
 import numpy as np
 from track.track import TrackChannels
 from ml_tools.tools import get_clipped_flow
@@ -9,15 +10,33 @@ from ml_tools.imageprocessing import resize_cv, rotate, normalize, resize_with_a
 
 @attr.s(slots=True)
 class Frame:
+    # types which channels are compacted to, if they can hold the values exactly
+    THERMAL_TYPES = (np.uint16,)
+    FILTERED_TYPES = (np.uint8,)
+    MASK_TYPES = (np.uint8, np.uint16)
 
     thermal = attr.ib()
     filtered = attr.ib()
     mask = attr.ib()
     frame_number = attr.ib()
-    flow = attr.ib(default=None)
+    _flow = attr.ib(default=None)
     flow_clipped = attr.ib(default=False)
     scaled_thermal = attr.ib(default=None)
     ffc_affected = attr.ib(default=False)
+    # calculates flow the first time it is used, if flow is generated lazily
+    lazy_flow = attr.ib(default=None)
+
+    @property
+    def flow(self):
+        if self.lazy_flow is not None:
+            self._flow = self.lazy_flow()
+            self.lazy_flow = None
+        return self._flow
+
+    @flow.setter
+    def flow(self, flow):
+        self.lazy_flow = None
+        self._flow = flow
 
     def get_channel(self, channel):
         if channel == TrackChannels.thermal:
@@ -34,15 +53,22 @@ class Frame:
     def from_array(
         cls, frame_arr, frame_number, flow_clipped=False, ffc_affected=False
     ):
+        """
+        Creates a frame from a sequence of channels, either thermal, filtered, flow_h,
+        flow_v and mask or thermal, filtered and mask if there is no flow
+        """
         flow = None
         if len(frame_arr) == 5:
             flow_h = frame_arr[TrackChannels.flow_h][:, :, np.newaxis]
             flow_v = frame_arr[TrackChannels.flow_v][:, :, np.newaxis]
             flow = np.concatenate((flow_h, flow_v), axis=2)
+            mask = frame_arr[TrackChannels.mask]
+        else:
+            mask = frame_arr[2]
         return cls(
             frame_arr[TrackChannels.thermal],
             frame_arr[TrackChannels.filtered],
-            frame_arr[TrackChannels.mask],
+            mask,
             frame_number,
             flow=flow,
             flow_clipped=flow_clipped,
@@ -65,13 +91,18 @@ class Frame:
 
         return np.asarray([self.thermal, self.filtered, self.flow, self.mask])
 
-    def generate_optical_flow(self, opt_flow, prev_frame, flow_threshold=40):
+    def generate_optical_flow(
+        self, opt_flow, prev_frame, flow_threshold=40, region_padding=None, lazy=False
+    ):
         """
         Generate optical flow from thermal frames
         :param opt_flow: An optical flow algorithm
+        :param region_padding: If set flow is only calculated around the objects in the
+            mask of this and the previous frame, padded by this many pixels, and is
+            zero elsewhere
+        :param lazy: If set the scaled thermal frames are kept and flow is only
+            calculated when it is first used
         """
-        height, width = self.thermal.shape
-        flow = np.zeros([height, width, 2], dtype=np.float32)
         scaled_thermal = self.thermal.copy()
         scaled_thermal[self.mask == 0] = 0
         scaled_thermal, _ = normalize(scaled_thermal, new_max=255)
@@ -79,13 +110,22 @@ class Frame:
 
         # threshold = np.median(self.thermal) + flow_threshold
         # scaled_thermal = np.uint8(np.clip(self.thermal - threshold, 0, 255))
+        prev_scaled_thermal = None
+        regions = None
         if prev_frame is not None:
-            # for some reason openCV spins up lots of threads for this which really slows things down, so we
-            # cap the threads to 2
-            cv2.setNumThreads(2)
-            flow = opt_flow.calc(prev_frame.scaled_thermal, scaled_thermal, flow)
+            prev_scaled_thermal = prev_frame.scaled_thermal
+            if region_padding is not None:
+                regions = get_flow_regions((prev_frame.mask, self.mask), region_padding)
         self.scaled_thermal = scaled_thermal
-        self.flow = flow
+        if lazy:
+            self.flow = None
+            self.lazy_flow = functools.partial(
+                calculate_flow, opt_flow, prev_scaled_thermal, scaled_thermal, regions
+            )
+        else:
+            self.flow = calculate_flow(
+                opt_flow, prev_scaled_thermal, scaled_thermal, regions
+            )
         if prev_frame:
             prev_frame.scaled_thermal = None
 
@@ -159,6 +199,22 @@ class Frame:
             self.flow = rotate(self.flow, degrees)
         self.filtered = rotate(self.filtered, degrees)
 
+    def compact(self):
+        """
+        Stores each channel in the smallest type which holds its values exactly,
+        thermal as uint16, filtered as uint8 and mask as uint8 or uint16
+        """
+        self.thermal = compact_array(self.thermal, Frame.THERMAL_TYPES)
+        self.filtered = compact_array(self.filtered, Frame.FILTERED_TYPES)
+        self.mask = compact_array(self.mask, Frame.MASK_TYPES)
+
+    @property
+    def nbytes(self):
+        nbytes = self.thermal.nbytes + self.filtered.nbytes + self.mask.nbytes
+        if self._flow is not None:
+            nbytes += self._flow.nbytes
+        return nbytes
+
     def float_arrays(self):
         self.thermal = np.float32(self.thermal)
         self.mask = np.float32(self.mask)
@@ -172,9 +228,10 @@ class Frame:
             self.filtered,
             self.mask,
             self.frame_number,
-            flow=self.flow,
+            flow=self._flow,
             flow_clipped=self.flow_clipped,
             ffc_affected=self.ffc_affected,
+            lazy_flow=self.lazy_flow,
         )
 
     def flip(self):
@@ -203,3 +260,87 @@ class Frame:
     @property
     def shape(self):
         return self.thermal.shape
+
+
+def calculate_flow(opt_flow, prev_scaled_thermal, scaled_thermal, regions=None):
+    """
+    Optical flow between two scaled thermal frames, if regions is given flow is only
+    calculated inside those slices
+    """
+    height, width = scaled_thermal.shape
+    flow = np.zeros([height, width, 2], dtype=np.float32)
+    if prev_scaled_thermal is None:
+        return flow
+    # for some reason openCV spins up lots of threads for this which really slows things down, so we
+    # cap the threads to 2
+    cv2.setNumThreads(2)
+    if regions is None:
+        return opt_flow.calc(prev_scaled_thermal, scaled_thermal, flow)
+    for region in regions:
+        flow[region] = opt_flow.calc(
+            np.ascontiguousarray(prev_scaled_thermal[region]),
+            np.ascontiguousarray(scaled_thermal[region]),
+            np.ascontiguousarray(flow[region]),
+        )
+    return flow
+
+
+def get_flow_regions(masks, padding):
+    """
+    Returns slices covering the objects in masks, each padded by padding pixels,
+    overlapping boxes are merged so no pixel is covered twice
+    """
+    occupied = np.zeros(masks[0].shape, dtype=bool)
+    for mask in masks:
+        occupied |= mask > 0
+    height, width = occupied.shape
+    boxes = []
+    for object_slice in ndimage.find_objects(ndimage.label(occupied)[0]):
+        rows, cols = object_slice
+        boxes.append(
+            [
+                max(0, rows.start - padding),
+                max(0, cols.start - padding),
+                min(height, rows.stop + padding),
+                min(width, cols.stop + padding),
+            ]
+        )
+    merged = True
+    while merged:
+        merged = False
+        for i, box in enumerate(boxes):
+            for other in boxes[i + 1 :]:
+                if (
+                    box[0] < other[2]
+                    and other[0] < box[2]
+                    and box[1] < other[3]
+                    and other[1] < box[3]
+                ):
+                    box[:] = [
+                        min(box[0], other[0]),
+                        min(box[1], other[1]),
+                        max(box[2], other[2]),
+                        max(box[3], other[3]),
+                    ]
+                    boxes.remove(other)
+                    merged = True
+                    break
+            if merged:
+                break
+    return [np.s_[top:bottom, left:right] for top, left, bottom, right in boxes]
+
+
+def compact_array(array, dtypes):
+    """Returns array as the first of dtypes which holds all of its values exactly"""
+    if len(array) == 0:
+        return array
+    for dtype in dtypes:
+        if array.dtype == dtype:
+            return array
+        info = np.iinfo(dtype)
+        if array.min() < info.min or array.max() > info.max:
+            continue
+        compacted = array.astype(dtype)
+        if np.array_equal(compacted, array):
+            return compacted
+    return array
@@ -4,79 +4,178 @@ import numpy as np
 from multiprocessing import Lock
 
 
+from ml_tools.frame import Frame, compact_array
 from ml_tools.tools import get_clipped_flow
 
 
 class FrameCache:
+    """
+    Stores the frames of a clip on disk in a single resizable (N, C, H, W) dataset,
+    chunked so that each frame is one chunk. Thermal, filtered and mask are stored
+    as uint16 which holds all of them exactly, flow is stored in a separate float32
+    dataset only if it has been calculated. Frames are appended and read by index
+    rather than creating a group per frame.
+    """
+
+    INITIAL_CAPACITY = 64
+    CHANNELS = ("thermal", "filtered", "mask")
+    # datasets holding a value per frame, and their types
+    FRAME_INFO = {"frame_number": np.int32, "ffc_affected": bool, "has_flow": bool}
+
     def __init__(self, cptv_name, keep_open=True, delete_if_exists=True):
         basename = os.path.splitext(cptv_name)[0]
         self.filename = basename + ".cache"
         self.db = None
         self.keep_open = keep_open
-        self.num_farmes = 0
+        self.frames = None
+        self.flow = None
+        self.num_frames = 0
+        self.frame_index = None
+        self.frame_info = {
+            name: np.zeros(FrameCache.INITIAL_CAPACITY, dtype=dtype)
+            for name, dtype in FrameCache.FRAME_INFO.items()
+        }
+        self.info_saved = True
         if delete_if_exists:
             self.delete()
 
-        f = h5py.File(self.filename, "w")
-        f.create_group("frames")
-        f.close()
+        if not os.path.exists(self.filename):
+            f = h5py.File(self.filename, "w")
+            f.create_group("frames")
+            f.close()
+
+    def _create_datasets(self, frame):
+        height, width = frame.thermal.shape
+        dtype = np.result_type(*[getattr(frame, name) for name in FrameCache.CHANNELS])
+        self.db.create_dataset(
+            "frames/channels",
+            (FrameCache.INITIAL_CAPACITY, len(FrameCache.CHANNELS), height, width),
+            maxshape=(None, len(FrameCache.CHANNELS), height, width),
+            chunks=(1, len(FrameCache.CHANNELS), height, width),
+            dtype=dtype,
+        )
+
+    def _create_flow_dataset(self):
+        capacity, _, height, width = self.frames.shape
+        self.db.create_dataset(
+            "frames/flow",
+            (capacity, 2, height, width),
+            maxshape=(None, 2, height, width),
+            chunks=(1, 2, height, width),
+            dtype=np.float32,
+        )
 
     def add_frame(self, frame):
+        """
+        Appends frame to the cache with its channels in compact types, flow is only
+        saved if it has been calculated
+        """
         self.open()
-        frames = self.db["frames"]
-        frame_group = frames.create_group(str(frame.frame_number))
-        frame_group.attrs["ffc_affected"] = frame.ffc_affected
+        compact = frame.copy()
+        compact.compact()
+        if self.frames is None:
+            self._create_datasets(compact)
+            self._open_datasets()
+        if frame.flow is not None and self.flow is None:
+            self._create_flow_dataset()
+            self._open_datasets()
 
-        height, width = frame.thermal.shape
+        index = self.num_frames
+        capacity = len(self.frames)
+        if index == capacity:
+            self.frames.resize(2 * capacity, axis=0)
+            if self.flow is not None:
+                self.flow.resize(2 * capacity, axis=0)
+            for name, values in self.frame_info.items():
+                grown = np.zeros(2 * capacity, dtype=values.dtype)
+                grown[:capacity] = values[:capacity]
+                self.frame_info[name] = grown
 
-        chunks = (1, height, width)
-
-        dims = (5, height, width)
-        frame_node = frame_group.create_dataset(
-            "frame", dims, chunks=chunks, dtype=np.float32
-        )
-        scaled_flow_h = None
-        scaled_flow_v = None
+        channels = [getattr(compact, name) for name in FrameCache.CHANNELS]
+        for name, channel in zip(FrameCache.CHANNELS, channels):
+            if not np.can_cast(channel.dtype, self.frames.dtype):
+                raise ValueError(
+                    "Cannot cache {} of type {} as {}".format(
+                        name, channel.dtype, self.frames.dtype
+                    )
+                )
+        self.frames[index] = np.stack(channels)
         if frame.flow is not None:
-            scaled_flow = get_clipped_flow(frame.flow)
-            scaled_flow_h = np.float32(scaled_flow[:, :, 0])
-            scaled_flow_v = np.float32(scaled_flow[:, :, 1])
-        else:
-            scaled_flow_h = np.zeros(frame.thermal.shape, dtype=np.float32)
-            scaled_flow_v = scaled_flow_h
-
-        frame_val = (
-            np.float32(frame.thermal),
-            np.float32(frame.filtered),
-            scaled_flow_h,
-            scaled_flow_v,
-            np.float32(frame.mask),
-        )
-        frame_node[:, :, :] = frame_val
+            scaled_flow = np.float32(get_clipped_flow(frame.flow))
+            self.flow[index] = np.moveaxis(scaled_flow, 2, 0)
+        self.frame_info["frame_number"][index] = frame.frame_number
+        self.frame_info["ffc_affected"][index] = frame.ffc_affected
+        self.frame_info["has_flow"][index] = frame.flow is not None
+        if self.frame_index is not None:
+            self.frame_index[frame.frame_number] = index
+        self.num_frames += 1
+        self.info_saved = False
         if not self.keep_open:
             self.close()
 
+    def _save_info(self):
+        """Saves the per frame values, these are kept in memory while appending"""
+        frames = self.db["frames"]
+        for name, values in self.frame_info.items():
+            if name in frames:
+                del frames[name]
+            frames.create_dataset(name, data=values[: self.num_frames])
+        frames.attrs["num_frames"] = self.num_frames
+        self.info_saved = True
+
+    def _load_info(self):
+        frames = self.db["frames"]
+        self.num_frames = int(frames.attrs.get("num_frames", 0))
+        if self.num_frames > 0:
+            self.frame_info = {name: frames[name][()] for name in FrameCache.FRAME_INFO}
+
+    def _open_datasets(self):
+        frames = self.db["frames"]
+        self.frames = frames.get("channels")
+        self.flow = frames.get("flow")
+
     def get_frame(self, frame_number):
+        """
+        Returns the channels of a frame in the order Frame.from_array expects, and if
+        the frame was affected by ffc
+        """
         self.open()
+        if self.frame_index is None:
+            frame_numbers = self.frame_info["frame_number"][: self.num_frames]
+            self.frame_index = {
+                int(number): index for index, number in enumerate(frame_numbers)
+            }
         ffc_affected = False
-        if str(frame_number) in self.db["frames"]:
-            frame_group = self.db["frames"][str(frame_number)]
-            frame = frame_group["frame"]
-            ffc_affected = frame_group.attrs["ffc_affected"]
-        else:
+        index = self.frame_index.get(frame_number)
+        if index is None:
             frame = None
+        else:
+            thermal, filtered, mask = self.frames[index]
+            frame = [thermal, compact_array(filtered, Frame.FILTERED_TYPES)]
+            if self.frame_info["has_flow"][index]:
+                flow = self.flow[index]
+                frame.extend((flow[0], flow[1]))
+            frame.append(compact_array(mask, Frame.MASK_TYPES))
+            ffc_affected = bool(self.frame_info["ffc_affected"][index])
         if not self.keep_open:
             self.close()
         return frame, ffc_affected
 
     def close(self):
         if self.db:
+            if not self.info_saved:
+                self._save_info()
             self.db.close()
             self.db = None
+            self.frames = None
+            self.flow = None
 
     def open(self, mode="a"):
         if not self.db:
             self.db = h5py.File(self.filename, mode)
+            self._open_datasets()
+            if self.num_frames == 0:
+                self._load_info()
 
     def delete(self):
         if self.db:
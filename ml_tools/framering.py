@@ -0,0 +1,126 @@
+import numpy as np
+
+from ml_tools.frame import Frame, compact_array
+
+
+class FrameRing:
+    """
+    Keeps the most recent capacity frames of a clip in preallocated arrays, each new
+    frame overwrites the oldest. Frames can be pinned by an owner such as a track,
+    every frame from the pinned frame number onwards is kept until the owner unpins
+    them, frames which are still pinned when their slot is overwritten are moved out
+    of the ring.
+    """
+
+    CHANNELS = {
+        "thermal": Frame.THERMAL_TYPES,
+        "filtered": Frame.FILTERED_TYPES,
+        "mask": Frame.MASK_TYPES,
+    }
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Frame ring capacity must be positive {}".format(capacity))
+        self.capacity = capacity
+        self.channels = None
+        self.flow = None
+        self.frame_numbers = np.full(capacity, -1, dtype=np.int64)
+        self.ffc_affected = np.zeros(capacity, dtype=bool)
+        self.has_flow = np.zeros(capacity, dtype=bool)
+        self.frames_added = 0
+        self.frame_index = {}
+        # owner -> first frame number it needs kept
+        self.pins = {}
+        # pinned frames which have been overwritten in the ring
+        self.spilled = {}
+
+    def _allocate(self, frame):
+        shape = (self.capacity,) + frame.thermal.shape
+        self.channels = {
+            name: np.zeros(shape, dtype=dtypes[-1])
+            for name, dtypes in FrameRing.CHANNELS.items()
+        }
+
+    @property
+    def oldest_pinned(self):
+        """The first frame number any owner needs kept, or None if nothing is pinned"""
+        if len(self.pins) == 0:
+            return None
+        return min(self.pins.values())
+
+    def pin(self, owner, frame_number):
+        """Keeps frames from frame_number onwards until owner is unpinned"""
+        self.pins[owner] = frame_number
+
+    def unpin(self, owner):
+        """Releases the frames pinned by owner"""
+        if self.pins.pop(owner, None) is None:
+            return
+        oldest_pinned = self.oldest_pinned
+        self.spilled = {
+            frame_number: frame
+            for frame_number, frame in self.spilled.items()
+            if oldest_pinned is not None and frame_number >= oldest_pinned
+        }
+
+    def add_frame(self, frame):
+        """Stores a copy of frame in the slot of the oldest frame"""
+        if self.channels is None:
+            self._allocate(frame)
+        if frame.flow is not None and self.flow is None:
+            self.flow = np.zeros((self.capacity,) + frame.flow.shape, dtype=np.float32)
+        slot = self.frames_added % self.capacity
+        old_number = int(self.frame_numbers[slot])
+        if old_number >= 0:
+            del self.frame_index[old_number]
+            oldest_pinned = self.oldest_pinned
+            if oldest_pinned is not None and old_number >= oldest_pinned:
+                self.spilled[old_number] = self._get_slot(slot)
+
+        for name, dtypes in FrameRing.CHANNELS.items():
+            channel = compact_array(getattr(frame, name), dtypes)
+            store = self.channels[name]
+            if not np.can_cast(channel.dtype, store.dtype):
+                raise ValueError(
+                    "Cannot store {} of type {} as {}".format(
+                        name, channel.dtype, store.dtype
+                    )
+                )
+            store[slot] = channel
+        if frame.flow is not None:
+            self.flow[slot] = frame.flow
+        self.frame_numbers[slot] = frame.frame_number
+        self.ffc_affected[slot] = frame.ffc_affected
+        self.has_flow[slot] = frame.flow is not None
+        self.frame_index[frame.frame_number] = slot
+        self.frames_added += 1
+
+    def _get_slot(self, slot):
+        channels = {name: store[slot].copy() for name, store in self.channels.items()}
+        flow = self.flow[slot].copy() if self.has_flow[slot] else None
+        return Frame(
+            channels["thermal"],
+            channels["filtered"],
+            channels["mask"],
+            int(self.frame_numbers[slot]),
+            flow=flow,
+            ffc_affected=bool(self.ffc_affected[slot]),
+        )
+
+    def get_frame(self, frame_number):
+        """
+        Returns a copy of frame frame_number, or None if it has been overwritten and
+        isn't pinned
+        """
+        slot = self.frame_index.get(frame_number)
+        if slot is not None:
+            return self._get_slot(slot)
+        return self.spilled.get(frame_number)
+
+    def get_last_frame(self):
+        if self.frames_added == 0:
+            return None
+        return self._get_slot((self.frames_added - 1) % self.capacity)
+
+    def __len__(self):
+        return len(self.frame_index) + len(self.spilled)
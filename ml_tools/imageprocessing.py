@@ -145,6 +145,44 @@ def save_image_channels(data, filename):
     img.save(filename + ".png")
 
 
+def denoise_nl_means(image):
+    return cv2.fastNlMeansDenoising(image, None)
+
+
+def denoise_bilateral(image):
+    return cv2.bilateralFilter(image, 5, 50, 5)
+
+
+def denoise_median(image):
+    return cv2.medianBlur(image, 3)
+
+
+def denoise_downsampled(image, blur):
+    """Blurs a half size copy of image and scales it back up"""
+    height, width = image.shape
+    small = cv2.resize(image, (width // 2, height // 2), interpolation=cv2.INTER_AREA)
+    small = blur(small)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def denoise_gaussian(image):
+    return denoise_downsampled(image, lambda small: cv2.GaussianBlur(small, (3, 3), 0))
+
+
+def denoise_box(image):
+    return denoise_downsampled(image, lambda small: cv2.blur(small, (3, 3)))
+
+
+# functions which denoise a uint8 image
+DENOISERS = {
+    "nlmeans": denoise_nl_means,
+    "bilateral": denoise_bilateral,
+    "median": denoise_median,
+    "gaussian": denoise_gaussian,
+    "box": denoise_box,
+}
+
+
 def detect_objects(image, otsus=True, threshold=0, kernel=(5, 5)):
     image = np.uint8(image)
     image = cv2.GaussianBlur(image, kernel, 0)
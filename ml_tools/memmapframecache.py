@@ -0,0 +1,188 @@
+import json
+import os
+
+import numpy as np
+
+from ml_tools.frame import Frame
+from ml_tools.tools import get_clipped_flow
+
+
+class MemmapFrameCache:
+    """
+    Stores the frames of a clip on disk in a memory mapped file, an alternative to
+    the hdf5 FrameCache. The file has a fixed size header followed by a fixed size
+    record per frame, the file grows as frames are added. get_frame returns read
+    only views of the mapped file so reads don't copy, and the OS page cache
+    decides what stays in memory. The record layout is decided by the first frame added, so
+    either every frame has flow or none do.
+    """
+
+    VERSION = 1
+    EXTENSION = ".frames"
+    HEADER_SIZE = 4096
+    INITIAL_CAPACITY = 64
+    CHANNELS = {
+        "thermal": Frame.THERMAL_TYPES,
+        "filtered": Frame.FILTERED_TYPES,
+        "mask": Frame.MASK_TYPES,
+    }
+
+    def __init__(self, cptv_name, keep_open=True, delete_if_exists=True):
+        basename = os.path.splitext(cptv_name)[0]
+        self.filename = basename + MemmapFrameCache.EXTENSION
+        self.keep_open = keep_open
+        self.records = None
+        self.reader = None
+        self.record_type = None
+        self.capacity = 0
+        self.num_frames = 0
+        self.frame_index = {}
+        if delete_if_exists:
+            self.delete()
+        elif os.path.exists(self.filename):
+            self._read_header()
+
+    def _get_record_type(self, frame):
+        height, width = frame.thermal.shape
+        fields = [
+            ("frame_number", np.int32),
+            ("ffc_affected", np.bool_),
+            ("has_flow", np.bool_),
+        ]
+        for name, dtypes in MemmapFrameCache.CHANNELS.items():
+            # use the widest compact type so any later frame will fit
+            dtype = getattr(frame, name).dtype
+            if dtype in dtypes:
+                dtype = dtypes[-1]
+            fields.append((name, dtype, (height, width)))
+        if frame.flow is not None:
+            fields.append(("flow", np.float32, (2, height, width)))
+        return np.dtype(fields)
+
+    def _write_header(self):
+        header = json.dumps(
+            {
+                "version": MemmapFrameCache.VERSION,
+                "descr": np.lib.format.dtype_to_descr(self.record_type),
+                "capacity": self.capacity,
+                "num_frames": self.num_frames,
+            }
+        ).encode()
+        if len(header) > MemmapFrameCache.HEADER_SIZE:
+            raise ValueError("Frame cache header is too big {}".format(len(header)))
+        with open(self.filename, "r+b") as f:
+            f.write(header.ljust(MemmapFrameCache.HEADER_SIZE))
+
+    def _read_header(self):
+        with open(self.filename, "rb") as f:
+            header = json.loads(f.read(MemmapFrameCache.HEADER_SIZE))
+        self.record_type = np.lib.format.descr_to_dtype(
+            [tuple(field) for field in header["descr"]]
+        )
+        self.capacity = header["capacity"]
+        self.num_frames = header["num_frames"]
+        self.open(mode="r")
+        self.frame_index = {
+            int(frame_number): index
+            for index, frame_number in enumerate(
+                self.reader["frame_number"][: self.num_frames]
+            )
+        }
+
+    def _resize(self, capacity):
+        """Grows the file to hold capacity frames and maps it"""
+        self.records = None
+        self.reader = None
+        mode = "r+b" if os.path.exists(self.filename) else "w+b"
+        with open(self.filename, mode) as f:
+            f.truncate(
+                MemmapFrameCache.HEADER_SIZE + capacity * self.record_type.itemsize
+            )
+        self.capacity = capacity
+        self._write_header()
+        self.open()
+
+    def add_frame(self, frame):
+        """Appends frame to the cache with its channels in compact types"""
+        compact = frame.copy()
+        compact.compact()
+        if self.record_type is None:
+            self.record_type = self._get_record_type(compact)
+            self._resize(MemmapFrameCache.INITIAL_CAPACITY)
+        elif frame.flow is not None and "flow" not in self.record_type.names:
+            raise ValueError("Frame cache was created for frames without flow")
+        self.open()
+        if self.num_frames == self.capacity:
+            self._resize(2 * self.capacity)
+
+        index = self.num_frames
+        for name in MemmapFrameCache.CHANNELS:
+            channel = getattr(compact, name)
+            if not np.can_cast(channel.dtype, self.record_type[name].base):
+                raise ValueError(
+                    "Cannot cache {} of type {} as {}".format(
+                        name, channel.dtype, self.record_type[name].base
+                    )
+                )
+            self.records[name][index] = channel
+        if frame.flow is not None:
+            scaled_flow = np.float32(get_clipped_flow(frame.flow))
+            self.records["flow"][index] = np.moveaxis(scaled_flow, 2, 0)
+        self.records["frame_number"][index] = frame.frame_number
+        self.records["ffc_affected"][index] = frame.ffc_affected
+        self.records["has_flow"][index] = frame.flow is not None
+        self.frame_index[frame.frame_number] = index
+        self.num_frames += 1
+        if not self.keep_open:
+            self.close()
+
+    def get_frame(self, frame_number):
+        """
+        Returns views of the channels of a frame in the order Frame.from_array
+        expects, and if the frame was affected by ffc
+        """
+        index = self.frame_index.get(frame_number)
+        if index is None:
+            return None, False
+        self.open(mode="r")
+        records = self.reader
+        frame = [records["thermal"][index], records["filtered"][index]]
+        if records["has_flow"][index]:
+            flow = records["flow"][index]
+            frame.extend((flow[0], flow[1]))
+        frame.append(records["mask"][index])
+        ffc_affected = bool(records["ffc_affected"][index])
+        if not self.keep_open:
+            self.close()
+        return frame, ffc_affected
+
+    def close(self):
+        if self.records is not None:
+            self.records.flush()
+            self._write_header()
+        self.records = None
+        self.reader = None
+
+    def _map(self, mode):
+        return np.memmap(
+            self.filename,
+            dtype=self.record_type,
+            mode=mode,
+            offset=MemmapFrameCache.HEADER_SIZE,
+            shape=(self.capacity,),
+        )
+
+    def open(self, mode="a"):
+        """Maps the file for reading if mode is "r" otherwise for appending frames"""
+        if self.record_type is None:
+            return
+        if mode == "r":
+            if self.reader is None:
+                self.reader = self._map("r")
+        elif self.records is None:
+            self.records = self._map("r+")
+
+    def delete(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -7,7 +7,6 @@ import tensorflow as tf
 import numpy as np
 import matplotlib.pyplot as plt
 import os.path
-import pickle
 import math
 import logging
 import time
@@ -16,6 +15,7 @@ from collections import namedtuple
 from sklearn import metrics
 
 from ml_tools import tools
+from ml_tools.dataset import load_datasets
 from ml_tools import visualise
 
 
@@ -99,6 +99,13 @@ class Model:
         # enabled parallel loading and training on data (much faster)
         self.enable_async_loading = True
 
+        # cache of segments which aren't augmented
+        self.segment_cache_mb = 1024
+        self.segment_cache_dir = None
+        if train_config:
+            self.segment_cache_mb = train_config.segment_cache_mb
+            self.segment_cache_dir = train_config.segment_cache_dir
+
         # folder to write tensorboard logs to
         if train_config:
             self.log_dir = os.path.join(train_config.train_dir, "logs")
@@ -141,11 +148,11 @@ class Model:
     def import_dataset(self, dataset_filename, ignore_labels=None):
         """
         Import dataset.
-        :param dataset_filename: path and filename of the dataset
+        :param dataset_filename: directory of the saved datasets, or file of pickled datasets
         :param ignore_labels: (optional) these labels will be removed from the dataset.
         :return:
         """
-        datasets = pickle.load(open(dataset_filename, "rb"))
+        datasets = load_datasets(dataset_filename)
         self.datasets.train, self.datasets.validation, self.datasets.test = datasets
 
         # augmentation really helps with reducing over-fitting, but test set should be fixed so we don't apply it there.
@@ -591,7 +598,7 @@ class Model:
     def setup_sample_training_data(self, log_dir, writer):
 
         # get some samples
-        segs = [self.datasets.train.sample_segment() for _ in range(1000)]
+        segs = self.datasets.train.sample_segments(1000)
         sample_X = []
         sample_y = []
         for segment in segs:
@@ -642,6 +649,12 @@ class Model:
         ), "Training dataset found, must call import_dataset before training."
         assert self.train_op, "Training operation has not been assigned."
 
+        for dataset in (self.datasets.train, self.datasets.validation):
+            cache_dir = None
+            if self.segment_cache_dir is not None:
+                cache_dir = os.path.join(self.segment_cache_dir, dataset.name)
+            dataset.enable_segment_cache(self.segment_cache_mb * 1024 * 1024, cache_dir)
+
         if self.enable_async_loading:
             self.start_async_load()
 
@@ -822,7 +835,7 @@ class Model:
         # make sure the workers load the correct number of frames.
         self.datasets.train.segment_width = self.testing_segment_frames
         self.datasets.validation.segment_width = self.testing_segment_frames
-        self.datasets.train.start_async_load(48)
+        self.datasets.train.start_async_load(48, self.batch_size)
         self.datasets.validation.start_async_load(48)
 
     def stop_async(self):
@@ -5,6 +5,7 @@ import random
 from ml_tools import tools
 from track.track import TrackChannels
 from ml_tools import imageprocessing
+from ml_tools.imageprocessing import resize_with_aspect, rotate
 
 
 # size to scale each frame to when loaded.
@@ -49,61 +50,18 @@ def preprocess_segment(
     # -------------------------------------------
     # first we scale to the standard size
     data = []
-    flip = False
-    if augment:
-        contrast_adjust = None
-        level_adjust = None
-        if random.random() <= 0.75:
-            # we will adjust contrast and levels, but only within these bounds.
-            # that is a bright input may have brightness reduced, but not increased.
-            LEVEL_OFFSET = 4
-
-            # apply level and contrast shift
-            level_adjust = float(random.normalvariate(0, LEVEL_OFFSET))
-            contrast_adjust = float(tools.random_log(0.9, (1 / 0.9)))
-        if random.random() <= 0.50:
-            flip = True
+    level_adjust, contrast_adjust, flip = get_segment_augmentation(augment)
     for i, frame in enumerate(frames):
         frame.float_arrays()
-        frame_height, frame_width = frame.thermal.shape
-        # adjusting the corners makes the algorithm robust to tracking differences.
-        # gp changed to 0,1 maybe should be a percent of the frame size
-        max_height_offset = int(np.clip(frame_height * 0.1, 1, 2))
-        max_width_offset = int(np.clip(frame_width * 0.1, 1, 2))
-
-        top_offset = random.randint(0, max_height_offset) if augment else default_inset
-        bottom_offset = (
-            random.randint(0, max_height_offset) if augment else default_inset
-        )
-        left_offset = random.randint(0, max_width_offset) if augment else default_inset
-        right_offset = random.randint(0, max_width_offset) if augment else default_inset
-        if frame_height < MIN_SIZE or frame_width < MIN_SIZE:
+        crop_region = get_crop_region(frame.thermal.shape, augment, default_inset)
+        if crop_region is None:
             continue
 
-        frame_bounds = tools.Rectangle(0, 0, frame_width, frame_height)
         # rotate then crop
-        if augment and random.random() <= 0.75:
-
-            degrees = random.randint(0, 40) - 20
+        degrees = get_rotation(augment)
+        if degrees is not None:
             frame.rotate(degrees)
 
-        # set up a cropping frame
-        crop_region = tools.Rectangle.from_ltrb(
-            left_offset,
-            top_offset,
-            frame_width - right_offset,
-            frame_height - bottom_offset,
-        )
-
-        # if the frame is too small we make it a little larger
-        while crop_region.width < MIN_SIZE:
-            crop_region.left -= 1
-            crop_region.right += 1
-            crop_region.crop(frame_bounds)
-        while crop_region.height < MIN_SIZE:
-            crop_region.top -= 1
-            crop_region.bottom += 1
-            crop_region.crop(frame_bounds)
         frame.crop_by_region(crop_region, out=frame)
         frame.resize((frame_size, frame_size), keep_aspect=keep_aspect)
         if reference_level is not None:
@@ -122,6 +80,152 @@ def preprocess_segment(
     return data, flip
 
 
+def preprocess_segment_array(
+    frames,
+    reference_level=None,
+    frame_velocity=None,
+    augment=False,
+    default_inset=2,
+    keep_aspect=False,
+    frame_size=48,
+):
+    """
+    Preprocesses a segment like preprocess_segment, but returns the frames stacked in
+    one array. Each frame is rotated, cropped and resized with all of its channels
+    at once into a preallocated array, then the levels and augmentation are applied
+    to the whole segment. Gives the same result as preprocess_segment for the same
+    random state, and doesn't modify frames.
+    :param frames: a list of Frames
+    :return: array of shape [frames, channels, frame_size, frame_size] with channels
+        ordered as Frame.as_array, and if the segment was flipped
+    """
+    # index of the mask in Frame.as_array
+    MASK = 2
+    if reference_level is not None:
+        assert len(frames) == len(
+            reference_level
+        ), "Reference level shape and data shape not match."
+
+    level_adjust, contrast_adjust, flip = get_segment_augmentation(augment)
+    # crop and rotation of each frame, drawn in the same order as preprocess_segment
+    transforms = []
+    for i, frame in enumerate(frames):
+        crop_region = get_crop_region(frame.thermal.shape, augment, default_inset)
+        if crop_region is not None:
+            transforms.append((i, crop_region, get_rotation(augment)))
+
+    channels = frames[0].channels if len(frames) > 0 else 3
+    data = np.empty(
+        (len(transforms), frame_size, frame_size, channels), dtype=np.float32
+    )
+    for out, (i, crop_region, degrees) in zip(data, transforms):
+        frame = frames[i]
+        # channels last, so the frame can be rotated and resized in one call
+        stacked = np.empty(frame.thermal.shape + (channels,), dtype=np.float32)
+        stacked[:, :, 0] = frame.thermal
+        stacked[:, :, 1] = frame.filtered
+        stacked[:, :, MASK] = frame.mask
+        if channels == 5:
+            stacked[:, :, 3:] = frame.flow
+        if degrees is not None:
+            stacked = rotate(stacked, degrees)
+        cropped = crop_region.subimage(stacked)
+        if keep_aspect:
+            for channel in range(channels):
+                out[:, :, channel] = resize_with_aspect(
+                    cropped[:, :, channel],
+                    (frame_size, frame_size),
+                    min_pad=channel == 0,
+                    interpolation=cv2.INTER_NEAREST if channel == MASK else None,
+                )
+        else:
+            # resize_cv treats INTER_NEAREST as unset, so Frame.resize interpolates
+            # the mask linearly like the other channels
+            cv2.resize(
+                np.ascontiguousarray(cropped),
+                dsize=(frame_size, frame_size),
+                dst=out,
+                interpolation=cv2.INTER_LINEAR,
+            )
+
+    thermal = data[:, :, :, 0]
+    if reference_level is not None:
+        thermal -= np.asarray(reference_level)[[i for i, _, _ in transforms]][
+            :, np.newaxis, np.newaxis
+        ]
+        np.clip(thermal, a_min=0, a_max=None, out=thermal)
+    if augment:
+        if level_adjust is not None:
+            thermal += level_adjust
+        if contrast_adjust is not None:
+            data[:, :, :, :2] *= contrast_adjust
+        if flip:
+            data = data[:, :, ::-1]
+    return np.ascontiguousarray(data.transpose(0, 3, 1, 2)), flip
+
+
+def get_segment_augmentation(augment):
+    """Returns the level adjustment, contrast adjustment and flip of a segment"""
+    contrast_adjust = None
+    level_adjust = None
+    flip = False
+    if augment:
+        if random.random() <= 0.75:
+            # we will adjust contrast and levels, but only within these bounds.
+            # that is a bright input may have brightness reduced, but not increased.
+            LEVEL_OFFSET = 4
+
+            # apply level and contrast shift
+            level_adjust = float(random.normalvariate(0, LEVEL_OFFSET))
+            contrast_adjust = float(tools.random_log(0.9, (1 / 0.9)))
+        if random.random() <= 0.50:
+            flip = True
+    return level_adjust, contrast_adjust, flip
+
+
+def get_crop_region(shape, augment, default_inset):
+    """Returns the region to crop a frame of shape to, or None if it is too small"""
+    frame_height, frame_width = shape
+    # adjusting the corners makes the algorithm robust to tracking differences.
+    # gp changed to 0,1 maybe should be a percent of the frame size
+    max_height_offset = int(np.clip(frame_height * 0.1, 1, 2))
+    max_width_offset = int(np.clip(frame_width * 0.1, 1, 2))
+
+    top_offset = random.randint(0, max_height_offset) if augment else default_inset
+    bottom_offset = random.randint(0, max_height_offset) if augment else default_inset
+    left_offset = random.randint(0, max_width_offset) if augment else default_inset
+    right_offset = random.randint(0, max_width_offset) if augment else default_inset
+    if frame_height < MIN_SIZE or frame_width < MIN_SIZE:
+        return None
+
+    frame_bounds = tools.Rectangle(0, 0, frame_width, frame_height)
+    # set up a cropping frame
+    crop_region = tools.Rectangle.from_ltrb(
+        left_offset,
+        top_offset,
+        frame_width - right_offset,
+        frame_height - bottom_offset,
+    )
+
+    # if the frame is too small we make it a little larger
+    while crop_region.width < MIN_SIZE:
+        crop_region.left -= 1
+        crop_region.right += 1
+        crop_region.crop(frame_bounds)
+    while crop_region.height < MIN_SIZE:
+        crop_region.top -= 1
+        crop_region.bottom += 1
+        crop_region.crop(frame_bounds)
+    return crop_region
+
+
+def get_rotation(augment):
+    """Returns degrees to rotate a frame by, or None if it isn't rotated"""
+    if augment and random.random() <= 0.75:
+        return random.randint(0, 40) - 20
+    return None
+
+
 def preprocess_frame(
     data, output_dim, use_thermal=True, augment=False, preprocess_fn=None
 ):
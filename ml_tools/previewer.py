@@ -436,7 +436,7 @@ class Previewer:
 
         thermal = frame.thermal
         filtered = frame.filtered + min_temp
-        mask = frame.mask.copy()
+        mask = np.int32(frame.mask)
         mask[mask > 0] = max_temp
         flow_h, flow_v = frame.get_flow_split(clip_flow=True)
         if flow_h is None and flow_v is None:
@@ -0,0 +1,66 @@
+import collections
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+
+class SegmentCache:
+    """
+    Caches preprocessed segments so segments which aren't augmented are only read and
+    preprocessed once. The most recently used segments are kept in memory up to
+    max_bytes, if cache_dir is set every segment is also saved there and segments
+    which have left memory are read back memory mapped. The directory is emptied when
+    the cache is created, so it can be shared by the processes of one run but isn't
+    reused by the next. Cached segments are read only.
+    """
+
+    EXTENSION = ".npy"
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.segments = collections.OrderedDict()
+        self.nbytes = 0
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            os.makedirs(cache_dir)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + SegmentCache.EXTENSION)
+
+    def get(self, key):
+        """Returns the segment cached as key, or None if it isn't cached"""
+        data = self.segments.get(key)
+        if data is not None:
+            self.segments.move_to_end(key)
+            return data
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def put(self, key, data):
+        data = np.asarray(data)
+        data.flags.writeable = False
+        if self.cache_dir is not None:
+            path = self._path(key)
+            # other processes may be reading the cache so replace the file whole
+            temp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(temp_path, "wb") as f:
+                np.save(f, data)
+            os.replace(temp_path, path)
+        if data.nbytes > self.max_bytes:
+            return
+        old = self.segments.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.segments[key] = data
+        self.nbytes += data.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self.segments.popitem(last=False)
+            self.nbytes -= old.nbytes
@@ -0,0 +1,72 @@
+import time
+import types
+
+import numpy as np
+import pytest
+
+from ml_tools.aliassampler import AliasSampler, AliasTable
+from ml_tools.dataset import Dataset
+
+
+class FakeSegment:
+    def __init__(self, label, weight):
+        self.label = label
+        self.weight = weight
+        self.track = types.SimpleNamespace(label=label)
+
+
+class TestAliasSampler:
+    def test_table_distribution(self):
+        rng = np.random.default_rng(0)
+        for _ in range(100):
+            weights = rng.random(rng.integers(1, 50)) ** rng.integers(1, 6)
+            weights[rng.integers(0, len(weights), len(weights) // 3)] = 0
+            if weights.sum() == 0:
+                continue
+            table = AliasTable(weights)
+            # each column keeps probability of its item, the rest is its alias's
+            distribution = table.probability.copy()
+            np.add.at(distribution, table.alias, 1 - table.probability)
+            assert np.allclose(distribution / len(weights), weights / weights.sum())
+
+    def test_empty_table(self):
+        with pytest.raises(ValueError):
+            AliasTable([0, 0])
+
+    def test_remove_group(self):
+        np.random.seed(1)
+        items = ["a1", "a2", "b1", "c1"]
+        sampler = AliasSampler(items, [1, 3, 4, 0], ["a", "a", "b", "c"])
+        drawn = sampler.sample(40000)
+        assert "c1" not in drawn
+        assert abs(drawn.count("a2") / len(drawn) - 3 / 8) < 0.01
+
+        sampler.remove_group("b")
+        drawn = sampler.sample(40000)
+        assert set(drawn) == {"a1", "a2"}
+        assert abs(drawn.count("a2") / len(drawn) - 3 / 4) < 0.01
+
+        sampler.remove_group("a")
+        assert sampler.sample(10) == []
+
+    def test_dataset_sampling(self):
+        dataset = Dataset(None)
+        dataset.segments = [FakeSegment("cat", 1.0) for _ in range(100000)]
+        dataset.segments += [FakeSegment("dog", 2.0) for _ in range(100000)]
+        weights = np.float64([segment.weight for segment in dataset.segments])
+        start = time.time()
+        np.random.choice(dataset.segments, 32, p=weights / weights.sum())
+        choice = time.time() - start
+        dataset.rebuild_segment_cdf()
+        start = time.time()
+        segments = dataset.sample_segments(32)
+        print(
+            "batch of 32 from {} segments cdf {:.1f}ms alias {:.1f}ms".format(
+                len(dataset.segments), choice * 1000, (time.time() - start) * 1000
+            )
+        )
+        assert len(segments) == 32
+
+        dataset.labels = ["cat", "dog"]
+        dataset.remove_label("dog")
+        assert {segment.label for segment in dataset.sample_segments(1000)} == {"cat"}
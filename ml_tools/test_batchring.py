@@ -0,0 +1,100 @@
+import multiprocessing
+import time
+import types
+
+import numpy as np
+import pytest
+
+from ml_tools.batchring import BatchRing
+from ml_tools.dataset import Dataset
+
+SEGMENT_SHAPE = (27, 5, 48, 48)
+
+
+def fill(batch_ring, batches):
+    for i in range(batches):
+        X = np.full((batch_ring.batch_size,) + SEGMENT_SHAPE, i, dtype=np.float16)
+        batch_ring.put(X, np.full(batch_ring.batch_size, i, dtype=np.int32))
+
+
+def fill_queue(q, batch_size, batches):
+    for i in range(batches):
+        X = np.full((batch_size,) + SEGMENT_SHAPE, i, dtype=np.float16)
+        q.put((X, np.full(batch_size, i, dtype=np.int32)))
+
+
+class CountingDataset(Dataset):
+    """Loads segments whose data is the number of segments loaded before them"""
+
+    def __init__(self):
+        super().__init__(None)
+        self.labels = ["a"]
+        self.loaded = 0
+
+    def sample_segments(self, n):
+        return [types.SimpleNamespace(label="a", clip_id="clip") for _ in range(n)]
+
+    def fetch_segments(self, segments, augment=False):
+        data = []
+        for _ in segments:
+            data.append(np.full((3, 2, 4, 4), self.loaded, dtype=np.float32))
+            self.loaded += 1
+        return data
+
+
+class TestBatchRing:
+    def test_batches_from_process(self):
+        batch_ring = BatchRing(3, 4, SEGMENT_SHAPE, np.float16, np.int32)
+        loader = multiprocessing.Process(target=fill, args=(batch_ring, 10))
+        loader.start()
+        for i in range(10):
+            X, y = batch_ring.next_batch()
+            assert X.shape == (4,) + SEGMENT_SHAPE
+            assert np.all(X == i) and np.all(y == i)
+        loader.join()
+
+    def test_faster_than_queue(self):
+        batch_size = 32
+        timings = []
+        batch_ring = BatchRing(3, batch_size, SEGMENT_SHAPE, np.float16, np.int32)
+        q = multiprocessing.Queue(3)
+        for target, args, get in (
+            (fill_queue, (q, batch_size, 20), q.get),
+            (fill, (batch_ring, 20), batch_ring.next_batch),
+        ):
+            loader = multiprocessing.Process(target=target, args=args)
+            loader.start()
+            start = time.time()
+            for i in range(20):
+                X, y = get()
+                assert X.shape == (batch_size,) + SEGMENT_SHAPE and np.all(y == i)
+            timings.append(time.time() - start)
+            loader.join()
+        print(
+            "batch of {} queue {:.1f}ms shared memory {:.1f}ms".format(
+                batch_size, timings[0] * 50, timings[1] * 50
+            )
+        )
+
+    def test_dataset_async_batches(self):
+        dataset = CountingDataset()
+        dataset.WORKER_THREADS = 1
+        dataset.start_async_load(8, batch_size=4)
+        try:
+            X, y = dataset.next_batch(4)
+            assert X.shape == (4, 3, 2, 4, 4) and X.dtype == np.float16
+            assert [X[i, 0, 0, 0, 0] for i in range(4)] == [0, 1, 2, 3]
+            X, y = dataset.next_batch(6)
+            assert X.shape[0] == 6 and np.all(y == 0)
+            # rows left over from the last batch are returned first
+            X, y = dataset.next_batch(4)
+            assert [X[i, 0, 0, 0, 0] for i in range(4)] == [10, 11, 12, 13]
+            X, y = dataset.next_batch(2)
+            assert [X[i, 0, 0, 0, 0] for i in range(2)] == [14, 15]
+        finally:
+            dataset.stop_async_load()
+        assert dataset.batch_ring is None
+
+    def test_invalid_slots(self):
+        with pytest.raises(ValueError):
+            BatchRing(0, 4, SEGMENT_SHAPE, np.float16, np.int32)
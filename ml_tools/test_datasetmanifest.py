@@ -0,0 +1,138 @@
+import datetime
+import pickle
+import time
+
+import numpy as np
+import pytz
+
+from ml_tools.dataset import Dataset, load_datasets, save_datasets
+from ml_tools.datasetstructures import TrackHeader
+from ml_tools.trackdatabase import TrackDatabase
+
+
+def make_track(rng, clip_id, track_id, label, num_frames=40):
+    left, top = rng.integers(0, 100, 2)
+    bounds = [
+        (left + i, top, left + i + 20, top + rng.integers(10, 30))
+        for i in range(num_frames)
+    ]
+    mass_history = rng.integers(20, 200, num_frames)
+    track = TrackHeader(
+        clip_id=clip_id,
+        track_id=track_id,
+        label=label,
+        start_time=datetime.datetime(2021, 3, 4, 5, 6, 7, tzinfo=pytz.utc),
+        num_frames=num_frames,
+        duration=num_frames / 9,
+        camera="camera{}".format(clip_id % 3),
+        location=np.array([-36.0, 174.5]),
+        score=0.9,
+        track_bounds=np.array(bounds),
+        frame_temp_median=np.float32(rng.normal(3000, 10, num_frames)),
+        frames_per_second=9,
+        predictions=rng.random((num_frames, 3)) if track_id % 2 else None,
+        correct_prediction=None,
+        frame_mass=mass_history,
+        start_frame=0,
+        ffc_frames=[1, 2] if track_id % 3 else [],
+        important_frames=list(range(0, num_frames, 2)),
+    )
+    track.calculate_segments(
+        mass_history, 9, 27, use_important=bool(track_id % 2), require_movement=False
+    )
+    return track
+
+
+def make_datasets(db, tracks_per_label):
+    rng = np.random.default_rng(4)
+    datasets = (Dataset(db, "train"), Dataset(db, "validation"))
+    for i in range(tracks_per_label * 2):
+        tracks = [
+            make_track(rng, i, i * 2 + j, label)
+            for j, label in enumerate(("cat", "dog"))
+        ]
+        datasets[i % 2].add_tracks(tracks)
+    for dataset in datasets:
+        dataset.balance_bins()
+    return datasets
+
+
+def assert_same(value, expected):
+    if isinstance(expected, np.ndarray):
+        assert np.array_equal(value, expected)
+    elif isinstance(expected, dict):
+        assert value.keys() == expected.keys()
+        for key in expected:
+            assert_same(value[key], expected[key])
+    else:
+        assert value == expected
+
+
+class TestDatasetManifest:
+    def test_round_trip(self, tmp_path):
+        db = TrackDatabase(str(tmp_path / "dataset.hdf5"))
+        datasets = make_datasets(db, 20)
+        save_datasets(datasets, str(tmp_path / "datasets"))
+        loaded = load_datasets(str(tmp_path / "datasets"))
+
+        for dataset, expected in zip(loaded, datasets):
+            assert dataset.name == expected.name
+            assert dataset.labels == expected.labels
+            assert len(dataset.segments) == len(expected.segments)
+            assert dataset.manifest.created_tracks == {}
+
+            segments = dataset.sample_segments(4)
+            assert len(dataset.manifest.created_tracks) <= 4
+            assert all(segment.track.segments for segment in segments)
+
+            for track, expected_track in zip(dataset.tracks, expected.tracks):
+                for name, value in expected_track.__dict__.items():
+                    if name == "segments":
+                        continue
+                    if name == "sample_frames":
+                        assert [frame.frame_num for frame in track.sample_frames] == [
+                            frame.frame_num for frame in value
+                        ]
+                        continue
+                    assert_same(getattr(track, name), value)
+            for segment, expected_segment in zip(dataset.segments, expected.segments):
+                assert segment.track.unique_id == expected_segment.track.unique_id
+                for name, value in expected_segment.__dict__.items():
+                    if name != "track":
+                        assert_same(getattr(segment, name), value)
+            for label in expected.labels:
+                assert dataset.get_counts(label) == expected.get_counts(label)
+
+    def test_remove_label(self, tmp_path):
+        db = TrackDatabase(str(tmp_path / "dataset.hdf5"))
+        save_datasets(make_datasets(db, 5), str(tmp_path / "datasets"))
+        train, _ = load_datasets(str(tmp_path / "datasets"))
+        train.sample_segments(1)
+        train.remove_label("dog")
+        assert {segment.label for segment in train.sample_segments(100)} == {"cat"}
+        assert all(segment.label == "cat" for segment in train.segments)
+
+        # unpickled datasets map their manifest again
+        train = pickle.loads(pickle.dumps(train))
+        assert train.manifest.created_tracks == {}
+        assert {segment.label for segment in train.sample_segments(100)} == {"cat"}
+
+    def test_faster_than_pickle(self, tmp_path):
+        db = TrackDatabase(str(tmp_path / "dataset.hdf5"))
+        datasets = make_datasets(db, 500)
+        save_datasets(datasets, str(tmp_path / "datasets"))
+        pickled = str(tmp_path / "datasets.dat")
+        with open(pickled, "wb") as f:
+            pickle.dump(datasets, f)
+        timings = []
+        for path in (pickled, str(tmp_path / "datasets")):
+            start = time.time()
+            load_datasets(path)[0].sample_segments(32)
+            timings.append(time.time() - start)
+        print(
+            "{} tracks pickle {:.1f}ms manifest {:.1f}ms".format(
+                sum(len(dataset.tracks) for dataset in datasets),
+                timings[0] * 1000,
+                timings[1] * 1000,
+            )
+        )
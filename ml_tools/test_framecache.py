@@ -0,0 +1,160 @@
+import os
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from ml_tools.frame import Frame
+from ml_tools.framecache import FrameCache
+from ml_tools.memmapframecache import MemmapFrameCache
+from ml_tools.tools import get_clipped_flow
+
+
+def make_frame(rng, frame_number, flow=True, shape=(120, 160)):
+    frame = Frame(
+        rng.integers(2800, 3500, shape).astype(np.uint16),
+        rng.integers(0, 256, shape).astype(np.uint8),
+        rng.integers(0, 300, shape).astype(np.int32),
+        frame_number,
+        ffc_affected=frame_number % 2 == 0,
+    )
+    if flow:
+        frame.flow = rng.normal(0, 2, shape + (2,)).astype(np.float32)
+    return frame
+
+
+def assert_frames_equal(expected, frame):
+    assert np.array_equal(expected.thermal, frame.thermal)
+    assert np.array_equal(expected.filtered, frame.filtered)
+    assert np.array_equal(expected.mask, frame.mask)
+    if expected.flow is None:
+        assert frame.flow is None
+    else:
+        assert np.array_equal(expected.flow, frame.flow)
+    assert expected.frame_number == frame.frame_number
+    assert expected.ffc_affected == frame.ffc_affected
+
+
+class GroupFrameCache:
+    """The previous cache layout, a group holding five float32 planes per frame"""
+
+    def __init__(self, filename):
+        self.db = h5py.File(filename, "w")
+        self.db.create_group("frames")
+
+    def add_frame(self, frame):
+        frame_group = self.db["frames"].create_group(str(frame.frame_number))
+        frame_group.attrs["ffc_affected"] = frame.ffc_affected
+        height, width = frame.thermal.shape
+        frame_node = frame_group.create_dataset(
+            "frame", (5, height, width), chunks=(1, height, width), dtype=np.float32
+        )
+        flow = get_clipped_flow(frame.flow)
+        frame_node[:, :, :] = (
+            np.float32(frame.thermal),
+            np.float32(frame.filtered),
+            np.float32(flow[:, :, 0]),
+            np.float32(flow[:, :, 1]),
+            np.float32(frame.mask),
+        )
+
+    def get_frame(self, frame_number):
+        frame_group = self.db["frames"][str(frame_number)]
+        return frame_group["frame"][()], frame_group.attrs["ffc_affected"]
+
+
+def assert_cached(cache, frames):
+    for frame in frames:
+        channels, ffc_affected = cache.get_frame(frame.frame_number)
+        restored = Frame.from_array(
+            channels, frame.frame_number, ffc_affected=ffc_affected
+        )
+        # flow is cached clipped
+        expected = frame.copy()
+        if expected.flow is not None:
+            expected.flow = get_clipped_flow(expected.flow)
+        assert_frames_equal(expected, restored)
+
+
+def time_cache(cache, frames, read_order):
+    start = time.time()
+    for frame in frames:
+        cache.add_frame(frame)
+    write_time = time.time() - start
+    start = time.time()
+    for frame_number in read_order:
+        cache.get_frame(frame_number)
+    return write_time, time.time() - start
+
+
+class TestFrameCache:
+    def test_compact(self):
+        rng = np.random.default_rng(0)
+        frame = make_frame(rng, 0)
+        compact = frame.copy()
+        compact.compact()
+        assert compact.thermal.dtype == np.uint16
+        assert compact.filtered.dtype == np.uint8
+        assert compact.mask.dtype == np.uint16
+        assert compact.nbytes < frame.nbytes
+        assert_frames_equal(frame, compact)
+        channels = [
+            compact.thermal,
+            compact.filtered,
+            compact.flow_h,
+            compact.flow_v,
+            compact.mask,
+        ]
+        restored = Frame.from_array(channels, 0, ffc_affected=True)
+        assert_frames_equal(compact, restored)
+        assert np.array_equal(frame.flow, restored.flow)
+
+        frame.mask[:] = 1
+        frame.flow = None
+        compact = frame.copy()
+        compact.compact()
+        assert compact.mask.dtype == np.uint8
+        channels = [compact.thermal, compact.filtered, compact.mask]
+        restored = Frame.from_array(channels, 0, ffc_affected=True)
+        assert_frames_equal(compact, restored)
+        assert restored.flow is None
+
+    @pytest.mark.parametrize("cache_class", [FrameCache, MemmapFrameCache])
+    def test_cache_round_trip(self, tmp_path, cache_class):
+        rng = np.random.default_rng(1)
+        cache = cache_class(str(tmp_path / "clip.cptv"))
+        frames = [make_frame(rng, i, flow=i < 3) for i in range(100)]
+        # later frames need a wider mask type than the first
+        frames[0].mask[:] = 1
+        for frame in frames:
+            cache.add_frame(frame)
+        assert_cached(cache, frames)
+        assert cache.get_frame(len(frames)) == (None, False)
+
+        cache.close()
+        assert_cached(cache_class(cache.filename, delete_if_exists=False), frames)
+        cache.delete()
+        assert not os.path.exists(cache.filename)
+
+    def test_layout_speed(self, tmp_path):
+        rng = np.random.default_rng(2)
+        frames = [make_frame(rng, i) for i in range(500)]
+        read_order = rng.permutation(len(frames))
+        group_cache = GroupFrameCache(str(tmp_path / "group.cache"))
+        group_write, group_read = time_cache(group_cache, frames, read_order)
+        group_cache.db.close()
+        print(
+            "{} frames group per frame write {:.0f} read {:.0f} frames/s".format(
+                len(frames), len(frames) / group_write, len(frames) / group_read
+            )
+        )
+        for cache_class in (FrameCache, MemmapFrameCache):
+            cache = cache_class(str(tmp_path / "clip.cptv"))
+            write, read = time_cache(cache, frames, read_order)
+            cache.delete()
+            print(
+                "{} write {:.0f} read {:.0f} frames/s".format(
+                    cache_class.__name__, len(frames) / write, len(frames) / read
+                )
+            )
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from ml_tools.framering import FrameRing
+from ml_tools.test_framecache import assert_frames_equal, make_frame
+from track.framebuffer import FrameBuffer
+
+SHAPE = (12, 16)
+
+
+class TestFrameRing:
+    def test_keeps_recent_frames(self):
+        rng = np.random.default_rng(0)
+        ring = FrameRing(4)
+        frames = [make_frame(rng, i, flow=i > 2, shape=SHAPE) for i in range(10)]
+        for frame in frames:
+            ring.add_frame(frame)
+        assert len(ring) == 4
+        for frame in frames[:6]:
+            assert ring.get_frame(frame.frame_number) is None
+        for frame in frames[6:]:
+            assert_frames_equal(frame, ring.get_frame(frame.frame_number))
+        assert_frames_equal(frames[-1], ring.get_last_frame())
+
+    def test_pinned_frames_kept_until_unpinned(self):
+        rng = np.random.default_rng(1)
+        ring = FrameRing(3)
+        frames = [make_frame(rng, i, shape=SHAPE) for i in range(12)]
+        for frame in frames[:3]:
+            ring.add_frame(frame)
+        ring.pin("a", 2)
+        for frame in frames[3:6]:
+            ring.add_frame(frame)
+        ring.pin("b", 5)
+        for frame in frames[6:]:
+            ring.add_frame(frame)
+
+        assert ring.get_frame(1) is None
+        for frame in frames[2:]:
+            assert_frames_equal(frame, ring.get_frame(frame.frame_number))
+        ring.unpin("a")
+        assert ring.get_frame(4) is None
+        for frame in frames[5:]:
+            assert_frames_equal(frame, ring.get_frame(frame.frame_number))
+        ring.unpin("b")
+        assert len(ring) == 3
+
+    def test_frame_buffer_ring(self):
+        rng = np.random.default_rng(2)
+        buffer = FrameBuffer("clip.cptv", False, False, False, True, ring_capacity=2)
+        frames = [make_frame(rng, i, flow=False, shape=SHAPE) for i in range(5)]
+        buffer.pin(1, 0)
+        for frame in frames:
+            buffer.store_frame(frame)
+        assert len(buffer.frames) == 0
+        for frame in frames:
+            assert_frames_equal(frame, buffer.get_frame(frame.frame_number))
+        buffer.unpin(1)
+        assert buffer.get_frame(0) is None
+        assert buffer.get_last_frame() is frames[-1]
+
+    def test_invalid_capacity(self):
+        with pytest.raises(ValueError):
+            FrameRing(0)
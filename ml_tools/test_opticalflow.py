@@ -0,0 +1,64 @@
+import numpy as np
+
+from ml_tools.frame import Frame, get_flow_regions
+from ml_tools.tools import get_optical_flow_function
+
+
+def blob_frame(x, y, frame_number):
+    rows, cols = np.mgrid[0:120, 0:160]
+    blob = np.exp(-((cols - x) ** 2 + (rows - y) ** 2) / 40.0)
+    return Frame(
+        np.uint16(3000 + 500 * blob),
+        np.uint8(255 * blob),
+        np.int32(blob > 0.1),
+        frame_number,
+    )
+
+
+class TestOpticalFlow:
+    def test_regions_cover_objects(self):
+        mask = np.zeros((120, 160), dtype=np.int32)
+        mask[10:20, 10:20] = 1
+        mask[22:25, 22:25] = 2
+        prev_mask = np.zeros_like(mask)
+        prev_mask[100:110, 150:160] = 1
+        regions = get_flow_regions((prev_mask, mask), 4)
+        # the first two objects are close enough to be merged
+        assert regions == [np.s_[6:29, 6:29], np.s_[96:114, 146:160]]
+
+        covered = np.zeros(mask.shape, dtype=int)
+        for region in regions:
+            covered[region] += 1
+        assert covered.max() == 1
+        assert np.all(covered[(mask > 0) | (prev_mask > 0)] == 1)
+
+    def test_region_flow(self):
+        opt_flow = get_optical_flow_function()
+        prev_frame = blob_frame(50, 60, 0)
+        prev_frame.generate_optical_flow(opt_flow, None, region_padding=8)
+        frame = blob_frame(52, 61, 1)
+        frame.generate_optical_flow(opt_flow, prev_frame, region_padding=8)
+        mean_flow = frame.flow[frame.mask > 0].mean(axis=0)
+        assert np.allclose(mean_flow, (2, 1), atol=0.25)
+        regions = get_flow_regions((prev_frame.mask, frame.mask), 8)
+        outside = np.ones(frame.mask.shape, dtype=bool)
+        for region in regions:
+            outside[region] = False
+        assert np.all(frame.flow[outside] == 0)
+
+    def test_lazy_flow(self):
+        opt_flow = get_optical_flow_function()
+        eager = [blob_frame(50 + i, 60, i) for i in range(3)]
+        lazy = [blob_frame(50 + i, 60, i) for i in range(3)]
+        for i in range(3):
+            prev = eager[i - 1] if i > 0 else None
+            eager[i].generate_optical_flow(opt_flow, prev)
+            prev = lazy[i - 1] if i > 0 else None
+            lazy[i].generate_optical_flow(opt_flow, prev, lazy=True)
+        assert all(frame.lazy_flow is not None for frame in lazy)
+        # flow is calculated once, in any order
+        for i in (2, 0, 1):
+            copy = lazy[i].copy()
+            assert np.array_equal(eager[i].flow, lazy[i].flow)
+            assert lazy[i].lazy_flow is None
+            assert np.array_equal(eager[i].flow, copy.flow)
@@ -0,0 +1,68 @@
+import random
+
+import numpy as np
+import pytest
+
+from ml_tools.frame import Frame
+from ml_tools.preprocess import preprocess_segment, preprocess_segment_array
+
+
+def make_frames(rng, num_frames, flow=True):
+    frames = []
+    for frame_number in range(num_frames):
+        height, width = rng.integers(2, 40, 2)
+        frames.append(
+            Frame(
+                rng.integers(2800, 3500, (height, width)).astype(np.uint16),
+                rng.normal(0, 30, (height, width)).astype(np.float32),
+                rng.integers(0, 3, (height, width)).astype(np.uint8),
+                frame_number,
+                flow=(
+                    rng.normal(0, 600, (height, width, 2)).astype(np.float32)
+                    if flow
+                    else None
+                ),
+            )
+        )
+    return frames
+
+
+def preprocess_frames(frames, seed, **kwargs):
+    random.seed(seed)
+    frames = [frame.copy() for frame in frames]
+    data, flip = preprocess_segment(frames, **kwargs)
+    return np.asarray([frame.as_array() for frame in data]), flip
+
+
+def preprocess_stacked(frames, seed, **kwargs):
+    random.seed(seed)
+    return preprocess_segment_array(frames, **kwargs)
+
+
+class TestPreprocessSegmentArray:
+    @pytest.mark.parametrize("augment", [False, True])
+    @pytest.mark.parametrize("keep_aspect", [False, True])
+    @pytest.mark.parametrize("flow", [False, True])
+    def test_same_as_frames(self, augment, keep_aspect, flow):
+        rng = np.random.default_rng(3)
+        frames = make_frames(rng, 27, flow)
+        reference_level = rng.integers(2900, 3100, 27)
+        for seed in range(4):
+            expected, expected_flip = preprocess_frames(
+                frames,
+                seed,
+                reference_level=reference_level,
+                augment=augment,
+                keep_aspect=keep_aspect,
+            )
+            data, flip = preprocess_stacked(
+                frames,
+                seed,
+                reference_level=reference_level,
+                augment=augment,
+                keep_aspect=keep_aspect,
+            )
+            assert flip == expected_flip
+            assert data.shape == expected.shape and data.dtype == np.float32
+            # resizing the channels together only changes float rounding
+            assert np.allclose(data, expected, atol=1e-2)
@@ -0,0 +1,93 @@
+import time
+import types
+
+import numpy as np
+import pytest
+
+from ml_tools.dataset import Dataset
+from ml_tools.segmentcache import SegmentCache
+from ml_tools.test_trackdatabase import add_track, make_track
+from ml_tools.trackdatabase import TrackDatabase
+
+
+def make_segments(db, num_segments):
+    rng = np.random.default_rng(5)
+    track, cropped_data, original = make_track(rng, 100)
+    add_track(db.database, "clip", track, cropped_data, original)
+    track_header = types.SimpleNamespace(
+        frames_per_second=9,
+        frames=100,
+        frame_temp_median=np.full(100, 3000.0),
+        frame_velocity=[(0, 0)] * 100,
+    )
+    return [
+        types.SimpleNamespace(
+            clip_id="clip",
+            track_number=track.get_id(),
+            frames=27,
+            start_frame=start,
+            label="cat",
+            track=track_header,
+        )
+        for start in range(0, 70, 70 // num_segments)
+    ]
+
+
+class TestSegmentCache:
+    def test_least_recently_used(self):
+        segment = np.ones((27, 5, 48, 48), dtype=np.float32)
+        cache = SegmentCache(segment.nbytes * 2)
+        for key in ("a", "b"):
+            cache.put(key, segment.copy())
+        cache.get("a")
+        cache.put("c", segment.copy())
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("c") is not None
+        assert cache.nbytes == segment.nbytes * 2
+        with pytest.raises(ValueError):
+            cache.get("a")[0] = 0
+
+    def test_disk_tier(self, tmp_path):
+        segments = [np.full((27, 5, 48, 48), i, dtype=np.float32) for i in range(3)]
+        cache = SegmentCache(segments[0].nbytes, str(tmp_path / "cache"))
+        for i, segment in enumerate(segments):
+            cache.put(str(i), segment)
+        for i, segment in enumerate(segments):
+            assert np.array_equal(cache.get(str(i)), segment)
+        assert isinstance(cache.get("0"), np.memmap)
+        assert len(list((tmp_path / "cache").iterdir())) == 3
+
+        # a new cache doesn't reuse the files
+        cache = SegmentCache(segments[0].nbytes, str(tmp_path / "cache"))
+        assert cache.get("0") is None
+
+    def test_dataset_cache(self, tmp_path):
+        db = TrackDatabase(str(tmp_path / "dataset.hdf5"))
+        segments = make_segments(db, 10)
+        dataset = Dataset(db)
+        expected = dataset.fetch_segments(segments)
+
+        dataset.enable_segment_cache(1024 * 1024 * 1024)
+        start = time.time()
+        assert all(
+            np.array_equal(data, expected_data)
+            for data, expected_data in zip(dataset.fetch_segments(segments), expected)
+        )
+        first = time.time() - start
+        get_segments = db.get_segments
+        db.get_segments = None
+        start = time.time()
+        cached = dataset.fetch_segments(segments)
+        print(
+            "{} segments uncached {:.1f}ms cached {:.1f}ms".format(
+                len(segments), first * 1000, (time.time() - start) * 1000
+            )
+        )
+        assert all(
+            np.array_equal(data, expected_data)
+            for data, expected_data in zip(cached, expected)
+        )
+
+        # augmented segments are always fetched
+        db.get_segments = get_segments
+        assert len(dataset.fetch_segments(segments[:2], augment=True)) == 2
@@ -0,0 +1,353 @@
+import datetime
+import os
+import pickle
+import time
+
+import h5py
+import numpy as np
+from dateutil.parser import parse as parse_date
+
+from migratedatabase import migrate
+from ml_tools.frame import Frame
+from ml_tools.trackdatabase import (
+    TrackDatabase,
+    read_track_frames,
+    write_track_frames,
+)
+from ml_tools.trackindex import TrackIndex
+from track.region import Region
+from track.track import Track
+
+
+def make_track(rng, num_frames):
+    track = Track("1")
+    track.start_frame = 0
+    cropped_data = []
+    original = []
+    for frame_number in range(num_frames):
+        width, height = rng.integers(4, 40, 2)
+        track.add_region(Region(10, 10, width, height, frame_number=frame_number))
+        cropped = Frame(
+            rng.integers(2800, 3500, (height, width)).astype(np.uint16),
+            rng.normal(0, 30, (height, width)).astype(np.float32),
+            rng.integers(0, 3, (height, width)).astype(np.uint8),
+            frame_number,
+            flow=rng.normal(0, 600, (height, width, 2)).astype(np.float32),
+        )
+        cropped_data.append(cropped)
+        original.append(rng.integers(2800, 3500, (120, 160)).astype(np.uint16))
+    return track, cropped_data, original
+
+
+def write_frame_datasets(db_name, clip_id, track, cropped_data, original):
+    """Writes a track in the previous layout with a dataset per frame"""
+    with h5py.File(db_name, "a") as f:
+        track_node = f["clips"].require_group(clip_id).create_group(str(track.get_id()))
+        track_node.attrs["frames"] = len(cropped_data)
+        track_node.create_dataset("overlay", data=np.ones((120, 160), np.float32))
+        cropped_node = track_node.create_group("cropped")
+        original_node = track_node.create_group("original")
+        for i, (cropped, thermal) in enumerate(zip(cropped_data, original)):
+            frame_node = cropped_node.create_dataset(
+                str(i),
+                (cropped.channels,) + cropped.shape,
+                chunks=(1,) + cropped.shape,
+                dtype=np.int16,
+            )
+            frame_node[:, :, :] = cropped.as_array()
+            thermal_node = original_node.create_dataset(
+                str(i), thermal.shape, chunks=thermal.shape, dtype=np.int16
+            )
+            thermal_node[:, :] = thermal
+
+
+def add_track(db_name, clip_id, track, cropped_data, original):
+    with h5py.File(db_name, "a") as f:
+        f["clips"].require_group(clip_id)
+    TrackDatabase(db_name).add_track(
+        clip_id,
+        track,
+        cropped_data,
+        np.ones((120, 160), np.float32),
+        [],
+        original_thermal=original,
+    )
+
+
+def assert_same_frames(frames, expected):
+    assert len(frames) == len(expected)
+    for frame, expected_frame in zip(frames, expected):
+        assert frame.frame_number == expected_frame.frame_number
+        assert np.array_equal(frame.thermal, expected_frame.thermal)
+        assert np.array_equal(frame.filtered, expected_frame.filtered)
+        assert np.array_equal(frame.mask, expected_frame.mask)
+        assert np.array_equal(frame.flow, expected_frame.flow)
+
+
+def assert_same_tracks(db, expected_db, track_id):
+    for kwargs in (
+        {},
+        {"start_frame": 3, "end_frame": 9},
+        {"frame_numbers": [7, 2, 11]},
+        {"original": True, "start_frame": 1, "end_frame": 4},
+    ):
+        assert_same_frames(
+            db.get_track("clip", track_id, **kwargs),
+            expected_db.get_track("clip", track_id, **kwargs),
+        )
+    assert_same_frames(
+        [db.get_frame("clip", track_id, 5)],
+        [expected_db.get_frame("clip", track_id, 5)],
+    )
+
+
+def write_clip(db_name, clip_id, start_time, finished=True):
+    with h5py.File(db_name, "a") as f:
+        clip_node = f["clips"].create_group(clip_id)
+        clip_node.create_dataset("background_frame", data=np.zeros((120, 160)))
+        clip_node.attrs["start_time"] = start_time.isoformat()
+        clip_node.attrs["device"] = "device-" + clip_id
+        if finished:
+            clip_node.attrs["finished"] = True
+
+
+def walk_track_ids(db_name, before_date=None, after_date=None):
+    """Finds track ids by reading every clip of the database"""
+    result = []
+    with h5py.File(db_name, "r") as f:
+        for clip_id, clip in f["clips"].items():
+            if not clip.attrs.get("finished"):
+                continue
+            date = parse_date(clip.attrs["start_time"])
+            if before_date and date >= before_date:
+                continue
+            if after_date and date < after_date:
+                continue
+            result.extend(
+                (clip_id, track) for track in clip if track != "background_frame"
+            )
+    return result
+
+
+def assert_index_matches(db):
+    start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    for dates in (
+        {},
+        {"before_date": start + datetime.timedelta(days=2)},
+        {"after_date": start + datetime.timedelta(days=1)},
+    ):
+        assert db.get_all_track_ids(**dates) == walk_track_ids(db.database, **dates)
+    with h5py.File(db.database, "r") as f:
+        clips = f["clips"]
+        assert db.get_all_clip_ids() == {
+            clip_id: list(clip) for clip_id, clip in clips.items()
+        }
+        assert db.latest_date() == max(
+            clip.attrs["start_time"] for clip in clips.values()
+        )
+        for clip_id, clip in clips.items():
+            assert db.has_clip(clip_id) == ("finished" in clip.attrs)
+            meta = db.get_clip_meta(clip_id)
+            assert meta.pop("tracks") == len(clip)
+            assert meta == dict(clip.attrs)
+            for track_id in clip:
+                if track_id == "background_frame":
+                    continue
+                track_meta = db.get_track_meta(clip_id, track_id)
+                expected = dict(clip[track_id].attrs)
+                expected["id"] = track_id
+                assert track_meta.keys() == expected.keys()
+                for key, value in expected.items():
+                    np.testing.assert_equal(track_meta[key], value)
+                assert np.array_equal(
+                    db.get_track_predictions(clip_id, track_id),
+                    (
+                        clip[track_id]["predictions"][()]
+                        if "predictions" in clip[track_id]
+                        else None
+                    ),
+                )
+
+
+class TestTrackDatabase:
+    def test_index(self, tmp_path):
+        rng = np.random.default_rng(2)
+        db_name = str(tmp_path / "dataset.hdf5")
+        TrackDatabase(db_name)
+        start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        for day in range(4):
+            write_clip(
+                db_name, str(day), start + datetime.timedelta(days=day), day != 3
+            )
+        # written without the index so it must be rebuilt
+        TrackIndex(db_name).delete()
+        db = TrackDatabase(db_name)
+        db.set_labels(["cat", "possum"])
+        for clip_id in ("0", "2"):
+            for _ in range(3):
+                track, cropped_data, original = make_track(rng, 5)
+                track.tag = "cat"
+                track.predictions = np.int16(rng.integers(0, 100, (5, 2)))
+                track.predicted_tag = "possum"
+                track.predicted_confidence = 80
+                add_track(db_name, clip_id, track, cropped_data, original)
+        assert db.get_labels().tolist() == ["cat", "possum"]
+        assert db.has_prediction("0") and not db.has_prediction("1")
+        assert_index_matches(db)
+        db.remove_clip("2")
+        assert_index_matches(db)
+
+        TrackIndex(db_name).delete()
+        rebuilt = TrackDatabase(db_name)
+        assert rebuilt.get_labels().tolist() == ["cat", "possum"]
+        assert_index_matches(rebuilt)
+
+    def test_merge_shards(self, tmp_path):
+        rng = np.random.default_rng(3)
+        db_name = str(tmp_path / "dataset.hdf5")
+        db = TrackDatabase(db_name)
+        start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        write_clip(db_name, "1", start)
+        TrackIndex(db_name).delete()
+        db = TrackDatabase(db_name)
+        expected = {}
+        for shard, clip_ids in enumerate((["0", "1"], ["2"])):
+            shard_db = TrackDatabase(db.get_shard_filename(shard), use_lock=False)
+            for day, clip_id in enumerate(clip_ids):
+                write_clip(
+                    shard_db.database, clip_id, start + datetime.timedelta(days=day)
+                )
+                track, cropped_data, original = make_track(rng, 6)
+                add_track(shard_db.database, clip_id, track, cropped_data, original)
+                expected[clip_id] = (
+                    track.get_id(),
+                    shard_db.get_track(clip_id, track.get_id()),
+                )
+        assert len(db.get_shard_filenames()) == 2
+
+        assert db.merge_shards() == 3
+        assert db.get_shard_filenames() == []
+        assert not list(tmp_path.glob("*.shard-*"))
+        assert_index_matches(db)
+        for clip_id, (track_id, frames) in expected.items():
+            assert_same_frames(db.get_track(clip_id, track_id), frames)
+
+    def test_layouts_match(self, tmp_path):
+        rng = np.random.default_rng(0)
+        track, cropped_data, original = make_track(rng, 12)
+        old_db = TrackDatabase(str(tmp_path / "old.hdf5"))
+        write_frame_datasets(old_db.database, "clip", track, cropped_data, original)
+        db = TrackDatabase(str(tmp_path / "new.hdf5"))
+        add_track(db.database, "clip", track, cropped_data, original)
+        assert_same_tracks(db, old_db, track.get_id())
+
+        migrate(old_db.database, str(tmp_path / "migrated.hdf5"))
+        migrated = TrackDatabase(str(tmp_path / "migrated.hdf5"))
+        assert_same_tracks(migrated, old_db, track.get_id())
+        with h5py.File(migrated.database, "r") as f:
+            track_node = f["clips"]["clip"][str(track.get_id())]
+            assert track_node.attrs["layout_version"] == 2
+            assert track_node.attrs["frames"] == 12
+            assert np.all(track_node["overlay"][()] == 1)
+
+    def test_segment_read_speed(self, tmp_path):
+        rng = np.random.default_rng(1)
+        track, cropped_data, original = make_track(rng, 200)
+        old_db = TrackDatabase(str(tmp_path / "old.hdf5"))
+        write_frame_datasets(old_db.database, "clip", track, cropped_data, original)
+        db = TrackDatabase(str(tmp_path / "new.hdf5"))
+        add_track(db.database, "clip", track, cropped_data, original)
+        timings = []
+        for database in (old_db, db):
+            start = time.time()
+            for _ in range(5):
+                database.get_track("clip", track.get_id(), 0, 200)
+            timings.append((time.time() - start) / 5)
+        print(
+            "200 frame segment dataset per frame {:.1f}ms concatenated {:.1f}ms".format(
+                timings[0] * 1000, timings[1] * 1000
+            )
+        )
+
+    def test_read_frames(self, tmp_path):
+        rng = np.random.default_rng(2)
+        frames = [
+            np.int16(rng.integers(0, 100, (5,) + tuple(rng.integers(1, 9, 2))))
+            for _ in range(10)
+        ]
+        original = np.int16(rng.integers(0, 100, (10, 12, 16)))
+        empty = [np.zeros((5, 0, 0), np.int16) for _ in range(3)]
+        with h5py.File(str(tmp_path / "frames.hdf5"), "w") as f:
+            write_track_frames(f.create_group("track"), frames, list(original))
+            write_track_frames(f.create_group("empty"), empty)
+            frame_numbers = [8, 1, 2, 8, 5]
+            read = read_track_frames(f["track"], frame_numbers)
+            for frame, frame_number in zip(read, frame_numbers):
+                assert np.array_equal(frame, frames[frame_number])
+            read = read_track_frames(f["track"], frame_numbers, original=True)
+            assert np.array_equal(read, original[frame_numbers])
+            read = read_track_frames(f["empty"], [2, 0])
+            assert [frame.shape for frame in read] == [(5, 0, 0)] * 2
+
+    def test_get_segments(self, tmp_path):
+        rng = np.random.default_rng(4)
+        db = TrackDatabase(str(tmp_path / "dataset.hdf5"))
+        track_ids = []
+        for clip_id in ("0", "1"):
+            for i in range(2):
+                track, cropped_data, original = make_track(rng, 100)
+                track._id = i
+                add_track(db.database, clip_id, track, cropped_data, original)
+                track_ids.append((clip_id, track.get_id()))
+        write_frame_datasets(db.database, "old", track, cropped_data, original)
+        track_ids.append(("old", track.get_id()))
+
+        requests = [(clip_id, track_id, [9, 3, 3]) for clip_id, track_id in track_ids]
+        for _ in range(32):
+            clip_id, track_id = track_ids[rng.integers(len(track_ids))]
+            start = int(rng.integers(0, 70))
+            requests.append((clip_id, track_id, range(start, start + 27)))
+        start = time.time()
+        segments = db.get_segments(requests)
+        batched = time.time() - start
+
+        start = time.time()
+        for request, segment in zip(requests, segments):
+            assert_same_frames(
+                segment, db.get_track(*request[:2], frame_numbers=request[2])
+            )
+        print(
+            "{} segments get_track {:.1f}ms get_segments {:.1f}ms".format(
+                len(requests), (time.time() - start) * 1000, batched * 1000
+            )
+        )
+        segments[0][1].thermal += 1
+        assert not np.array_equal(segments[0][1].thermal, segments[0][2].thermal)
+
+    def test_pickle(self, tmp_path):
+        db_name = str(tmp_path / "dataset.hdf5")
+        db = TrackDatabase(db_name)
+        write_clip(db_name, "0", datetime.datetime(2021, 1, 1))
+        TrackIndex(db_name).delete()
+        db = TrackDatabase(db_name)
+        assert db.get_all_track_ids() == []
+        assert pickle.loads(pickle.dumps(db)).get_all_clip_ids() == {
+            "0": ["background_frame"]
+        }
+
+        # pickled before the database had an index
+        old_db = TrackDatabase.__new__(TrackDatabase)
+        old_db.__dict__ = {"database": db_name}
+        assert pickle.loads(pickle.dumps(old_db)).has_clip("0")
+
+        # unpickling doesn't touch the filesystem until the database is used
+        moved = str(tmp_path / "moved" / "dataset.hdf5")
+        db.database = moved
+        db._index = TrackIndex(moved)
+        unpickled = pickle.loads(pickle.dumps(db))
+        assert not (tmp_path / "moved").exists()
+        (tmp_path / "moved").mkdir()
+        unpickled = pickle.loads(pickle.dumps(db))
+        assert list((tmp_path / "moved").iterdir()) == []
+        assert unpickled.get_all_clip_ids() == {}
+        assert os.path.exists(moved)
@@ -7,6 +7,8 @@ Date December 2017
 Handles reading and writing tracks (or segments) to a large database.  Uses HDF5 as a backing store.
 
 """
+
+import glob
 import h5py
 import os
 import logging
@@ -18,8 +20,12 @@ from dateutil.parser import parse as parse_date
 from multiprocessing import Lock
 import numpy as np
 from track.framebuffer import Frame
+from ml_tools.trackindex import TrackIndex
 
-special_datasets = ["background_frame", "predictions", "overlay"]
+# tracks without a layout_version attribute store a dataset per frame
+TRACK_LAYOUT_VERSION = 2
+# pixels per chunk of the concatenated track frames
+TRACK_CHUNK_PIXELS = 16384
 
 
 class HDF5Manager:
@@ -27,17 +33,20 @@ class HDF5Manager:
 
     LOCK_FILE = "/var/lock/classifier-hdf5.lock"
 
-    def __init__(self, db, mode="r"):
+    def __init__(self, db, mode="r", use_lock=True):
         self.mode = mode
         self.f = None
         self.db = db
-        self.lock = filelock.FileLock(HDF5Manager.LOCK_FILE, timeout=60 * 3)
-        filelock.logger().setLevel(logging.ERROR)
+        self.lock = None
+        if use_lock:
+            self.lock = filelock.FileLock(HDF5Manager.LOCK_FILE, timeout=60 * 3)
+            filelock.logger().setLevel(logging.ERROR)
 
     def __enter__(self):
         # note: we might not have to lock when in read only mode?
         # this could improve performance
-        self.lock.acquire()
+        if self.lock is not None:
+            self.lock.acquire()
         self.f = h5py.File(self.db, self.mode)
         return self.f
 
@@ -45,23 +54,55 @@ class HDF5Manager:
         try:
             self.f.close()
         finally:
-            self.lock.release()
+            if self.lock is not None:
+                self.lock.release()
 
 
 class TrackDatabase:
-    def __init__(self, database_filename):
+    def __init__(self, database_filename, use_lock=True):
         """
         Initialises given database.  If database does not exist an empty one is created.
+        Queries of clip and track metadata are answered from a sidecar index, which is
+        built from the database if it doesn't exist.
         :param database_filename: filename of database
+        :param use_lock: lock the database while it is accessed, only databases which
+        are written by a single process such as shards can be used without locking
         """
 
         self.database = database_filename
-
-        if not os.path.exists(database_filename):
-            logging.info("Creating new database %s", database_filename)
-            f = h5py.File(database_filename, "w")
+        self.use_lock = use_lock
+        self._index = TrackIndex(database_filename)
+        self.opened = False
+        self._open()
+
+    def _open(self):
+        """Creates the database and builds its index if they don't exist"""
+        if not os.path.exists(self.database):
+            logging.info("Creating new database %s", self.database)
+            f = h5py.File(self.database, "w")
             f.create_group("clips")
             f.close()
+            self._index.delete()
+        if not self._index.exists:
+            with HDF5Manager(self.database, use_lock=self.use_lock) as f:
+                self._index.rebuild(f)
+        self.opened = True
+
+    @property
+    def index(self):
+        # unpickled databases are only opened when first used
+        if not self.opened:
+            self._open()
+        return self._index
+
+    def __setstate__(self, state):
+        # databases pickled before the index and use_lock existed, or when the
+        # index was a plain attribute
+        state.setdefault("use_lock", True)
+        index = state.pop("index", None)
+        state.setdefault("_index", index or TrackIndex(state["database"]))
+        state["opened"] = False
+        self.__dict__.update(state)
 
     def has_clip(self, clip_id):
         """
@@ -69,27 +110,18 @@ class TrackDatabase:
         :param clip_id: name of clip
         :return: If the database contains given clip
         """
-        with HDF5Manager(self.database) as f:
-            clips = f["clips"]
-            has_record = clip_id in clips and "finished" in clips[clip_id].attrs
-        return has_record
+        return self.index.has_clip(clip_id)
 
     def has_prediction(self, clip_id):
-        with HDF5Manager(self.database, "a") as f:
-            clips = f["clips"]
-            # has_record = clip_id in clips and "finished" in clips[clip_id].attrs
-            clip = clips[clip_id]
-            # if has_record:
-            return clip.attrs.get("has_prediction", False)
-        return False
+        return self.index.has_prediction(clip_id)
 
     def get_labels(self):
-        with HDF5Manager(self.database) as f:
-            return f.attrs.get("labels", None)
+        return self.index.get_labels()
 
     def set_labels(self, labels):
-        with HDF5Manager(self.database, "a") as f:
+        with HDF5Manager(self.database, "a", use_lock=self.use_lock) as f:
             f.attrs["labels"] = labels
+            self.index.set_labels(f.attrs["labels"])
 
     def create_clip(self, clip, overwrite=True):
         """
@@ -100,7 +132,7 @@ class TrackDatabase:
         """
         print("creating clip {}".format(clip.get_id()))
         clip_id = str(clip.get_id())
-        with HDF5Manager(self.database, "a") as f:
+        with HDF5Manager(self.database, "a", use_lock=self.use_lock) as f:
             clips = f["clips"]
             if overwrite and clip_id in clips:
                 del clips[clip_id]
@@ -163,52 +195,34 @@ class TrackDatabase:
 
             f.flush()
             group.attrs["finished"] = True
+            self.index.update_clip(clip_id, group, tracks=True)
 
     def latest_date(self):
-        start_time = None
-
-        with HDF5Manager(self.database) as f:
-            clips = f["clips"]
-            results = {}
-            for clip_id in clips:
-                clip_start = clips[clip_id].attrs["start_time"]
-                if clip_start:
-                    if start_time is None or clip_start > start_time:
-                        start_time = clip_start
-
-        return start_time
+        return self.index.latest_date()
 
     def get_all_clip_ids(self):
         """
         Returns a list of clip_id, track_number pairs.
         """
-        with HDF5Manager(self.database) as f:
-            clips = f["clips"]
-            results = {}
-            for clip_id in clips:
-                results[clip_id] = [track_id for track_id in clips[clip_id]]
-        return results
+        return self.index.get_clip_children()
 
     def get_all_track_ids(self, before_date=None, after_date=None):
         """
         Returns a list of clip_id, track_number pairs.
         """
-        with HDF5Manager(self.database) as f:
-            clips = f["clips"]
-            result = []
-            for clip_id in clips:
-                clip = clips[clip_id]
-                if not clip.attrs.get("finished"):
-                    continue
-                date = parse_date(clip.attrs["start_time"])
-                if before_date and date >= before_date:
-                    continue
-                if after_date and date < after_date:
-                    continue
-                for track in clip:
-                    if track not in special_datasets:
-                        result.append((clip_id, track))
-        return result
+        clip_ids = set()
+        for clip_id, start_time in self.index.get_clips(finished=True):
+            date = parse_date(start_time)
+            if before_date and date >= before_date:
+                continue
+            if after_date and date < after_date:
+                continue
+            clip_ids.add(clip_id)
+        return [
+            (clip_id, track_id)
+            for clip_id, track_id in self.index.get_track_ids()
+            if clip_id in clip_ids
+        ]
 
     def get_track_meta(self, clip_id, track_number):
         """
@@ -217,10 +231,8 @@ class TrackDatabase:
         :param track_number:
         :return:
         """
-        with HDF5Manager(self.database) as f:
-            dataset = f["clips"][clip_id][str(track_number)]
-            result = hdf5_attributes_dictionary(dataset)
-            result["id"] = track_number
+        result = self.index.get_track_meta(str(clip_id), str(track_number))
+        result["id"] = track_number
         return result
 
     def get_track_predictions(self, clip_id, track_number):
@@ -230,14 +242,10 @@ class TrackDatabase:
         :param track_number:
         :return:
         """
-        with HDF5Manager(self.database) as f:
-            track = f["clips"][clip_id][str(track_number)]
-            if "predictions" in track:
-                return track["predictions"][:]
-        return None
+        return self.index.get_track_predictions(str(clip_id), str(track_number))
 
     def get_clip_background(self, clip_id):
-        with HDF5Manager(self.database) as f:
+        with HDF5Manager(self.database, use_lock=self.use_lock) as f:
             clip = f["clips"][str(clip_id)]
             if "background_frame" in clip:
                 return clip["background_frame"][:]
@@ -250,11 +258,7 @@ class TrackDatabase:
         :return:
         """
 
-        with HDF5Manager(self.database) as f:
-            dataset = f["clips"][str(clip_id)]
-            result = hdf5_attributes_dictionary(dataset)
-            result["tracks"] = len(dataset)
-        return result
+        return self.index.get_clip_meta(str(clip_id))
 
     def get_clip_tracks(self, clip_id):
         """
@@ -262,20 +266,10 @@ class TrackDatabase:
         :param clip_id:
         :return:
         """
-        tracks = []
-        with HDF5Manager(self.database) as f:
-            dataset = f["clips"][str(clip_id)]
-            for track_id in dataset:
-                if track_id in special_datasets:
-                    continue
-                tracks.append(hdf5_attributes_dictionary(dataset[track_id]))
-        return tracks
+        return self.index.get_clip_tracks(str(clip_id))
 
     def get_tag(self, clip_id, track_number):
-        with HDF5Manager(self.database) as f:
-            clips = f["clips"]
-            track_node = clips[str(clip_id)][str(track_number)]
-            return track_node.attrs["tag"]
+        return self.get_track_meta(clip_id, track_number)["tag"]
 
     def get_frame(self, clip_id, track_id, frame, original=False):
         frames = self.get_track(
@@ -302,7 +296,7 @@ class TrackDatabase:
         :param end_frame: last frame of slice to return (exclusive).
         :return: a list of numpy arrays of shape [channels, height, width] and of type np.int16
         """
-        with HDF5Manager(self.database) as f:
+        with HDF5Manager(self.database, use_lock=self.use_lock) as f:
             clips = f["clips"]
             track_node = clips[str(clip_id)][str(track_number)]
 
@@ -311,21 +305,56 @@ class TrackDatabase:
             if end_frame is None:
                 end_frame = track_node.attrs["frames"]
 
-            result = []
-            if original:
-                track_node = track_node["original"]
-            else:
-                if "cropped" in track_node:
-                    track_node = track_node["cropped"]
-
             if frame_numbers is None:
-                frame_iter = range(start_frame, end_frame)
-            else:
-                frame_iter = iter(frame_numbers)
+                frame_numbers = range(start_frame, end_frame)
+            frames = read_frames(track_node, frame_numbers, original)
+            result = [
+                Frame.from_array(frame, frame_number, flow_clipped=True)
+                for frame, frame_number in zip(frames, frame_numbers)
+            ]
+        return result
+
+    def get_segments(self, requests, original=False):
+        """
+        Fetches frames from many tracks while the database is opened once. Requests
+        for the same track are combined so each track is read once.
+        :param requests: list of (clip_id, track_number, frame_numbers), where
+        frame_numbers is a sequence of frames to read such as range(start, end)
+        :return: a list of Frames for each request, in the order of requests
+        """
+        by_track = {}
+        for i, (clip_id, track_number, _) in enumerate(requests):
+            by_track.setdefault((str(clip_id), str(track_number)), []).append(i)
 
-            for frame_number in frame_iter:
-                frame = track_node[str(frame_number)][:, :, :]
-                result.append(Frame.from_array(frame, frame_number, flow_clipped=True))
+        result = [None] * len(requests)
+        with HDF5Manager(self.database, use_lock=self.use_lock) as f:
+            clips = f["clips"]
+            for (clip_id, track_number), indices in by_track.items():
+                track_node = clips[clip_id][track_number]
+                frame_numbers = sorted(
+                    set(
+                        frame_number for i in indices for frame_number in requests[i][2]
+                    )
+                )
+                frames = dict(
+                    zip(
+                        frame_numbers,
+                        read_frames(track_node, frame_numbers, original),
+                    )
+                )
+                used = set()
+                for i in indices:
+                    segment = []
+                    for frame_number in requests[i][2]:
+                        frame = frames[frame_number]
+                        # requests which overlap get their own copy of the frame
+                        if frame_number in used:
+                            frame = frame.copy()
+                        used.add(frame_number)
+                        segment.append(
+                            Frame.from_array(frame, frame_number, flow_clipped=True)
+                        )
+                    result[i] = segment
         return result
 
     def remove_clip(self, clip_id):
@@ -336,16 +365,53 @@ class TrackDatabase:
         :param clip_id: id of clip to remove
         :returns: true if clip was deleted, false if it could not be found.
         """
-        with HDF5Manager(self.database, "a") as f:
+        with HDF5Manager(self.database, "a", use_lock=self.use_lock) as f:
             clips = f["clips"]
             if clip_id in clips:
                 del clips[clip_id]
+                self.index.remove_clip(clip_id)
                 return True
             else:
                 return False
 
+    def get_shard_filename(self, shard):
+        """
+        Returns the filename of a shard of this database, a shard is written by a
+        single process and merged into this database when loading finishes
+        """
+        base, ext = os.path.splitext(self.database)
+        return "{}.shard-{}{}".format(base, shard, ext)
+
+    def get_shard_filenames(self):
+        base, ext = os.path.splitext(self.database)
+        return sorted(glob.glob("{}.shard-*{}".format(glob.escape(base), ext)))
+
+    def merge_shards(self):
+        """
+        Copies the clips of every shard into this database, replacing any clips with
+        the same id, then deletes the shards.
+        :returns: number of clips merged
+        """
+        shards = self.get_shard_filenames()
+        merged = 0
+        with HDF5Manager(self.database, "a", use_lock=self.use_lock) as f:
+            clips = f["clips"]
+            for shard in shards:
+                with h5py.File(shard, "r") as shard_f:
+                    for clip_id, clip_node in shard_f["clips"].items():
+                        if clip_id in clips:
+                            del clips[clip_id]
+                        shard_f.copy(clip_node, clips, name=clip_id)
+                        self.index.update_clip(clip_id, clips[clip_id], tracks=True)
+                        merged += 1
+                logging.info("Merged shard %s", shard)
+        for shard in shards:
+            TrackIndex(shard).delete()
+            os.remove(shard)
+        return merged
+
     def add_prediction(self, clip_id, track_id, track_prediction):
-        with HDF5Manager(self.database, "a") as f:
+        with HDF5Manager(self.database, "a", use_lock=self.use_lock) as f:
             clip = f["clips"][(str(clip_id))]
             track_node = clip[str(track_id)]
             predicted_tag = track_prediction.predicted_tag()
@@ -364,6 +430,7 @@ class TrackDatabase:
                     labels=track_prediction.labels,
                 )
             clip.attrs["has_prediction"] = True
+            self.index.update_track(str(clip_id), clip, str(track_id))
 
     def add_prediction_data(
         self, track, predictions, predicted_tag, score, labels=None
@@ -413,37 +480,17 @@ class TrackDatabase:
         if opts is None:
             opts = {}
         frames = len(cropped_data)
-        with HDF5Manager(self.database, "a") as f:
+        with HDF5Manager(self.database, "a", use_lock=self.use_lock) as f:
             clips = f["clips"]
             clip_node = clips[clip_id]
             has_prediction = False
             track_node = clip_node.create_group(track_id)
-            cropped_frame = track_node.create_group("cropped")
-            thermal_frame = track_node.create_group("original")
-
-            # write each frame out individually, as they will probably be different sizes.
-            original = None
-            for frame_i, cropped in enumerate(cropped_data):
-                if original_thermal is not None:
-                    original = original_thermal[frame_i]
-                channels = cropped.channels
-                height, width = cropped.shape
-                # using a chunk size of 1 for channels has the advantage that we can quickly load just one channel
-                chunks = (1, height, width)
-                dims = (channels, height, width)
-                frame_node = cropped_frame.create_dataset(
-                    str(frame_i), dims, chunks=chunks, **opts, dtype=np.int16
-                )
-                frame_node[:, :, :] = cropped.as_array()
-                if original is not None:
-                    thermal_node = thermal_frame.create_dataset(
-                        str(frame_i),
-                        original.shape,
-                        chunks=original.shape,
-                        **opts,
-                        dtype=np.int16,
-                    )
-                    thermal_node[:, :] = original
+            write_track_frames(
+                track_node,
+                [cropped.as_array() for cropped in cropped_data],
+                original_thermal,
+                opts,
+            )
             # write out attributes
             if track:
                 track_stats = track.get_stats()
@@ -475,15 +522,8 @@ class TrackDatabase:
                 for name, value in track_stats._asdict().items():
                     node_attrs[name] = value
                 # frame history
-                node_attrs["mass_history"] = np.int32(
-                    [bounds.mass for bounds in track.bounds_history]
-                )
-                node_attrs["bounds_history"] = np.int16(
-                    [
-                        [bounds.left, bounds.top, bounds.right, bounds.bottom]
-                        for bounds in track.bounds_history
-                    ]
-                )
+                node_attrs["mass_history"] = np.int32(track.bounds_history.mass)
+                node_attrs["bounds_history"] = np.int16(track.bounds_history.ltrb())
 
                 node_attrs["important_frames"] = np.uint16(important_frames)
                 if "overlay" not in track_node:
@@ -500,16 +540,119 @@ class TrackDatabase:
             # this means if we are interupted part way through the track will be overwritten
             clip_node.attrs["finished"] = True
             clip_node.attrs["has_prediction"] = has_prediction
+            self.index.update_track(clip_id, clip_node, track_id)
 
     def get_overlay(self, clip_id, track_id):
-        with HDF5Manager(self.database, "r") as f:
+        with HDF5Manager(self.database, "r", use_lock=self.use_lock) as f:
             clip = f["clips"][str(clip_id)]
             track = clip[str(track_id)]
             return track["overlay"][:]
 
 
-def hdf5_attributes_dictionary(dataset):
-    result = {}
-    for key, value in dataset.attrs.items():
-        result[key] = value
-    return result
+def write_track_frames(track_node, cropped_frames, original_frames=None, opts=None):
+    """
+    Writes the frames of a track in the current layout. The cropped frames, which
+    are probably different sizes, are flattened and concatenated into one
+    (channels, pixels) dataset, with the offset of each frame and its shape saved
+    alongside so any range of frames can be read with one call. Original frames
+    are all the same size so are stacked into one dataset.
+    :param cropped_frames: list of numpy arrays of shape [channels, height, width]
+    :param original_frames: optional list of numpy arrays of shape [height, width]
+    """
+    if opts is None:
+        opts = {}
+    track_node.attrs["layout_version"] = TRACK_LAYOUT_VERSION
+    cropped_node = track_node.create_group("cropped")
+    shapes = np.zeros((len(cropped_frames), 3), dtype=np.int32)
+    for i, frame in enumerate(cropped_frames):
+        shapes[i] = frame.shape
+    sizes = shapes[:, 1] * shapes[:, 2]
+    offsets = np.zeros(len(cropped_frames) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    cropped_node.create_dataset("shapes", data=shapes)
+    cropped_node.create_dataset("offsets", data=offsets)
+    if offsets[-1] > 0:
+        dtype = np.result_type(*cropped_frames)
+        pixels = np.zeros((shapes[:, 0].max(), offsets[-1]), dtype=dtype)
+        for frame, start, end in zip(cropped_frames, offsets[:-1], offsets[1:]):
+            pixels[: len(frame), start:end] = frame.reshape(len(frame), -1)
+        # using a chunk size of 1 for channels has the advantage that we can quickly load just one channel
+        pixels_node = cropped_node.create_dataset(
+            "pixels",
+            pixels.shape,
+            chunks=(1, min(offsets[-1], TRACK_CHUNK_PIXELS)),
+            **opts,
+            dtype=np.int16,
+        )
+        # let hdf5 convert to int16 as it did when writing a dataset per frame
+        pixels_node[:, :] = pixels
+
+    original_node = track_node.create_group("original")
+    if original_frames is not None and len(original_frames) > 0:
+        original = np.stack(original_frames)
+        frames_node = original_node.create_dataset(
+            "frames",
+            original.shape,
+            chunks=(1,) + original.shape[1:],
+            **opts,
+            dtype=np.int16,
+        )
+        frames_node[:, :, :] = original
+
+
+def read_frames(track_node, frame_numbers, original=False):
+    """Reads frames of either layout as arrays of shape [channels, height, width]"""
+    if track_node.attrs.get("layout_version", 1) >= 2:
+        return read_track_frames(track_node, frame_numbers, original)
+    return read_frame_datasets(track_node, frame_numbers, original)
+
+
+def read_track_frames(track_node, frame_numbers, original=False):
+    """
+    Reads frames written by write_track_frames, each run of consecutive frame
+    numbers is read with one call then split
+    """
+    frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+    if len(frame_numbers) == 0:
+        return []
+    frames = {}
+    if original:
+        frames_node = track_node["original"]["frames"]
+        for first, last in _frame_runs(frame_numbers):
+            for i, frame in enumerate(frames_node[first:last]):
+                frames[first + i] = frame
+        return [frames[frame_number] for frame_number in frame_numbers]
+
+    cropped_node = track_node["cropped"]
+    # pixels isn't written when every frame is empty
+    pixels_node = cropped_node.get("pixels")
+    for first, last in _frame_runs(frame_numbers):
+        offsets = cropped_node["offsets"][first : last + 1]
+        shapes = cropped_node["shapes"][first:last]
+        start = offsets[0]
+        if pixels_node is None:
+            pixels = np.empty((shapes[:, 0].max(initial=0), 0), dtype=np.int16)
+        else:
+            pixels = pixels_node[:, start : offsets[-1]]
+        for i, (channels, height, width) in enumerate(shapes):
+            frame = pixels[:channels, offsets[i] - start : offsets[i + 1] - start]
+            frames[first + i] = frame.reshape(channels, height, width)
+    return [frames[frame_number] for frame_number in frame_numbers]
+
+
+def _frame_runs(frame_numbers):
+    """Returns (first, last + 1) of each run of consecutive frame numbers"""
+    frame_numbers = np.unique(frame_numbers)
+    breaks = np.flatnonzero(np.diff(frame_numbers) > 1) + 1
+    firsts = frame_numbers[np.concatenate(([0], breaks))]
+    lasts = frame_numbers[np.concatenate((breaks - 1, [-1]))] + 1
+    return zip(firsts.tolist(), lasts.tolist())
+
+
+def read_frame_datasets(track_node, frame_numbers, original=False):
+    """Reads frames from the previous layout which has a dataset per frame"""
+    if original:
+        track_node = track_node["original"]
+    elif "cropped" in track_node:
+        track_node = track_node["cropped"]
+    return [track_node[str(frame_number)][()] for frame_number in frame_numbers]
@@ -0,0 +1,299 @@
+"""
+A SQLite index of the clip and track metadata in a TrackDatabase, so that queries
+don't need to open the HDF5 file and walk every clip.
+"""
+
+import logging
+import os
+import pickle
+import sqlite3
+
+import h5py
+
+
+class TrackIndex:
+    """
+    Holds a row per clip and per track of a TrackDatabase, with the values most
+    queries filter on as columns and the complete attributes of each node pickled.
+    Rows are written from the open HDF5 nodes while the database is locked, so the
+    index mirrors the HDF5 file.
+    """
+
+    # increment when the tables change to rebuild old indexes
+    VERSION = 1
+    EXTENSION = ".sqlite"
+    # children of a clip group which aren't tracks
+    SPECIAL_DATASETS = ("background_frame", "predictions", "overlay")
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS info (
+            name TEXT PRIMARY KEY,
+            value BLOB
+        );
+        CREATE TABLE IF NOT EXISTS clips (
+            clip_id TEXT PRIMARY KEY,
+            start_time TEXT,
+            device TEXT,
+            finished INTEGER,
+            has_prediction INTEGER,
+            has_background INTEGER,
+            meta BLOB
+        );
+        CREATE TABLE IF NOT EXISTS tracks (
+            clip_id TEXT,
+            track_id TEXT,
+            tag TEXT,
+            frames INTEGER,
+            start_frame INTEGER,
+            end_frame INTEGER,
+            average_mass REAL,
+            median_mass REAL,
+            mass_std REAL,
+            has_prediction INTEGER,
+            meta BLOB,
+            predictions BLOB,
+            PRIMARY KEY (clip_id, track_id)
+        );
+        CREATE INDEX IF NOT EXISTS clips_start_time ON clips (start_time);
+    """
+
+    def __init__(self, database_filename):
+        self.filename = os.path.splitext(database_filename)[0] + TrackIndex.EXTENSION
+        self.conn = None
+        self.pid = None
+
+    @property
+    def exists(self):
+        if not os.path.exists(self.filename):
+            return False
+        with self._connect() as conn:
+            version = conn.execute(
+                "SELECT value FROM info WHERE name = 'version'"
+            ).fetchone()
+        return version is not None and pickle.loads(version[0]) == TrackIndex.VERSION
+
+    def _connect(self):
+        """
+        Returns the connection of this process, used as a context manager it commits
+        or rolls back a transaction
+        """
+        # connections can't be shared with forked processes
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.filename, timeout=60 * 3)
+            self.conn.executescript(TrackIndex.SCHEMA)
+            self.pid = os.getpid()
+        return self.conn
+
+    def __getstate__(self):
+        # connections can't be pickled, the unpickled index connects when used
+        state = self.__dict__.copy()
+        state["conn"] = None
+        state["pid"] = None
+        return state
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+    def delete(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def rebuild(self, f):
+        """Indexes every clip and track of the open HDF5 file f"""
+        logging.info("Building track index %s", self.filename)
+        self.delete()
+        with self._connect() as conn:
+            self._set_info(conn, "labels", f.attrs.get("labels", None))
+            clips = f["clips"]
+            for clip_id in clips:
+                self._update_clip(conn, clip_id, clips[clip_id], tracks=True)
+            self._set_info(conn, "version", TrackIndex.VERSION)
+
+    def _set_info(self, conn, name, value):
+        conn.execute(
+            "INSERT OR REPLACE INTO info VALUES (?, ?)", (name, pickle.dumps(value))
+        )
+
+    def set_labels(self, labels):
+        with self._connect() as conn:
+            self._set_info(conn, "labels", labels)
+
+    def get_labels(self):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM info WHERE name = 'labels'"
+            ).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def update_clip(self, clip_id, clip_node, tracks=False):
+        """
+        Saves the attributes of clip_node, and if tracks is set replaces the clips
+        tracks with those in clip_node
+        """
+        with self._connect() as conn:
+            self._update_clip(conn, clip_id, clip_node, tracks)
+
+    def _update_clip(self, conn, clip_id, clip_node, tracks):
+        meta = dict(clip_node.attrs)
+        conn.execute(
+            "INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                clip_id,
+                meta.get("start_time"),
+                meta.get("device"),
+                bool(meta.get("finished", False)),
+                bool(meta.get("has_prediction", False)),
+                "background_frame" in clip_node,
+                pickle.dumps(meta),
+            ),
+        )
+        if tracks:
+            conn.execute("DELETE FROM tracks WHERE clip_id = ?", (clip_id,))
+            for track_id in clip_node:
+                track_node = clip_node[track_id]
+                if track_id in TrackIndex.SPECIAL_DATASETS or not isinstance(
+                    track_node, h5py.Group
+                ):
+                    continue
+                self._update_track(conn, clip_id, track_id, track_node)
+
+    def update_track(self, clip_id, clip_node, track_id):
+        """Saves the attributes of a track, and of its clip which may have changed"""
+        with self._connect() as conn:
+            self._update_clip(conn, clip_id, clip_node, tracks=False)
+            self._update_track(conn, clip_id, track_id, clip_node[track_id])
+
+    def _update_track(self, conn, clip_id, track_id, track_node):
+        meta = dict(track_node.attrs)
+        predictions = None
+        if "predictions" in track_node:
+            predictions = pickle.dumps(track_node["predictions"][()])
+        conn.execute(
+            "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                clip_id,
+                track_id,
+                meta.get("tag"),
+                _to_int(meta.get("frames")),
+                _to_int(meta.get("start_frame")),
+                _to_int(meta.get("end_frame")),
+                _to_float(meta.get("average_mass")),
+                _to_float(meta.get("median_mass")),
+                _to_float(meta.get("mass_std")),
+                bool(meta.get("has_prediction", False)),
+                pickle.dumps(meta),
+                predictions,
+            ),
+        )
+
+    def remove_clip(self, clip_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM tracks WHERE clip_id = ?", (clip_id,))
+            conn.execute("DELETE FROM clips WHERE clip_id = ?", (clip_id,))
+
+    def has_clip(self, clip_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT finished FROM clips WHERE clip_id = ?", (clip_id,)
+            ).fetchone()
+        return row is not None and bool(row[0])
+
+    def has_prediction(self, clip_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT has_prediction FROM clips WHERE clip_id = ?", (clip_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError("Clip {} not found".format(clip_id))
+        return bool(row[0])
+
+    def latest_date(self):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MAX(start_time) FROM clips WHERE start_time != ''"
+            ).fetchone()
+        return row[0]
+
+    def get_clips(self, finished=False):
+        """Returns (clip_id, start_time) of each clip"""
+        query = "SELECT clip_id, start_time FROM clips"
+        if finished:
+            query += " WHERE finished"
+        with self._connect() as conn:
+            return conn.execute(query + " ORDER BY clip_id").fetchall()
+
+    def get_track_ids(self):
+        """Returns (clip_id, track_id) of every track, in the order hdf5 lists them"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT clip_id, track_id FROM tracks ORDER BY clip_id, track_id"
+            ).fetchall()
+
+    def get_clip_children(self):
+        """Returns the names of the children of each clip group"""
+        with self._connect() as conn:
+            clips = conn.execute(
+                "SELECT clip_id, has_background FROM clips ORDER BY clip_id"
+            ).fetchall()
+            tracks = conn.execute(
+                "SELECT clip_id, track_id FROM tracks ORDER BY clip_id, track_id"
+            ).fetchall()
+        children = {
+            clip_id: ["background_frame"] if has_background else []
+            for clip_id, has_background in clips
+        }
+        for clip_id, track_id in tracks:
+            children[clip_id].append(track_id)
+        return {clip_id: sorted(names) for clip_id, names in children.items()}
+
+    def get_clip_meta(self, clip_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT meta, has_background FROM clips WHERE clip_id = ?", (clip_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError("Clip {} not found".format(clip_id))
+            num_tracks = conn.execute(
+                "SELECT COUNT(*) FROM tracks WHERE clip_id = ?", (clip_id,)
+            ).fetchone()[0]
+        meta = pickle.loads(row[0])
+        meta["tracks"] = num_tracks + row[1]
+        return meta
+
+    def _get_track(self, column, clip_id, track_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT {} FROM tracks WHERE clip_id = ? AND track_id = ?".format(
+                    column
+                ),
+                (clip_id, track_id),
+            ).fetchone()
+        if row is None:
+            raise KeyError("Track {} {} not found".format(clip_id, track_id))
+        return row[0]
+
+    def get_track_meta(self, clip_id, track_id):
+        return pickle.loads(self._get_track("meta", clip_id, track_id))
+
+    def get_track_predictions(self, clip_id, track_id):
+        predictions = self._get_track("predictions", clip_id, track_id)
+        return None if predictions is None else pickle.loads(predictions)
+
+    def get_clip_tracks(self, clip_id):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT meta FROM tracks WHERE clip_id = ? ORDER BY track_id",
+                (clip_id,),
+            ).fetchall()
+        return [pickle.loads(row[0]) for row in rows]
+
+
+def _to_int(value):
+    return None if value is None else int(value)
+
+
+def _to_float(value):
+    return None if value is None else float(value)
@@ -0,0 +1,129 @@
+"""
+Benchmarks each of the denoisers available to tracking, reporting how long the
+denoising takes per frame and how well the tracks agree with those found using
+the default denoiser.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+from config.config import Config
+from load.clip import Clip
+from load.cliptrackextractor import ClipTrackExtractor
+from ml_tools.imageprocessing import DENOISERS
+from ml_tools.logs import init_logging
+
+DEFAULT_DENOISER = "nlmeans"
+
+
+class TimedDenoiser:
+    """Wraps a denoise function recording the time spent in it"""
+
+    def __init__(self, denoise):
+        self.denoise = denoise
+        self.time = 0
+        self.frames = 0
+
+    def __call__(self, image):
+        start = time.time()
+        denoised = self.denoise(image)
+        self.time += time.time() - start
+        self.frames += 1
+        return denoised
+
+    @property
+    def ms_per_frame(self):
+        return self.time * 1000 / max(1, self.frames)
+
+
+def track_agreement(reference_tracks, tracks):
+    """
+    For each reference track find the track which overlaps it for the most frames
+    and return the average of these overlaps, 1 means every reference track was found
+    """
+    if len(reference_tracks) == 0:
+        return 1.0 if len(tracks) == 0 else 0.0
+    total = 0
+    for reference in reference_tracks:
+        overlaps = [reference.get_overlap_ratio(track, 0.5) for track in tracks]
+        total += max(overlaps, default=0)
+    return total / len(reference_tracks)
+
+
+def parse_clip(config, filename, denoiser):
+    config.tracking.denoiser = denoiser
+    track_extractor = ClipTrackExtractor(config.tracking, False, False)
+    timed_denoise = TimedDenoiser(track_extractor.denoise)
+    track_extractor.denoise = timed_denoise
+    clip = Clip(config.tracking, filename)
+    start = time.time()
+    track_extractor.parse_clip(clip)
+    ms_per_frame = (time.time() - start) * 1000 / max(1, clip.frame_on)
+    return clip, timed_denoise.ms_per_frame, ms_per_frame
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "cptv",
+        nargs="*",
+        help="CPTV files to benchmark, defaults to the test clips",
+    )
+    parser.add_argument("-c", "--config-file", help="Path to config file to use")
+    parser.add_argument(
+        "-d",
+        "--denoisers",
+        nargs="+",
+        default=list(DENOISERS),
+        help="Denoisers to benchmark",
+    )
+    return parser.parse_args()
+
+
+def main():
+    init_logging()
+    args = parse_args()
+    if args.config_file:
+        config = Config.load_from_file(args.config_file)
+    else:
+        config = Config.get_defaults()
+    files = args.cptv
+    if not files:
+        clips_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "clips")
+        files = sorted(glob.glob(os.path.join(clips_dir, "*.cptv")))
+
+    results = {denoiser: [] for denoiser in args.denoisers}
+    for filename in files:
+        reference, _, _ = parse_clip(config, filename, DEFAULT_DENOISER)
+        print(
+            "{} tracks with {} {}".format(
+                os.path.basename(filename), DEFAULT_DENOISER, len(reference.tracks)
+            )
+        )
+        for denoiser in args.denoisers:
+            clip, denoise_ms, frame_ms = parse_clip(config, filename, denoiser)
+            agreement = track_agreement(reference.tracks, clip.tracks)
+            results[denoiser].append((denoise_ms, frame_ms, agreement))
+            print(
+                "  {:<10} denoise {:.2f}ms/frame, tracking {:.1f}ms/frame, tracks {} agreement {:.2f}".format(
+                    denoiser, denoise_ms, frame_ms, len(clip.tracks), agreement
+                )
+            )
+
+    print("===== OVERALL =====")
+    for denoiser, stats in results.items():
+        count = max(1, len(stats))
+        print(
+            "{:<10} denoise {:.2f}ms/frame, tracking {:.1f}ms/frame, agreement {:.2f}".format(
+                denoiser,
+                sum(stat[0] for stat in stats) / count,
+                sum(stat[1] for stat in stats) / count,
+                sum(stat[2] for stat in stats) / count,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -44,3 +44,36 @@ class TestTrackingSpeed:
         )
         print("Took {:.1f}ms per frame".format(ms_per_frame))
         assert ms_per_frame < TestTrackingSpeed.MAX_FRAME_MS
+
+    def test_single_pass(self):
+        config = Config.get_defaults()
+        dir_name = os.path.dirname(os.path.realpath(__file__))
+        for cptv_file in [
+            TestTrackingSpeed.CPTV_FILE_NO_BACKGROUND,
+            TestTrackingSpeed.CPTV_FILE_BACKGROUND,
+        ]:
+            file_name = os.path.join(dir_name, cptv_file)
+            tracks = []
+            timings = []
+            for single_pass in [False, True]:
+                config.tracking.single_pass = single_pass
+                track_extractor = ClipTrackExtractor(config.tracking, False, False)
+                clip = Clip(config.tracking, file_name)
+                start = time.time()
+                track_extractor.parse_clip(clip)
+                timings.append((time.time() - start) * 1000)
+                tracks.append(
+                    [
+                        [(str(region), region.mass) for region in track.bounds_history]
+                        for track in clip.tracks
+                    ]
+                )
+            print(
+                "{} two passes {:.0f}ms single pass {:.0f}ms saves {:.0f}ms".format(
+                    cptv_file,
+                    timings[0],
+                    timings[1],
+                    timings[0] - timings[1],
+                )
+            )
+            assert tracks[0] == tracks[1]
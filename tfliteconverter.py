@@ -5,8 +5,7 @@ import numpy as np
 import shutil
 import tensorflow as tf
 from config.config import Config
-from ml_tools.dataset import dataset_db_path
-import pickle
+from ml_tools.dataset import get_datasets_path, load_datasets
 from ml_tools.model import Model
 from model_crnn import ModelCRNN_HQ, Model_CNN
 
@@ -39,9 +38,7 @@ def optimizer_model(args):
 # frame count to 1 as is needed for tflite
 def save_eval_model(args):
     config = Config.load_from_file()
-    datasets_filename = dataset_db_path(config)
-    with open(datasets_filename, "rb") as f:
-        dsets = pickle.load(f)
+    dsets = load_datasets(get_datasets_path(config))
 
     labels = ["hedgehog", "false-positive", "possum", "rodent", "bird"]
 
@@ -127,8 +124,7 @@ def run_model(args):
 def representative_dataset_gen():
     config = Config.load_from_file()
 
-    dataset_filename = os.path.join(config.tracks_folder, "datasets.dat")
-    datasets = pickle.load(open(dataset_filename, "rb"))
+    datasets = load_datasets(get_datasets_path(config))
     train, validation, test = datasets
     num_calibration_steps = 1000
     for i in range(num_calibration_steps):
@@ -21,21 +21,44 @@ import attr
 import cv2
 import numpy as np
 from ml_tools.framecache import FrameCache
+from ml_tools.memmapframecache import MemmapFrameCache
+from ml_tools.framering import FrameRing
 from ml_tools.frame import Frame
 from track.track import TrackChannels
 from ml_tools.tools import get_optical_flow_function, get_clipped_flow
 
 
 class FrameBuffer:
-    """Stores entire clip in memory, required for some operations such as track exporting."""
+    """
+    Stores entire clip in memory, required for some operations such as track exporting.
+    If ring_capacity is set only the most recent ring_capacity frames, and frames
+    pinned by active tracks, are kept in memory.
+    """
+
+    # classes which can cache frames to disk
+    CACHE_BACKENDS = {"hdf5": FrameCache, "memmap": MemmapFrameCache}
 
     def __init__(
-        self, cptv_name, high_quality_flow, cache_to_disk, calc_flow, keep_frames
+        self,
+        cptv_name,
+        high_quality_flow,
+        cache_to_disk,
+        calc_flow,
+        keep_frames,
+        cache_backend="hdf5",
+        ring_capacity=None,
+        flow_region_padding=None,
+        lazy_flow=False,
     ):
-        self.cache = FrameCache(cptv_name) if cache_to_disk else None
+        self.cache = None
+        if cache_to_disk:
+            self.cache = FrameBuffer.CACHE_BACKENDS[cache_backend](cptv_name)
         self.opt_flow = None
         self.high_quality_flow = high_quality_flow
+        self.flow_region_padding = flow_region_padding
+        self.lazy_flow = lazy_flow
         self.frames = None
+        self.ring = FrameRing(ring_capacity) if ring_capacity else None
         self.prev_frame = None
         self.calc_flow = calc_flow
         self.keep_frames = keep_frames
@@ -51,22 +74,47 @@ class FrameBuffer:
     def add_frame(self, thermal, filtered, mask, frame_number, ffc_affected=False):
         frame = Frame(thermal, filtered, mask, frame_number, ffc_affected=ffc_affected)
         if self.opt_flow:
-            frame.generate_optical_flow(self.opt_flow, self.prev_frame)
+            frame.generate_optical_flow(
+                self.opt_flow,
+                self.prev_frame,
+                region_padding=self.flow_region_padding,
+                lazy=self.lazy_flow,
+            )
+        self.store_frame(frame)
+
+    def store_frame(self, frame):
+        """Adds a frame which already has its optical flow generated (if required)"""
         self.prev_frame = frame
+        if self.ring is not None:
+            self.ring.add_frame(frame)
         if self.keep_frames:
             if self.cache:
                 self.cache.add_frame(frame)
-            else:
+            elif self.ring is None:
+                frame.compact()
                 self.frames.append(frame)
 
+    def pin(self, owner, frame_number):
+        """Keeps frames from frame_number onwards in the ring until owner is unpinned"""
+        if self.ring is not None:
+            self.ring.pin(owner, frame_number)
+
+    def unpin(self, owner):
+        if self.ring is not None:
+            self.ring.unpin(owner)
+
     @property
     def has_flow(self):
-        return self.cache or self.opt_flow
+        return self.opt_flow is not None
 
     def get_frame(self, frame_number):
         if self.prev_frame and self.prev_frame.frame_number == frame_number:
             return self.prev_frame
-        elif self.cache:
+        if self.ring is not None:
+            frame = self.ring.get_frame(frame_number)
+            if frame is not None or not self.cache:
+                return frame
+        if self.cache:
             cache_frame, ffc_affected = self.cache.get_frame(frame_number)
             if cache_frame:
                 return Frame.from_array(
@@ -89,7 +137,7 @@ class FrameBuffer:
             self.cache.delete()
 
     def get_last_frame(self):
-        if self.cache and self.prev_frame:
+        if (self.cache or self.ring is not None) and self.prev_frame:
             return self.prev_frame
         elif len(self.frames) > 0:
             return self.frames[-1]
@@ -97,7 +145,7 @@ class FrameBuffer:
 
     def get_last_filtered(self, region=None):
 
-        if self.cache:
+        if self.cache or self.ring is not None:
             if not self.prev_frame:
                 return None
             prev = self.prev_frame.filtered
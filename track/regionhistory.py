@@ -0,0 +1,239 @@
+"""
+classifier-pipeline - this is a server side component that manipulates cptv
+files and to create a classification model of animals present
+Copyright (C) 2018, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from track.region import Region
+
+
+class RegionHistory:
+    """
+    A sequence of regions stored as growable numpy columns rather than a list of
+    Region objects. Indexing returns a RegionView which reads and writes the
+    underlying columns, slicing returns a new RegionHistory.
+    """
+
+    COLUMNS = {
+        "x": np.int32,
+        "y": np.int32,
+        "width": np.int32,
+        "height": np.int32,
+        "mass": np.int64,
+        # nan represents a region with no variance calculated
+        "pixel_variance": np.float64,
+        "id": np.int32,
+        "frame_number": np.int32,
+        "blank": np.bool_,
+        "was_cropped": np.bool_,
+        "is_along_border": np.bool_,
+    }
+
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, regions=None, capacity=INITIAL_CAPACITY):
+        self._columns = {
+            name: np.zeros(max(1, capacity), dtype=dtype)
+            for name, dtype in RegionHistory.COLUMNS.items()
+        }
+        self._length = 0
+        if regions is not None:
+            for region in regions:
+                self.append(region)
+
+    @classmethod
+    def from_columns(cls, **columns):
+        """Creates a history from arrays of equal length, missing columns are zero"""
+        length = len(next(iter(columns.values())))
+        history = cls(capacity=length)
+        for name, values in columns.items():
+            history._columns[name][:length] = values
+        history._length = length
+        return history
+
+    def _grow(self, capacity):
+        for name, values in self._columns.items():
+            grown = np.zeros(capacity, dtype=values.dtype)
+            grown[: self._length] = values[: self._length]
+            self._columns[name] = grown
+
+    def append(self, region):
+        if self._length == len(self._columns["x"]):
+            self._grow(2 * self._length)
+        self._length += 1
+        self._set_row(self._length - 1, region)
+
+    def _set_row(self, index, region):
+        columns = self._columns
+        columns["x"][index] = region.x
+        columns["y"][index] = region.y
+        columns["width"][index] = region.width
+        columns["height"][index] = region.height
+        columns["mass"][index] = region.mass
+        columns["pixel_variance"][index] = (
+            np.nan if region.pixel_variance is None else region.pixel_variance
+        )
+        columns["id"][index] = region.id
+        columns["frame_number"][index] = region.frame_number
+        columns["blank"][index] = region.blank
+        columns["was_cropped"][index] = region.was_cropped
+        columns["is_along_border"][index] = region.is_along_border
+
+    def column(self, name):
+        """Returns a view of the values of column name"""
+        return self._columns[name][: self._length]
+
+    @property
+    def x(self):
+        return self.column("x")
+
+    @property
+    def y(self):
+        return self.column("y")
+
+    @property
+    def width(self):
+        return self.column("width")
+
+    @property
+    def height(self):
+        return self.column("height")
+
+    @property
+    def right(self):
+        return self.x + self.width
+
+    @property
+    def bottom(self):
+        return self.y + self.height
+
+    @property
+    def mid_x(self):
+        return self.x + self.width / 2
+
+    @property
+    def mid_y(self):
+        return self.y + self.height / 2
+
+    @property
+    def area(self):
+        return self.width * self.height
+
+    @property
+    def mass(self):
+        return self.column("mass")
+
+    @property
+    def pixel_variance(self):
+        return self.column("pixel_variance")
+
+    @property
+    def frame_number(self):
+        return self.column("frame_number")
+
+    @property
+    def blank(self):
+        return self.column("blank")
+
+    @property
+    def was_cropped(self):
+        return self.column("was_cropped")
+
+    @property
+    def is_along_border(self):
+        return self.column("is_along_border")
+
+    def ltrb(self):
+        """Returns array of shape [regions, 4] of left, top, right, bottom bounds"""
+        return np.stack((self.x, self.y, self.right, self.bottom), axis=1)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            return RegionHistory.from_columns(
+                **{
+                    name: values[start:stop:step]
+                    for name, values in self._columns.items()
+                }
+            )
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError("region history index out of range")
+        return RegionView(self, index)
+
+    def __setitem__(self, index, region):
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError("region history index out of range")
+        self._set_row(index, region)
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield RegionView(self, index)
+
+    def __repr__(self):
+        return "RegionHistory({})".format(list(self))
+
+
+def _column_property(name, to_python):
+    def get(self):
+        return to_python(self._history._columns[name][self._index])
+
+    def set(self, value):
+        self._history._columns[name][self._index] = value
+
+    return property(get, set)
+
+
+def _variance_to_python(value):
+    if np.isnan(value):
+        return None
+    return float(value)
+
+
+def _set_variance(self, value):
+    self._history._columns["pixel_variance"][self._index] = (
+        np.nan if value is None else value
+    )
+
+
+class RegionView(Region):
+    """A Region whose values are stored in a row of a RegionHistory"""
+
+    def __init__(self, history, index):
+        self._history = history
+        self._index = index
+
+    x = _column_property("x", int)
+    y = _column_property("y", int)
+    width = _column_property("width", int)
+    height = _column_property("height", int)
+    mass = _column_property("mass", int)
+    pixel_variance = property(
+        _column_property("pixel_variance", _variance_to_python).fget, _set_variance
+    )
+    id = _column_property("id", int)
+    frame_number = _column_property("frame_number", int)
+    blank = _column_property("blank", bool)
+    was_cropped = _column_property("was_cropped", bool)
+    is_along_border = _column_property("is_along_border", bool)
@@ -0,0 +1,106 @@
+"""
+classifier-pipeline - this is a server side component that manipulates cptv
+files and to create a classification model of animals present
+Copyright (C) 2018, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+
+class RegionGrid:
+    """
+    A uniform grid of cells covering the frame, each cell lists the items whose bounds
+    cover any of its pixels. Bounds outside of the frame are clamped to the edge cells,
+    so any two rectangles with a positive overlap area always share a cell.
+    """
+
+    CELL_SIZE = 16
+
+    def __init__(self, width=160, height=120, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cols = max(1, -(-width // cell_size))
+        self.rows = max(1, -(-height // cell_size))
+        self.cells = [[] for _ in range(self.cols * self.rows)]
+
+    def _cells(self, rect):
+        if rect.width <= 0 or rect.height <= 0:
+            return []
+        size = self.cell_size
+        left = min(self.cols - 1, max(0, int(rect.left) // size))
+        right = min(self.cols - 1, max(0, (int(rect.right) - 1) // size))
+        top = min(self.rows - 1, max(0, int(rect.top) // size))
+        bottom = min(self.rows - 1, max(0, (int(rect.bottom) - 1) // size))
+        return [
+            row * self.cols + col
+            for row in range(top, bottom + 1)
+            for col in range(left, right + 1)
+        ]
+
+    def add(self, item, rect):
+        for cell in self._cells(rect):
+            self.cells[cell].append(item)
+
+    def query(self, rect):
+        """Returns the set of items which may overlap rect"""
+        items = set()
+        for cell in self._cells(rect):
+            items.update(self.cells[cell])
+        return items
+
+
+class TrackOverlapIndex:
+    """
+    Indexes tracks by their frame range and the rectangle enclosing all of their
+    regions, so overlap checks only need to consider tracks which share frames and
+    space with each other.
+    """
+
+    def __init__(self, tracks):
+        self.tracks = [track for track in tracks if len(track) > 0]
+        self.start = np.array([track.start_frame for track in self.tracks])
+        self.end = np.array(
+            [track.start_frame + len(track) - 1 for track in self.tracks]
+        )
+        bounds = np.array(
+            [
+                (
+                    track.bounds_history.x.min(),
+                    track.bounds_history.y.min(),
+                    track.bounds_history.right.max(),
+                    track.bounds_history.bottom.max(),
+                )
+                for track in self.tracks
+            ]
+        ).reshape(-1, 4)
+        self.left, self.top, self.right, self.bottom = bounds.T
+
+    def candidates(self, track):
+        """Returns the other tracks which share frames and space with track"""
+        if len(track) == 0 or len(self.tracks) == 0:
+            return []
+        history = track.bounds_history
+        end = track.start_frame + len(track) - 1
+        possible = (
+            (self.start <= end)
+            & (self.end >= track.start_frame)
+            & (self.left < history.right.max())
+            & (self.right > history.x.min())
+            & (self.top < history.bottom.max())
+            & (self.bottom > history.y.min())
+        )
+        return [
+            self.tracks[i] for i in np.flatnonzero(possible) if self.tracks[i] != track
+        ]
@@ -0,0 +1,44 @@
+import numpy as np
+
+from track.region import Region
+from track.regionhistory import RegionHistory
+
+
+def make_regions(count):
+    return [
+        Region(i, i + 1, 10 + i, 20, mass=i * 3, frame_number=i, blank=i % 2 == 0)
+        for i in range(count)
+    ]
+
+
+class TestRegionHistory:
+    def test_append_and_view(self):
+        regions = make_regions(40)
+        history = RegionHistory(regions)
+        assert len(history) == 40
+        for region, view in zip(regions, history):
+            assert str(region) == str(view)
+            assert region.mass == view.mass
+            assert region.blank == view.blank
+            assert region.frame_number == view.frame_number
+        assert np.array_equal(history.mass, [region.mass for region in regions])
+        assert history[-1].x == regions[-1].x
+
+    def test_view_writes_through(self):
+        history = RegionHistory(make_regions(3))
+        view = history[1]
+        view.mass = 100
+        view.pixel_variance = None
+        view.right = 50
+        assert history.mass[1] == 100
+        assert history[1].pixel_variance is None
+        assert history[1].width == 50 - view.x
+        assert history[1].copy().width == view.width
+
+    def test_slice(self):
+        history = RegionHistory(make_regions(10))
+        sliced = history[2:5]
+        assert len(sliced) == 3
+        assert sliced[0].frame_number == 2
+        sliced[0].mass = 1000
+        assert history[2].mass == 6
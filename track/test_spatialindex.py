@@ -0,0 +1,68 @@
+import numpy as np
+
+from track.region import Region
+from track.spatialindex import RegionGrid, TrackOverlapIndex
+from track.track import Track
+
+
+def random_region(rng, frame_number=0):
+    return Region(
+        int(rng.integers(-10, 160)),
+        int(rng.integers(-10, 120)),
+        int(rng.integers(0, 40)),
+        int(rng.integers(0, 40)),
+        frame_number=frame_number,
+    )
+
+
+def random_track(rng):
+    track = Track(1)
+    track.start_frame = int(rng.integers(0, 50))
+    for i in range(int(rng.integers(1, 30))):
+        track.add_region(random_region(rng, track.start_frame + i))
+    return track
+
+
+def loop_overlap_ratio(track, other, threshold=0.05):
+    """Overlap ratio calculated one frame at a time"""
+    frames_overlapped = 0
+    for pos in range(track.start_frame, track.end_frame + 1):
+        our_index = pos - track.start_frame
+        other_index = pos - other.start_frame
+        if 0 <= other_index < len(other) and our_index < len(track):
+            bounds = track.bounds_history[our_index]
+            if bounds.area == 0:
+                continue
+            overlap = bounds.overlap_area(other.bounds_history[other_index])
+            if overlap / bounds.area >= threshold:
+                frames_overlapped += 1
+    return frames_overlapped / len(track)
+
+
+class TestSpatialIndex:
+    def test_grid_finds_overlaps(self):
+        rng = np.random.default_rng(1)
+        regions = [random_region(rng) for _ in range(200)]
+        grid = RegionGrid(160, 120)
+        for i, region in enumerate(regions):
+            grid.add(i, region)
+        for _ in range(100):
+            query = random_region(rng)
+            expected = {
+                i for i, region in enumerate(regions) if region.overlap_area(query) > 0
+            }
+            assert expected <= grid.query(query)
+
+    def test_overlap_ratio(self):
+        rng = np.random.default_rng(2)
+        tracks = [random_track(rng) for _ in range(30)]
+        index = TrackOverlapIndex(tracks)
+        for track in tracks:
+            candidates = index.candidates(track)
+            for other in tracks:
+                if other == track:
+                    continue
+                ratio = track.get_overlap_ratio(other)
+                assert ratio == loop_overlap_ratio(track, other)
+                if ratio > 0:
+                    assert other in candidates
@@ -0,0 +1,153 @@
+import math
+import time
+
+import numpy as np
+import pytest
+
+from ml_tools.tools import eucl_distance
+from track.region import Region
+from track.track import Track, TrackMovementStatistics
+
+
+def random_track(rng, frames):
+    track = Track(1)
+    track.start_frame = 0
+    x = int(rng.integers(0, 100))
+    y = int(rng.integers(0, 80))
+    for frame_number in range(frames):
+        if frame_number > 0 and rng.random() < 0.1:
+            track.add_blank_frame()
+            continue
+        x = int(np.clip(x + rng.integers(-3, 4), 0, 140))
+        y = int(np.clip(y + rng.integers(-3, 4), 0, 100))
+        region = Region(
+            x,
+            y,
+            int(rng.integers(4, 20)),
+            int(rng.integers(4, 20)),
+            mass=int(rng.integers(1, 200)),
+            frame_number=frame_number,
+        )
+        region.pixel_variance = float(rng.random() * 5)
+        region.is_along_border = bool(rng.random() < 0.1)
+        track.add_region(region)
+    return track
+
+
+def loop_stats(track):
+    """Calculates the statistics of track one region at a time"""
+    if len(track) <= 1:
+        return TrackMovementStatistics()
+    history = track.bounds_history
+    non_blank = [bound for bound in history if not bound.blank]
+    mass_history = [int(bound.mass) for bound in non_blank]
+    variance_history = [
+        bound.pixel_variance for bound in non_blank if bound.pixel_variance
+    ]
+    movement = 0
+    max_offset = 0
+    frames_moved = 0
+    avg_vel = 0
+    first_point = history[0].mid
+    for i, (vx, vy) in enumerate(zip(track.vel_x, track.vel_y)):
+        region = history[i]
+        if not region.blank:
+            avg_vel += abs(vx) + abs(vy)
+        if i == 0:
+            continue
+        if region.blank or history[i - 1].blank:
+            continue
+        if region.has_moved(history[i - 1]) or region.is_along_border:
+            movement += (vx**2 + vy**2) ** 0.5
+            max_offset = max(max_offset, eucl_distance(first_point, region.mid))
+            frames_moved += 1
+    avg_vel = avg_vel / len(mass_history)
+    max_offset = math.sqrt(max_offset)
+    delta_std = float(np.mean(variance_history)) ** 0.5
+    jitter_bigger = 0
+    jitter_smaller = 0
+    for i in range(1, len(history)):
+        bound = history[i]
+        prev_bound = history[i - 1]
+        if prev_bound.is_along_border or bound.is_along_border:
+            continue
+        height_diff = bound.height - prev_bound.height
+        width_diff = prev_bound.width - bound.width
+        thresh_h = max(
+            Track.MIN_JITTER_CHANGE, prev_bound.height * Track.JITTER_THRESHOLD
+        )
+        thresh_v = max(
+            Track.MIN_JITTER_CHANGE, prev_bound.width * Track.JITTER_THRESHOLD
+        )
+        if abs(height_diff) > thresh_h:
+            if height_diff > 0:
+                jitter_bigger += 1
+            else:
+                jitter_smaller += 1
+        elif abs(width_diff) > thresh_v:
+            if width_diff > 0:
+                jitter_bigger += 1
+            else:
+                jitter_smaller += 1
+
+    movement_points = (movement**0.5) + max_offset
+    jitter_percent = int(
+        round(100 * (jitter_bigger + jitter_smaller) / float(track.frames))
+    )
+    blank_percent = int(round(100.0 * track.blank_frames / track.frames))
+    score = (
+        min(movement_points, 100)
+        + min(delta_std * 25.0, 100)
+        + (100 - jitter_percent)
+        + (100 - blank_percent)
+    )
+    return TrackMovementStatistics(
+        movement=float(movement),
+        max_offset=float(max_offset),
+        average_mass=float(np.mean(mass_history)),
+        median_mass=float(np.median(mass_history)),
+        delta_std=float(delta_std),
+        score=float(score),
+        region_jitter=jitter_percent,
+        jitter_bigger=jitter_bigger,
+        jitter_smaller=jitter_smaller,
+        blank_percent=blank_percent,
+        frames_moved=frames_moved,
+        mass_std=float(np.std(mass_history)),
+        average_velocity=float(avg_vel),
+    )
+
+
+def assert_stats_equal(expected, stats):
+    for name, value in expected._asdict().items():
+        if isinstance(value, float):
+            assert getattr(stats, name) == pytest.approx(value, nan_ok=True), name
+        else:
+            assert getattr(stats, name) == value, name
+
+
+class TestTrackStats:
+    def test_batch_stats_match_loop(self):
+        rng = np.random.default_rng(3)
+        tracks = [random_track(rng, int(rng.integers(1, 60))) for _ in range(40)]
+        batch_stats = Track.get_batch_stats(tracks)
+        for track, stats in zip(tracks, batch_stats):
+            assert_stats_equal(loop_stats(track), stats)
+            assert_stats_equal(loop_stats(track), track.get_stats())
+
+    def test_batch_stats_speed(self):
+        rng = np.random.default_rng(5)
+        tracks = [random_track(rng, 3000) for _ in range(10)]
+        start = time.time()
+        loop = [loop_stats(track) for track in tracks]
+        loop_time = time.time() - start
+        start = time.time()
+        batch = Track.get_batch_stats(tracks)
+        batch_time = time.time() - start
+        for expected, stats in zip(loop, batch):
+            assert_stats_equal(expected, stats)
+        print(
+            "get_stats of {} frames loop {:.3f}s batch {:.3f}s".format(
+                sum(len(track) for track in tracks), loop_time, batch_time
+            )
+        )
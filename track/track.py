@@ -22,7 +22,8 @@ from collections import namedtuple
 
 from ml_tools.tools import Rectangle, get_clipped_flow
 from track.region import Region
-from kalman.kalman import Kalman
+from track.regionhistory import RegionHistory
+from kalman.kalman import KalmanTracker
 from ml_tools.tools import eucl_distance
 
 
@@ -49,10 +50,11 @@ class Track:
     # must change atleast 5 pixels to be considered for jitter
     MIN_JITTER_CHANGE = 5
 
-    def __init__(self, clip_id, id=None, fps=9):
+    def __init__(self, clip_id, id=None, fps=9, kalman_batch=None):
         """
         Creates a new Track.
         :param id: id number for track, if not specified is provided by an auto-incrementer
+        :param kalman_batch: (optional) BatchKalman shared by the tracks of a clip
         """
 
         if not id:
@@ -70,7 +72,7 @@ class Track:
         self.current_frame_num = None
         self.frame_list = []
         # our bounds over time
-        self.bounds_history = []
+        self.bounds_history = RegionHistory()
         # number frames since we lost target.
         self.frames_since_target_seen = 0
         self.blank_frames = 0
@@ -87,8 +89,7 @@ class Track:
 
         self.from_metadata = False
         self.track_tags = None
-        self.kalman_tracker = Kalman()
-        self.predicted_mid = None
+        self.kalman_tracker = KalmanTracker(kalman_batch)
         self.crop_rectangle = None
 
         self.predictions = None
@@ -100,7 +101,7 @@ class Track:
 
     @classmethod
     def from_region(cls, clip, region):
-        track = cls(clip.get_id(), fps=clip.frames_per_second)
+        track = cls(clip.get_id(), fps=clip.frames_per_second, kalman_batch=clip.kalman)
         track.start_frame = region.frame_number
         track.start_s = region.frame_number / float(clip.frames_per_second)
         track.crop_rectangle = clip.crop_rectangle
@@ -153,7 +154,7 @@ class Track:
         positions = data.get("positions")
         if not positions:
             return False
-        self.bounds_history = []
+        self.bounds_history = RegionHistory()
         self.frame_list = []
         for position in positions:
             frame_number = round(position[0] * frames_per_second)
@@ -178,9 +179,7 @@ class Track:
         self.update_velocity()
         self.frames_since_target_seen = 0
         self.kalman_tracker.correct(region)
-        prediction = self.kalman_tracker.predict()
-
-        self.predicted_mid = (prediction[0][0], prediction[1][0])
+        self.kalman_tracker.predict()
 
     def update_velocity(self):
         if len(self.bounds_history) >= 2:
@@ -215,9 +214,8 @@ class Track:
 
     def average_mass(self):
         """Average mass of last 3 frames that weren't blank"""
-        return np.mean(
-            [bound.mass for bound in self.bounds_history if bound.blank == False][-3:]
-        )
+        history = self.bounds_history
+        return np.mean(history.mass[~history.blank][-3:])
 
     def add_blank_frame(self, buffer_frame=None):
         """Maintains same bounds as previously, does not reset framce_since_target_seen counter"""
@@ -241,8 +239,11 @@ class Track:
         self.update_velocity()
         self.blank_frames += 1
         self.frames_since_target_seen += 1
-        prediction = self.kalman_tracker.predict()
-        self.predicted_mid = (prediction[0][0], prediction[1][0])
+        self.kalman_tracker.predict()
+
+    @property
+    def predicted_mid(self):
+        return self.kalman_tracker.predicted_mid
 
     def get_stats(self):
         """
@@ -250,96 +251,158 @@ class Track:
         that this is a good track.
         :return: a TrackMovementStatistics record
         """
+        return Track.get_batch_stats([self])[0]
 
-        if len(self) <= 1:
-            return TrackMovementStatistics()
-        # get movement vectors only from non blank regions
-        non_blank = [bound for bound in self.bounds_history if not bound.blank]
-        mass_history = [int(bound.mass) for bound in non_blank]
-        variance_history = [
-            bound.pixel_variance for bound in non_blank if bound.pixel_variance
-        ]
-        movement = 0
-        max_offset = 0
-
-        frames_moved = 0
-        avg_vel = 0
-        first_point = self.bounds_history[0].mid
-        for i, (vx, vy) in enumerate(zip(self.vel_x, self.vel_y)):
-            region = self.bounds_history[i]
-            if not region.blank:
-                avg_vel += abs(vx) + abs(vy)
-            if i == 0:
-                continue
-
-            if region.blank or self.bounds_history[i - 1].blank:
-                continue
-            if region.has_moved(self.bounds_history[i - 1]) or region.is_along_border:
-                distance = (vx ** 2 + vy ** 2) ** 0.5
-                movement += distance
-                offset = eucl_distance(first_point, region.mid)
-                max_offset = max(max_offset, offset)
-                frames_moved += 1
-        avg_vel = avg_vel / len(mass_history)
+    @staticmethod
+    def get_batch_stats(tracks):
+        """
+        Calculates the statistics of many tracks at once, by concatenating their histories
+        :return: a list of TrackMovementStatistics records, one for each track
+        """
+        all_stats = [TrackMovementStatistics() for _ in tracks]
+        scored = [i for i, track in enumerate(tracks) if len(track) > 1]
+        if len(scored) == 0:
+            return all_stats
+        tracks = [tracks[i] for i in scored]
+        lengths = np.array([len(track) for track in tracks])
+        num_tracks = len(tracks)
+        starts = np.cumsum(lengths) - lengths
+        segment = np.repeat(np.arange(num_tracks), lengths)
+
+        def concat(name):
+            return np.concatenate(
+                [track.bounds_history.column(name) for track in tracks]
+            )
+
+        x = concat("x")
+        y = concat("y")
+        width = concat("width")
+        height = concat("height")
+        mass = concat("mass")
+        variance = concat("pixel_variance")
+        blank = concat("blank")
+        border = concat("is_along_border")
+        right = x + width
+        bottom = y + height
+        mid_x = x + width / 2
+        mid_y = y + height / 2
+
+        # velocities may be shorter than the history, e.g. tracks from metadata
+        vel_x = np.zeros(len(x))
+        vel_y = np.zeros(len(x))
+        has_vel = np.zeros(len(x), dtype=bool)
+        for start, track in zip(starts, tracks):
+            num_vel = min(len(track), len(track.vel_x), len(track.vel_y))
+            vel_x[start : start + num_vel] = track.vel_x[:num_vel]
+            vel_y[start : start + num_vel] = track.vel_y[:num_vel]
+            has_vel[start : start + num_vel] = True
+
+        # compare each region with the previous region of the same track
+        is_first = np.zeros(len(x), dtype=bool)
+        is_first[starts] = True
+        prev = np.maximum(0, np.arange(len(x)) - 1)
+        has_moved = (
+            (x != x[prev]) & (right != right[prev])
+            | (y != y[prev]) & (bottom != bottom[prev])
+        ) | border
+
+        def segment_sum(values, mask):
+            return np.bincount(
+                segment[mask], weights=values[mask], minlength=num_tracks
+            )
+
+        def segment_count(mask):
+            return np.bincount(segment[mask], minlength=num_tracks)
+
+        avg_vel = segment_sum(np.abs(vel_x) + np.abs(vel_y), has_vel & ~blank)
+        moved = has_vel & ~is_first & ~blank & ~blank[prev] & has_moved
+        movement = segment_sum(np.power(vel_x ** 2 + vel_y ** 2, 0.5), moved)
+        frames_moved = segment_count(moved)
+        offset = (mid_x[starts][segment] - mid_x) ** 2 + (
+            mid_y[starts][segment] - mid_y
+        ) ** 2
+        max_offset = np.zeros(num_tracks)
+        np.maximum.at(max_offset, segment[moved], offset[moved])
+        max_offset = np.sqrt(max_offset)
+
+        non_blank = ~blank
+        num_mass = segment_count(non_blank)
         # the standard deviation is calculated by averaging the per frame variances.
         # this ends up being slightly different as I'm using /n rather than /(n-1) but that
         # shouldn't make a big difference as n = width*height*frames which is large.
-        max_offset = math.sqrt(max_offset)
-        delta_std = float(np.mean(variance_history)) ** 0.5
-        jitter_bigger = 0
-        jitter_smaller = 0
-        for i, bound in enumerate(self.bounds_history[1:]):
-            prev_bound = self.bounds_history[i]
-            if prev_bound.is_along_border or bound.is_along_border:
-                continue
-            height_diff = bound.height - prev_bound.height
-            width_diff = prev_bound.width - bound.width
-            thresh_h = max(
-                Track.MIN_JITTER_CHANGE, prev_bound.height * Track.JITTER_THRESHOLD
+        has_variance = non_blank & ~np.isnan(variance) & (variance != 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg_vel = avg_vel / num_mass
+            average_mass = segment_sum(mass.astype(np.float64), non_blank) / num_mass
+            mass_std = np.sqrt(
+                segment_sum((mass - average_mass[segment]) ** 2, non_blank) / num_mass
             )
-            thresh_v = max(
-                Track.MIN_JITTER_CHANGE, prev_bound.width * Track.JITTER_THRESHOLD
-            )
-            if abs(height_diff) > thresh_h:
-                if height_diff > 0:
-                    jitter_bigger += 1
-                else:
-                    jitter_smaller += 1
-            elif abs(width_diff) > thresh_v:
-                if width_diff > 0:
-                    jitter_bigger += 1
-                else:
-                    jitter_smaller += 1
-
-        movement_points = (movement ** 0.5) + max_offset
-        delta_points = delta_std * 25.0
-        jitter_percent = int(
-            round(100 * (jitter_bigger + jitter_smaller) / float(self.frames))
+            delta_std = (
+                segment_sum(variance, has_variance) / segment_count(has_variance)
+            ) ** 0.5
+
+        # median of each track, from masses sorted within each track
+        sorted_mass = np.float64(
+            mass[non_blank][np.lexsort((mass[non_blank], segment[non_blank]))]
+        )
+        mass_starts = np.cumsum(num_mass) - num_mass
+        has_mass = num_mass > 0
+        median_mass = np.full(num_tracks, np.nan)
+        median_mass[has_mass] = (
+            sorted_mass[mass_starts[has_mass] + (num_mass[has_mass] - 1) // 2]
+            + sorted_mass[mass_starts[has_mass] + num_mass[has_mass] // 2]
+        ) / 2
+
+        # jitter between each region and the previous region
+        checked = ~is_first & ~border & ~border[prev]
+        height_diff = height - height[prev]
+        width_diff = width[prev] - width
+        thresh_h = np.maximum(
+            Track.MIN_JITTER_CHANGE, height[prev] * Track.JITTER_THRESHOLD
         )
-        blank_percent = int(round(100.0 * self.blank_frames / self.frames))
-        score = (
-            min(movement_points, 100)
-            + min(delta_points, 100)
-            + (100 - jitter_percent)
-            + (100 - blank_percent)
+        thresh_v = np.maximum(
+            Track.MIN_JITTER_CHANGE, width[prev] * Track.JITTER_THRESHOLD
         )
-        stats = TrackMovementStatistics(
-            movement=float(movement),
-            max_offset=float(max_offset),
-            average_mass=float(np.mean(mass_history)),
-            median_mass=float(np.median(mass_history)),
-            delta_std=float(delta_std),
-            score=float(score),
-            region_jitter=jitter_percent,
-            jitter_bigger=jitter_bigger,
-            jitter_smaller=jitter_smaller,
-            blank_percent=blank_percent,
-            frames_moved=frames_moved,
-            mass_std=float(np.std(mass_history)),
-            average_velocity=float(avg_vel),
+        height_jitter = checked & (np.abs(height_diff) > thresh_h)
+        width_jitter = checked & ~height_jitter & (np.abs(width_diff) > thresh_v)
+        jitter_bigger = segment_count(
+            height_jitter & (height_diff > 0) | width_jitter & (width_diff > 0)
+        )
+        jitter_smaller = segment_count(
+            height_jitter & (height_diff <= 0) | width_jitter & (width_diff <= 0)
         )
 
-        return stats
+        for i, track in enumerate(tracks):
+            movement_points = (movement[i] ** 0.5) + max_offset[i]
+            delta_points = delta_std[i] * 25.0
+            jitter_percent = int(
+                round(
+                    100 * (jitter_bigger[i] + jitter_smaller[i]) / float(track.frames)
+                )
+            )
+            blank_percent = int(round(100.0 * track.blank_frames / track.frames))
+            score = (
+                min(movement_points, 100)
+                + min(delta_points, 100)
+                + (100 - jitter_percent)
+                + (100 - blank_percent)
+            )
+            all_stats[scored[i]] = TrackMovementStatistics(
+                movement=float(movement[i]),
+                max_offset=float(max_offset[i]),
+                average_mass=float(average_mass[i]),
+                median_mass=float(median_mass[i]),
+                delta_std=float(delta_std[i]),
+                score=float(score),
+                region_jitter=jitter_percent,
+                jitter_bigger=int(jitter_bigger[i]),
+                jitter_smaller=int(jitter_smaller[i]),
+                blank_percent=blank_percent,
+                frames_moved=int(frames_moved[i]),
+                mass_std=float(mass_std[i]),
+                average_velocity=float(avg_vel[i]),
+            )
+        return all_stats
 
     def smooth(self, frame_bounds: Rectangle):
         """
@@ -348,43 +411,32 @@ class Track:
         """
         if len(self.bounds_history) == 0:
             return
-
-        new_bounds_history = []
-        prev_frame = self.bounds_history[0]
-        current_frame = self.bounds_history[0]
-        next_frame = self.bounds_history[1]
-
-        for i in range(len(self.bounds_history)):
-
-            prev_frame = self.bounds_history[max(0, i - 1)]
-            current_frame = self.bounds_history[i]
-            next_frame = self.bounds_history[min(len(self.bounds_history) - 1, i + 1)]
-
-            frame_x = current_frame.mid_x
-            frame_y = current_frame.mid_y
-            frame_width = (
-                prev_frame.width + current_frame.width + next_frame.width
-            ) / 3
-            frame_height = (
-                prev_frame.height + current_frame.height + next_frame.height
-            ) / 3
-            frame = Region(
-                int(frame_x - frame_width / 2),
-                int(frame_y - frame_height / 2),
-                int(frame_width),
-                int(frame_height),
-            )
-            frame.crop(frame_bounds)
-
-            new_bounds_history.append(frame)
-
-        self.bounds_history = new_bounds_history
+        history = self.bounds_history
+        # average width and height with the previous and next frames
+        prev_i = np.maximum(0, np.arange(len(history)) - 1)
+        next_i = np.minimum(len(history) - 1, np.arange(len(history)) + 1)
+        width = (history.width[prev_i] + history.width + history.width[next_i]) / 3
+        height = (history.height[prev_i] + history.height + history.height[next_i]) / 3
+
+        left = np.trunc(history.mid_x - width / 2)
+        top = np.trunc(history.mid_y - height / 2)
+        right = left + np.trunc(width)
+        bottom = top + np.trunc(height)
+        # same as Rectangle.crop
+        left = np.maximum(left, frame_bounds.left)
+        top = np.maximum(top, frame_bounds.top)
+        right = np.maximum(frame_bounds.left, np.minimum(right, frame_bounds.right))
+        bottom = np.maximum(frame_bounds.top, np.minimum(bottom, frame_bounds.bottom))
+
+        self.bounds_history = RegionHistory.from_columns(
+            x=left, y=top, width=right - left, height=bottom - top
+        )
 
     def trim(self):
         """
         Removes empty frames from start and end of track
         """
-        mass_history = [int(bound.mass) for bound in self.bounds_history]
+        mass_history = self.bounds_history.mass
         start = 0
         while start < len(self) and mass_history[start] <= 2:
             start += 1
@@ -396,7 +448,7 @@ class Track:
             end -= 1
         if end < start:
             self.start_frame = 0
-            self.bounds_history = []
+            self.bounds_history = RegionHistory()
             self.vel_x = []
             self.vel_y = []
             self.blank_frames = 0
@@ -419,26 +471,31 @@ class Track:
             return 0.0
 
         start = max(self.start_frame, other_track.start_frame)
-        end = min(self.end_frame, other_track.end_frame)
-
-        frames_overlapped = 0
-
-        for pos in range(start, end + 1):
-            our_index = pos - self.start_frame
-            other_index = pos - other_track.start_frame
-            if (
-                our_index >= 0
-                and other_index >= 0
-                and our_index < len(self)
-                and other_index < len(other_track)
-            ):
-                our_bounds = self.bounds_history[our_index]
-                if our_bounds.area == 0:
-                    continue
-                other_bounds = other_track.bounds_history[other_index]
-                overlap = our_bounds.overlap_area(other_bounds) / our_bounds.area
-                if overlap >= threshold:
-                    frames_overlapped += 1
+        end = min(
+            self.end_frame,
+            other_track.end_frame,
+            self.start_frame + len(self) - 1,
+            other_track.start_frame + len(other_track) - 1,
+        )
+        if end < start:
+            return 0.0
+
+        ours = self.bounds_history
+        theirs = other_track.bounds_history
+        our_slice = slice(start - self.start_frame, end + 1 - self.start_frame)
+        other_slice = slice(
+            start - other_track.start_frame, end + 1 - other_track.start_frame
+        )
+        x_overlap = np.minimum(ours.right[our_slice], theirs.right[other_slice])
+        x_overlap -= np.maximum(ours.x[our_slice], theirs.x[other_slice])
+        y_overlap = np.minimum(ours.bottom[our_slice], theirs.bottom[other_slice])
+        y_overlap -= np.maximum(ours.y[our_slice], theirs.y[other_slice])
+        overlap = np.maximum(0, x_overlap) * np.maximum(0, y_overlap)
+        area = ours.area[our_slice]
+        has_area = area != 0
+        frames_overlapped = np.count_nonzero(
+            overlap[has_area] / area[has_area] >= threshold
+        )
 
         return frames_overlapped / len(self)
 
@@ -464,7 +521,7 @@ class Track:
 
     @property
     def last_mass(self):
-        return self.bounds_history[-1].mass
+        return int(self.bounds_history.mass[-1])
 
     @property
     def velocity(self):
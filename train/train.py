@@ -1,11 +1,10 @@
 import datetime
 import os
-import pickle
 
 import tensorflow as tf
 from model_crnn import ModelCRNN_HQ, ModelCRNN_LQ, Model_CNN
 from model_resnet import ResnetModel
-from ml_tools.dataset import dataset_db_path
+from ml_tools.dataset import get_datasets_path, load_datasets
 
 
 def train_model(run_name, conf, hyper_params):
@@ -14,9 +13,8 @@ def train_model(run_name, conf, hyper_params):
 
     # a little bit of a pain, the model needs to know how many classes to classify during initialisation,
     # but we don't load the dataset till after that, so we load it here just to count the number of labels...
-    datasets_filename = dataset_db_path(conf)
-    with open(datasets_filename, "rb") as f:
-        dsets = pickle.load(f)
+    datasets_filename = get_datasets_path(conf)
+    dsets = load_datasets(datasets_filename)
     labels = dsets[0].labels
     if conf.train.model == ResnetModel.MODEL_NAME:
         model = ResnetModel(labels, conf.train)